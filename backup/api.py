@@ -1,160 +1,229 @@
 import logging
-import random
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+from itertools import chain
+from typing import Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from .cache import NOT_MODIFIED, ResponseCache
 from .data import (
     Cast,
     Country,
     Director,
     Genre,
     Movie,
+    MovieNotModified,
     MovieRating,
     UserDetails,
     UserRating,
     UserSimilarity,
 )
+from .errors import FilmwebError, FilmwebInvalidTokenError
+from .ratelimit import RateLimiter, backoff_delay, parse_retry_after
+from .token import TokenCache, decode_expiry
+
+# HTTP statuses the server uses to ask the clients to slow down
+THROTTLED = (429, 503)
+
+
+def parse_movie_details(movie_id: int, movie_details: dict) -> Movie:
+    return Movie(
+        id=movie_id,
+        title=movie_details["title"]["title"] if "title" in movie_details else None,
+        originalTitle=movie_details["originalTitle"]["title"],
+        internationalTitle=(
+            movie_details["internationalTitle"]["title"]
+            if "internationalTitle" in movie_details
+            else None
+        ),
+        year=movie_details["year"],
+        genres=(
+            list(
+                Genre(genre["id"], genre["name"]["text"])
+                for genre in movie_details["genres"]
+            )
+            if "genres" in movie_details
+            else []
+        ),
+        duration=movie_details["duration"] if "duration" in movie_details else None,
+        directors=(
+            list(
+                Director(director["id"], director["name"])
+                for director in movie_details["directors"]
+            )
+            if "directors" in movie_details
+            else []
+        ),
+        cast=(
+            list(Cast(cast["id"], cast["name"]) for cast in movie_details["mainCast"])
+            if "mainCast" in movie_details
+            else []
+        ),
+        countries=(
+            list(
+                Country(country["id"], country["code"])
+                for country in movie_details["countries"]
+            )
+            if "countries" in movie_details
+            else []
+        ),
+    )
+
+
+def parse_movie_rating(movie_id: int, movie_rating: dict) -> MovieRating:
+    return MovieRating(
+        movie_id=movie_id,
+        count=movie_rating["count"] if "count" in movie_rating else 0,
+        rate=movie_rating["rate"] if "rate" in movie_rating else 0.0,
+        countWantToSee=(
+            movie_rating["countWantToSee"] if "countWantToSee" in movie_rating else 0
+        ),
+        countVote1=(movie_rating["countVote1"] if "countVote1" in movie_rating else 0),
+        countVote2=(movie_rating["countVote2"] if "countVote2" in movie_rating else 0),
+        countVote3=(movie_rating["countVote3"] if "countVote3" in movie_rating else 0),
+        countVote4=(movie_rating["countVote4"] if "countVote4" in movie_rating else 0),
+        countVote5=(movie_rating["countVote5"] if "countVote5" in movie_rating else 0),
+        countVote6=(movie_rating["countVote6"] if "countVote6" in movie_rating else 0),
+        countVote7=(movie_rating["countVote7"] if "countVote7" in movie_rating else 0),
+        countVote8=(movie_rating["countVote8"] if "countVote8" in movie_rating else 0),
+        countVote9=(movie_rating["countVote9"] if "countVote9" in movie_rating else 0),
+        countVote10=(
+            movie_rating["countVote10"] if "countVote10" in movie_rating else 0
+        ),
+    )
+
+
+def parse_user_ratings(response: list) -> list[UserRating]:
+    return list(
+        UserRating(
+            score["entity"],
+            score["rate"],
+            score["favorite"] if "favorite" in score else False,
+            score["viewDate"],
+        )
+        for score in response
+    )
+
+
+def parse_user_details(response: dict) -> UserDetails:
+    return UserDetails(
+        id=response["id"],
+        name=response["name"],
+        display_name=(
+            f"{response["personalData"]["firstname"]} {response["personalData"]["surname"]}"
+            if "personalData" in response
+            else None
+        ),
+    )
+
+
+def parse_user_friends(response: dict) -> list[UserDetails]:
+    friends_details: list[UserDetails] = []
+    for id, details in response.items():
+        display_name = None
+        if "firstname" in details or "surname" in details:
+            display_name = f"{details["firstname"] if "firstname" in details else ""} {details["surname"] if "surname" in details else ""}".strip()
+
+        friend_details = UserDetails(
+            id=int(id),
+            name=details["name"],
+            display_name=display_name,
+        )
+        friends_details.append(friend_details)
+
+    return friends_details
+
+
+def parse_user_friends_similarities(response: list) -> list[UserSimilarity]:
+    return list(
+        UserSimilarity(
+            id=similarities[0],
+            similarity=similarities[1],
+            movies=similarities[2],
+        )
+        for similarities in response
+    )
 
 
 class FilmwebAPI:
-    def __init__(self, secret: str):
+    def __init__(
+        self,
+        secret: str,
+        pool_size: int = 10,
+        rate_limiter: RateLimiter | None = None,
+        max_retries: int = 5,
+        token_cache: TokenCache | None = None,
+        refresh_margin: float = 60.0,
+        response_cache: ResponseCache | None = None,
+    ):
         self.logger = logging.getLogger("filmweb.api")
 
+        self.session = self.create_session(pool_size)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = max_retries
+        self.response_cache = response_cache
+
+        # The token is refreshed in the background once it's about to expire,
+        # by a single thread, while the others keep using the current one
+        self.token_cache = token_cache
+        self.refresh_margin = refresh_margin
+        self.token_lock = threading.Lock()
+        self.refresher_lock = threading.Lock()
+        self.token_refresher: threading.Thread | None = None
+
         self.__secret__ = secret
-        self.__token__ = self.fetch_token()
+        self.__token__: str | None = None
+        self.token_expires_at: float | None = None
+        self.refresh_token(None)
 
     def fetch_movie_details(self, movie_id: int) -> Movie:
         movie_details = self.fetch(f"/film/{movie_id}/preview")
 
         self.logger.debug("Got movie details for movie id %s", movie_id)
 
-        return Movie(
-            id=movie_id,
-            title=movie_details["title"]["title"] if "title" in movie_details else None,
-            originalTitle=movie_details["originalTitle"]["title"],
-            internationalTitle=(
-                movie_details["internationalTitle"]["title"]
-                if "internationalTitle" in movie_details
-                else None
-            ),
-            year=movie_details["year"],
-            genres=(
-                list(
-                    Genre(genre["id"], genre["name"]["text"])
-                    for genre in movie_details["genres"]
-                )
-                if "genres" in movie_details
-                else []
-            ),
-            duration=movie_details["duration"] if "duration" in movie_details else None,
-            directors=(
-                list(
-                    Director(director["id"], director["name"])
-                    for director in movie_details["directors"]
-                )
-                if "directors" in movie_details
-                else []
-            ),
-            cast=(
-                list(
-                    Cast(cast["id"], cast["name"]) for cast in movie_details["mainCast"]
-                )
-                if "mainCast" in movie_details
-                else []
-            ),
-            countries=(
-                list(
-                    Country(country["id"], country["code"])
-                    for country in movie_details["countries"]
-                )
-                if "countries" in movie_details
-                else []
-            ),
-        )
+        return parse_movie_details(movie_id, movie_details)
+
+    def fetch_movie_details_if_modified(
+        self, movie_id: int
+    ) -> Movie | MovieNotModified:
+        movie_details = self.fetch(f"/film/{movie_id}/preview", if_modified=True)
+        if movie_details is NOT_MODIFIED:
+            self.logger.debug("Movie details for movie id %s haven't changed", movie_id)
+            return MovieNotModified(movie_id)
+
+        self.logger.debug("Got movie details for movie id %s", movie_id)
+
+        return parse_movie_details(movie_id, movie_details)
 
     def fetch_movie_rating(self, movie_id: int) -> MovieRating:
         movie_rating = self.fetch(f"/film/{movie_id}/rating")
 
         self.logger.debug("Got rating details for movie id %s", movie_id)
 
-        return MovieRating(
-            movie_id=movie_id,
-            count=movie_rating["count"] if "count" in movie_rating else 0,
-            rate=movie_rating["rate"] if "rate" in movie_rating else 0.0,
-            countWantToSee=(
-                movie_rating["countWantToSee"]
-                if "countWantToSee" in movie_rating
-                else 0
-            ),
-            countVote1=(
-                movie_rating["countVote1"] if "countVote1" in movie_rating else 0
-            ),
-            countVote2=(
-                movie_rating["countVote2"] if "countVote2" in movie_rating else 0
-            ),
-            countVote3=(
-                movie_rating["countVote3"] if "countVote3" in movie_rating else 0
-            ),
-            countVote4=(
-                movie_rating["countVote4"] if "countVote4" in movie_rating else 0
-            ),
-            countVote5=(
-                movie_rating["countVote5"] if "countVote5" in movie_rating else 0
-            ),
-            countVote6=(
-                movie_rating["countVote6"] if "countVote6" in movie_rating else 0
-            ),
-            countVote7=(
-                movie_rating["countVote7"] if "countVote7" in movie_rating else 0
-            ),
-            countVote8=(
-                movie_rating["countVote8"] if "countVote8" in movie_rating else 0
-            ),
-            countVote9=(
-                movie_rating["countVote9"] if "countVote9" in movie_rating else 0
-            ),
-            countVote10=(
-                movie_rating["countVote10"] if "countVote10" in movie_rating else 0
-            ),
-        )
+        return parse_movie_rating(movie_id, movie_rating)
 
     def fetch_user_ratings(self) -> list[UserRating]:
-        movies: list[UserRating] = []
-        page = 1
-        while True:
-            response = self.fetch(f"/logged/vote/title/film?page={page}", True)
-            if type(response) != list or len(response) == 0:
-                break
-
-            page = page + 1
-
-            for score in response:
-                movie = UserRating(
-                    score["entity"],
-                    score["rate"],
-                    score["favorite"] if "favorite" in score else False,
-                    score["viewDate"],
-                )
+        return list(chain.from_iterable(self.iter_user_ratings()))
 
-                movies.append(movie)
+    def iter_user_ratings(self, prefetch: int = 1) -> Iterator[list[UserRating]]:
+        count = 0
+        for response in self.iter_pages("/logged/vote/title/film", prefetch):
+            ratings = parse_user_ratings(response)
+            count += len(ratings)
 
-        self.logger.info("Found %s scored movies!", len(movies))
+            yield ratings
 
-        return movies
+        self.logger.info("Found %s scored movies!", count)
 
     def fetch_user_details(self) -> UserDetails:
         response = self.fetch("/logged/info", True)
 
-        user_details = UserDetails(
-            id=response["id"],
-            name=response["name"],
-            display_name=(
-                f"{response["personalData"]["firstname"]} {response["personalData"]["surname"]}"
-                if "personalData" in response
-                else None
-            ),
-        )
+        user_details = parse_user_details(response)
 
         self.logger.debug("Got user details for user %s", user_details.name)
 
@@ -163,18 +232,7 @@ class FilmwebAPI:
     def fetch_user_friends(self) -> list[UserDetails]:
         response = self.fetch(f"/logged/friends", True)
 
-        friends_details: list[UserDetails] = []
-        for id, details in response.items():
-            display_name = None
-            if "firstname" in details or "surname" in details:
-                display_name = f"{details["firstname"] if "firstname" in details else ""} {details["surname"] if "surname" in details else ""}".strip()
-
-            friend_details = UserDetails(
-                id=int(id),
-                name=details["name"],
-                display_name=display_name,
-            )
-            friends_details.append(friend_details)
+        friends_details = parse_user_friends(response)
 
         self.logger.info("Found %s friends!", len(friends_details))
 
@@ -183,14 +241,7 @@ class FilmwebAPI:
     def fetch_user_friends_similarities(self) -> list[UserSimilarity]:
         response = self.fetch(f"/logged/friends/similarities", True)
 
-        friends_similarities: list[UserSimilarity] = []
-        for similarities in response:
-            friend_similarity = UserSimilarity(
-                id=similarities[0],
-                similarity=similarities[1],
-                movies=similarities[2],
-            )
-            friends_similarities.append(friend_similarity)
+        friends_similarities = parse_user_friends_similarities(response)
 
         self.logger.info(
             f"Found {len(friends_similarities)} friends with similar taste!"
@@ -199,37 +250,115 @@ class FilmwebAPI:
         return friends_similarities
 
     def fetch_friend_ratings(self, friend_name: str) -> list[UserRating]:
-        movies: list[UserRating] = []
+        return list(chain.from_iterable(self.iter_friend_ratings(friend_name)))
+
+    def iter_friend_ratings(
+        self, friend_name: str, prefetch: int = 1
+    ) -> Iterator[list[UserRating]]:
+        count = 0
+        for response in self.iter_pages(
+            f"/logged/friend/{friend_name}/vote/title/film", prefetch
+        ):
+            ratings = parse_user_ratings(response)
+            count += len(ratings)
+
+            yield ratings
+
+        self.logger.info(f"Found {count} movies scored by {friend_name}!")
+
+    def iter_pages(self, path: str, prefetch: int = 1) -> Iterator[list]:
+        """
+        Yields consecutive pages of a paginated endpoint until the first empty
+        one, keeping up to `prefetch` pages requested ahead of the consumer
+        """
+        if prefetch <= 1:
+            page = 1
+            while True:
+                response = self.fetch(f"{path}?page={page}", True)
+                if type(response) != list or len(response) == 0:
+                    return
+
+                page = page + 1
+
+                yield response
+
+        pending: deque[Future] = deque()
         page = 1
-        while True:
-            response = self.fetch(
-                f"/logged/friend/{friend_name}/vote/title/film?page={page}", True
-            )
-            if type(response) != list or len(response) == 0:
-                break
-
-            page = page + 1
-
-            for score in response:
-                movie = UserRating(
-                    score["entity"],
-                    score["rate"],
-                    score["favorite"] if "favorite" in score else False,
-                    score["viewDate"],
-                )
+        executor = ThreadPoolExecutor(
+            max_workers=prefetch, thread_name_prefix="filmweb-page"
+        )
+        try:
+            while True:
+                # Speculatively request the next pages, the ones after the
+                # last page are empty and simply thrown away
+                while len(pending) < prefetch:
+                    pending.append(
+                        executor.submit(self.fetch, f"{path}?page={page}", True)
+                    )
+                    page = page + 1
+
+                response = pending.popleft().result()
+                if type(response) != list or len(response) == 0:
+                    return
+
+                yield response
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def create_session(self, pool_size: int) -> requests.Session:
+        session = requests.Session()
+
+        # All cookies are passed explicitly with each request, so don't let the
+        # shared session collect cookies from responses between the threads
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+
+        return session
+
+    def connection_stats(self) -> tuple[int, int]:
+        """
+        Returns the number of requests sent and the number of connections opened
+        """
+        requests_count = 0
+        connections_count = 0
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                connections_count += pool.num_connections
 
-                movies.append(movie)
+        return requests_count, connections_count
 
-        self.logger.info(f"Found {len(movies)} movies scored by {friend_name}!")
+    def log_stats(self) -> None:
+        requests_count, connections_count = self.connection_stats()
+        reused = (
+            (requests_count - connections_count) / requests_count * 100
+            if requests_count > 0
+            else 0.0
+        )
 
-        return movies
+        self.logger.info(
+            "Sent %s requests over %s connections (%.1f%% reused)",
+            requests_count,
+            connections_count,
+            reused,
+        )
+        for endpoint, rate in self.rate_limiter.effective_rates().items():
+            self.logger.info("Effective rate for %s is %.2f req/s", endpoint, rate)
+        if self.response_cache is not None:
+            self.response_cache.log_stats()
 
     def fetch_token(self) -> str:
         cookies = {"_artuser_prm": self.__secret__}
 
         try:
             url = "https://www.filmweb.pl/api/v1/jwt"
-            response = requests.post(url, cookies=cookies, timeout=10)
+            response = self.session.post(url, cookies=cookies, timeout=10)
             response.raise_for_status()
 
             self.logger.debug("Got the JWT token!")
@@ -238,37 +367,121 @@ class FilmwebAPI:
         except requests.exceptions.RequestException:
             raise FilmwebInvalidTokenError("Failed to fetch JWT token!")
 
-    def fetch(self, path: str, authenticate: bool = False):
+    def refresh_token(self, stale_token: str | None) -> None:
+        # Many requests may fail with the same stale token at once, only the
+        # first one of them should ask for a new one
+        with self.token_lock:
+            if self.__token__ != stale_token:
+                return
+
+            if self.token_cache is None:
+                token = self.fetch_token()
+                self.__token__, self.token_expires_at = token, decode_expiry(token)
+                return
+
+            with self.token_cache.lock():
+                # Another run may have already cached a new token
+                cached = self.token_cache.load_fresh(stale_token, self.refresh_margin)
+                if cached is None:
+                    token = self.fetch_token()
+                    self.token_cache.save(token)
+                    self.__token__, self.token_expires_at = token, decode_expiry(token)
+                else:
+                    self.logger.debug("Reusing the cached JWT token")
+                    self.__token__, self.token_expires_at = (
+                        cached.token,
+                        cached.expires_at,
+                    )
+
+    def refresh_token_in_background(self, stale_token: str | None) -> None:
+        with self.refresher_lock:
+            if self.token_refresher is not None and self.token_refresher.is_alive():
+                return
+
+            self.token_refresher = threading.Thread(
+                target=self.__refresh_token_quietly__,
+                args=(stale_token,),
+                name="filmweb-jwt",
+                daemon=True,
+            )
+            self.token_refresher.start()
+
+    def __refresh_token_quietly__(self, stale_token: str | None) -> None:
+        # The current token is still valid, and once it expires the requests
+        # refresh it themselves
+        try:
+            self.refresh_token(stale_token)
+        except FilmwebError as e:
+            self.logger.warning("Failed to refresh the JWT token: %s", e)
+
+    def current_token(self) -> str | None:
+        token, expires_at = self.__token__, self.token_expires_at
+        if expires_at is not None:
+            expires_in = expires_at - time.time()
+            if expires_in <= 0:
+                self.refresh_token(token)
+                return self.__token__
+            if expires_in <= self.refresh_margin:
+                self.refresh_token_in_background(token)
+
+        return token
+
+    def fetch(self, path: str, authenticate: bool = False, if_modified: bool = False):
+        """
+        Returns the JSON response, or NOT_MODIFIED if `if_modified` is set and
+        the cached response is still valid
+        """
         headers = {"X-Locale": "pl_PL"}
 
         url = f"https://www.filmweb.pl/api/v1{path}"
 
-        time.sleep(random.uniform(0.1, 0.35))  # TODO: remove, rethink
+        # Only the public responses are cached, the authenticated ones depend
+        # on the user
+        lookup = None
+        if self.response_cache is not None and authenticate is False:
+            lookup = self.response_cache.prepare(path, headers["X-Locale"], headers)
 
         retry = 0
-        while retry < 3:
+        delay = 0.0
+        while retry < self.max_retries:
             if retry > 0:
                 self.logger.warning(f"Attempt no. {retry} to fetch {url}")
-                time.sleep(1)
+                time.sleep(delay)
             retry += 1
+            delay = backoff_delay(retry)
 
+            token = self.__token__
             cookies = {}
             if authenticate is True:
-                cookies["JWT"] = self.__token__
+                token = self.current_token()
+                cookies["JWT"] = token
+
+            self.rate_limiter.acquire(url)
 
             response = None
             try:
-                response = requests.get(
+                response = self.session.get(
                     url, headers=headers, cookies=cookies, timeout=10
                 )
                 response.raise_for_status()
 
+                self.rate_limiter.on_success(url)
+
                 if response.status_code == 204:
                     return None
 
+                if lookup is not None:
+                    return self.response_cache.on_response(
+                        lookup,
+                        response.status_code,
+                        response.headers,
+                        response.content,
+                        if_modified,
+                    )
+
                 return response.json()
             except requests.exceptions.Timeout as e:
-                if retry == 3:
+                if retry == self.max_retries:
                     self.logger.error(
                         f"All {retry} attempts to fetch {url} have failed!",
                         e,
@@ -277,7 +490,18 @@ class FilmwebAPI:
                 continue
             except requests.exceptions.RequestException as e:
                 if response is not None and response.status_code == 400:
-                    self.__token__ = self.fetch_token()
+                    self.refresh_token(token)
+                    delay = 0.0
+                    continue
+                elif response is not None and response.status_code in THROTTLED:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    self.rate_limiter.on_throttle(url, retry_after)
+                    self.logger.warning(
+                        "Throttled with %s while fetching %s, slowing down to %.2f req/s",
+                        response.status_code,
+                        url,
+                        self.rate_limiter.effective_rate(url),
+                    )
                     continue
                 else:
                     raise FilmwebError(
@@ -285,11 +509,3 @@ class FilmwebAPI:
                     ) from e
 
         raise FilmwebError(f"Failed to fetch data after {retry} retries!")
-
-
-class FilmwebError(Exception):
-    pass
-
-
-class FilmwebInvalidTokenError(FilmwebError):
-    pass
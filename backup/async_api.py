@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import suppress
+from typing import AsyncIterator
+
+import aiohttp
+
+from .api import (
+    THROTTLED,
+    FilmwebError,
+    FilmwebInvalidTokenError,
+    parse_movie_details,
+    parse_movie_rating,
+    parse_user_details,
+    parse_user_friends,
+    parse_user_friends_similarities,
+    parse_user_ratings,
+)
+from .cache import NOT_MODIFIED, ResponseCache
+from .data import (
+    Movie,
+    MovieNotModified,
+    MovieRating,
+    UserDetails,
+    UserRating,
+    UserSimilarity,
+)
+from .ratelimit import RateLimiter, backoff_delay, parse_retry_after
+from .token import TokenCache, decode_expiry
+
+
+class AsyncFilmwebAPI:
+    """
+    asyncio counterpart of the FilmwebAPI, returning the same dataclasses.
+
+    The session and the JWT token are acquired when entering the context
+    manager, and at most `concurrency` requests are in flight at any time.
+    """
+
+    def __init__(
+        self,
+        secret: str,
+        concurrency: int = 100,
+        rate_limiter: RateLimiter | None = None,
+        max_retries: int = 5,
+        token_cache: TokenCache | None = None,
+        refresh_margin: float = 60.0,
+        response_cache: ResponseCache | None = None,
+    ):
+        self.logger = logging.getLogger("filmweb.api")
+
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self.response_cache = response_cache
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session: aiohttp.ClientSession | None = None
+
+        # The token is refreshed in the background once it's about to expire,
+        # by a single task, while the others keep using the current one
+        self.token_cache = token_cache
+        self.refresh_margin = refresh_margin
+        self.token_lock = asyncio.Lock()
+        self.token_refresher: asyncio.Task | None = None
+
+        self.__secret__ = secret
+        self.__token__: str | None = None
+        self.token_expires_at: float | None = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self) -> None:
+        self.session = self.create_session(self.concurrency)
+        await self.refresh_token(None)
+
+    async def close(self) -> None:
+        if self.token_refresher is not None and not self.token_refresher.done():
+            self.token_refresher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.token_refresher
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch_movie_details(self, movie_id: int) -> Movie:
+        movie_details = await self.fetch(f"/film/{movie_id}/preview")
+
+        self.logger.debug("Got movie details for movie id %s", movie_id)
+
+        return parse_movie_details(movie_id, movie_details)
+
+    async def fetch_movie_details_if_modified(
+        self, movie_id: int
+    ) -> Movie | MovieNotModified:
+        movie_details = await self.fetch(f"/film/{movie_id}/preview", if_modified=True)
+        if movie_details is NOT_MODIFIED:
+            self.logger.debug("Movie details for movie id %s haven't changed", movie_id)
+            return MovieNotModified(movie_id)
+
+        self.logger.debug("Got movie details for movie id %s", movie_id)
+
+        return parse_movie_details(movie_id, movie_details)
+
+    async def fetch_movie_rating(self, movie_id: int) -> MovieRating:
+        movie_rating = await self.fetch(f"/film/{movie_id}/rating")
+
+        self.logger.debug("Got rating details for movie id %s", movie_id)
+
+        return parse_movie_rating(movie_id, movie_rating)
+
+    async def fetch_user_ratings(self) -> list[UserRating]:
+        movies: list[UserRating] = []
+        async for ratings in self.iter_user_ratings():
+            movies.extend(ratings)
+
+        return movies
+
+    async def iter_user_ratings(
+        self, prefetch: int = 1
+    ) -> AsyncIterator[list[UserRating]]:
+        count = 0
+        async for response in self.iter_pages("/logged/vote/title/film", prefetch):
+            ratings = parse_user_ratings(response)
+            count += len(ratings)
+
+            yield ratings
+
+        self.logger.info("Found %s scored movies!", count)
+
+    async def fetch_user_details(self) -> UserDetails:
+        response = await self.fetch("/logged/info", True)
+
+        user_details = parse_user_details(response)
+
+        self.logger.debug("Got user details for user %s", user_details.name)
+
+        return user_details
+
+    async def fetch_user_friends(self) -> list[UserDetails]:
+        response = await self.fetch("/logged/friends", True)
+
+        friends_details = parse_user_friends(response)
+
+        self.logger.info("Found %s friends!", len(friends_details))
+
+        return friends_details
+
+    async def fetch_user_friends_similarities(self) -> list[UserSimilarity]:
+        response = await self.fetch("/logged/friends/similarities", True)
+
+        friends_similarities = parse_user_friends_similarities(response)
+
+        self.logger.info(
+            f"Found {len(friends_similarities)} friends with similar taste!"
+        )
+
+        return friends_similarities
+
+    async def fetch_friend_ratings(self, friend_name: str) -> list[UserRating]:
+        movies: list[UserRating] = []
+        async for ratings in self.iter_friend_ratings(friend_name):
+            movies.extend(ratings)
+
+        return movies
+
+    async def iter_friend_ratings(
+        self, friend_name: str, prefetch: int = 1
+    ) -> AsyncIterator[list[UserRating]]:
+        count = 0
+        async for response in self.iter_pages(
+            f"/logged/friend/{friend_name}/vote/title/film", prefetch
+        ):
+            ratings = parse_user_ratings(response)
+            count += len(ratings)
+
+            yield ratings
+
+        self.logger.info(f"Found {count} movies scored by {friend_name}!")
+
+    async def iter_pages(self, path: str, prefetch: int = 1) -> AsyncIterator[list]:
+        """
+        Yields consecutive pages of a paginated endpoint until the first empty
+        one, keeping up to `prefetch` pages requested ahead of the consumer
+        """
+        pending: deque[asyncio.Task] = deque()
+        page = 1
+        try:
+            while True:
+                # Speculatively request the next pages, the ones after the
+                # last page are empty and simply thrown away
+                while len(pending) < max(1, prefetch):
+                    pending.append(
+                        asyncio.create_task(self.fetch(f"{path}?page={page}", True))
+                    )
+                    page = page + 1
+
+                response = await pending.popleft()
+                if type(response) != list or len(response) == 0:
+                    return
+
+                yield response
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def log_stats(self) -> None:
+        for endpoint, rate in self.rate_limiter.effective_rates().items():
+            self.logger.info("Effective rate for %s is %.2f req/s", endpoint, rate)
+        if self.response_cache is not None:
+            self.response_cache.log_stats()
+
+    def create_session(self, concurrency: int) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+
+        # All cookies are passed explicitly with each request
+        return aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+
+    async def fetch_token(self) -> str:
+        cookies = {"_artuser_prm": self.__secret__}
+
+        try:
+            url = "https://www.filmweb.pl/api/v1/jwt"
+            async with self.session.post(url, cookies=cookies) as response:
+                response.raise_for_status()
+
+                self.logger.debug("Got the JWT token!")
+
+                jwt = response.cookies.get("JWT")
+                return jwt.value if jwt is not None else None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise FilmwebInvalidTokenError("Failed to fetch JWT token!")
+
+    async def refresh_token(self, stale_token: str | None) -> None:
+        # Many requests may fail with the same stale token at once, only the
+        # first one of them should ask for a new one
+        async with self.token_lock:
+            if self.__token__ != stale_token:
+                return
+
+            if self.token_cache is None:
+                token = await self.fetch_token()
+                self.__token__, self.token_expires_at = token, decode_expiry(token)
+                return
+
+            async with self.token_cache.lock_async():
+                # Another run may have already cached a new token
+                cached = self.token_cache.load_fresh(stale_token, self.refresh_margin)
+                if cached is None:
+                    token = await self.fetch_token()
+                    self.token_cache.save(token)
+                    self.__token__, self.token_expires_at = token, decode_expiry(token)
+                else:
+                    self.logger.debug("Reusing the cached JWT token")
+                    self.__token__, self.token_expires_at = (
+                        cached.token,
+                        cached.expires_at,
+                    )
+
+    def refresh_token_in_background(self, stale_token: str | None) -> None:
+        if self.token_refresher is not None and not self.token_refresher.done():
+            return
+
+        self.token_refresher = asyncio.create_task(
+            self.__refresh_token_quietly__(stale_token)
+        )
+
+    async def __refresh_token_quietly__(self, stale_token: str | None) -> None:
+        # The current token is still valid, and once it expires the requests
+        # refresh it themselves
+        try:
+            await self.refresh_token(stale_token)
+        except FilmwebError as e:
+            self.logger.warning("Failed to refresh the JWT token: %s", e)
+
+    async def current_token(self) -> str | None:
+        token, expires_at = self.__token__, self.token_expires_at
+        if expires_at is not None:
+            expires_in = expires_at - time.time()
+            if expires_in <= 0:
+                await self.refresh_token(token)
+                return self.__token__
+            if expires_in <= self.refresh_margin:
+                self.refresh_token_in_background(token)
+
+        return token
+
+    async def fetch(
+        self, path: str, authenticate: bool = False, if_modified: bool = False
+    ):
+        headers = {"X-Locale": "pl_PL"}
+
+        url = f"https://www.filmweb.pl/api/v1{path}"
+
+        # Only the public responses are cached, the authenticated ones depend
+        # on the user. The cache blocks on SQLite and zlib, so it runs in a
+        # thread instead of the event loop
+        lookup = None
+        if self.response_cache is not None and authenticate is False:
+            lookup = await asyncio.to_thread(
+                self.response_cache.prepare, path, headers["X-Locale"], headers
+            )
+
+        retry = 0
+        delay = 0.0
+        while retry < self.max_retries:
+            if retry > 0:
+                self.logger.warning(f"Attempt no. {retry} to fetch {url}")
+                await asyncio.sleep(delay)
+            retry += 1
+            delay = backoff_delay(retry)
+
+            token = self.__token__
+            cookies = {}
+            if authenticate is True:
+                token = await self.current_token()
+                cookies["JWT"] = token
+
+            await self.rate_limiter.acquire_async(url)
+
+            try:
+                async with self.semaphore:
+                    async with self.session.get(
+                        url, headers=headers, cookies=cookies
+                    ) as response:
+                        response.raise_for_status()
+
+                        self.rate_limiter.on_success(url)
+
+                        if response.status == 204:
+                            return None
+
+                        if lookup is not None:
+                            return await asyncio.to_thread(
+                                self.response_cache.on_response,
+                                lookup,
+                                response.status,
+                                response.headers,
+                                await response.read(),
+                                if_modified,
+                            )
+
+                        return await response.json(content_type=None)
+            except asyncio.TimeoutError as e:
+                if retry == self.max_retries:
+                    self.logger.error(
+                        f"All {retry} attempts to fetch {url} have failed!",
+                        e,
+                        exc_info=True,
+                    )
+                continue
+            except aiohttp.ClientResponseError as e:
+                if e.status == 400:
+                    await self.refresh_token(token)
+                    delay = 0.0
+                    continue
+                elif e.status in THROTTLED:
+                    retry_after = parse_retry_after(
+                        e.headers.get("Retry-After") if e.headers else None
+                    )
+                    self.rate_limiter.on_throttle(url, retry_after)
+                    self.logger.warning(
+                        "Throttled with %s while fetching %s, slowing down to %.2f req/s",
+                        e.status,
+                        url,
+                        self.rate_limiter.effective_rate(url),
+                    )
+                    continue
+                else:
+                    raise FilmwebError(
+                        f"Failed to fetch data due to unhandled exception"
+                    ) from e
+            except aiohttp.ClientError as e:
+                raise FilmwebError(
+                    f"Failed to fetch data due to unhandled exception"
+                ) from e
+
+        raise FilmwebError(f"Failed to fetch data after {retry} retries!")
@@ -1,25 +1,129 @@
-import csv
+import asyncio
 import logging
+import multiprocessing
 import re
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import aclosing, closing
+from itertools import groupby
+from operator import itemgetter
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator
 
 from .api import FilmwebAPI
-from .data import UserDetails
-from .db import FilmwebDB
+from .async_api import AsyncFilmwebAPI
+from .cache import ResponseCache
+from .data import (
+    Movie,
+    MovieNotModified,
+    MovieRating,
+    UserDetails,
+    UserRating,
+)
+from .db import FilmwebDB, MovieRatingDetails, RatingChanges
+from .export import EXPORT_FORMATS, ExportManifest, HashingWriter, atomic_write
+from .ratelimit import RateLimiter
+from .token import TokenCache
 
 
 class FilmwebBackup:
-    def __init__(self, db: FilmwebDB, api: FilmwebAPI):
+    def __init__(
+        self,
+        db: FilmwebDB,
+        api: FilmwebAPI | AsyncFilmwebAPI | None,
+        jobs: int = 1,
+        prefetch: int = 4,
+        incremental: bool = False,
+        full_sync_ttl: int = 604800,
+        batch_size: int = 100,
+        flush_interval: float = 5.0,
+        export_format: str = "csv",
+    ):
         self.logger = logging.getLogger("filmweb.backup")
 
         self.db = db
         self.api = api
+        self.jobs = jobs
+        self.prefetch = prefetch
+        self.incremental = incremental
+        self.full_sync_ttl = full_sync_ttl
+
+        # The same movie is often rated by the user and many of the friends,
+        # but it's enough to back it up once per run
+        self.visited_movies: set[int] = set()
+        self.duplicate_visits = 0
+
+        # Fetched movies are written in batches, each in a single transaction,
+        # once there are enough of them or they have been waiting for too long
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.movies_batch: list[Movie] = []
+        self.movie_ratings_batch: list[MovieRating] = []
+        self.touched_movies_batch: list[int] = []
+        self.flushed_at = time.monotonic()
+
+        self.export_format = export_format
 
     @classmethod
-    def from_secret(cls, secret: str):
-        db = FilmwebDB()
-        api = FilmwebAPI(secret)
+    def from_secret(
+        cls,
+        secret: str,
+        pool_size: int = 10,
+        jobs: int = 1,
+        use_async: bool = False,
+        concurrency: int = 100,
+        rate: float = 5.0,
+        burst: int = 5,
+        prefetch: int = 4,
+        incremental: bool = False,
+        batch_size: int = 100,
+        db_profile: str = "safe",
+        export_format: str = "csv",
+        token_cache: str | None = ".filmweb-jwt.json",
+        response_cache: str | None = ".filmweb-cache.db",
+        response_cache_size: int = 256 * 1024 * 1024,
+    ):
+        db = FilmwebDB(profile=db_profile)
+        rate_limiter = RateLimiter(rate, burst)
+        tokens = TokenCache(secret, token_cache) if token_cache is not None else None
+        responses = (
+            ResponseCache(response_cache, response_cache_size)
+            if response_cache is not None
+            else None
+        )
+        if use_async is True:
+            api = AsyncFilmwebAPI(
+                secret,
+                concurrency,
+                rate_limiter,
+                token_cache=tokens,
+                response_cache=responses,
+            )
+        else:
+            # The movie workers and the threads prefetching the pages of ratings
+            # all send their requests at the same time
+            api = FilmwebAPI(
+                secret,
+                max(pool_size, jobs + prefetch),
+                rate_limiter,
+                token_cache=tokens,
+                response_cache=responses,
+            )
 
-        return cls(db, api)
+        return cls(
+            db,
+            api,
+            jobs,
+            prefetch,
+            incremental,
+            batch_size=batch_size,
+            export_format=export_format,
+        )
 
     @classmethod
     def from_db_api(cls, db: FilmwebDB, api: FilmwebAPI):
@@ -38,33 +142,110 @@ class FilmwebBackup:
         else:
             self.logger.debug("Movie rating for movie %s are up-to-date", movie_id)
 
+    def backup_movies(self, movie_ids: list[int]) -> None:
+        work = self.__plan_movies__(self.__unvisited_movies__(movie_ids))
+
+        if self.jobs <= 1:
+            for fetch, store, movie_id in work:
+                store(fetch(movie_id))
+            return
+
+        # Workers only talk to the API, all the results are written to the DB
+        # from the calling thread, so the SQLite connection is never shared
+        pending: dict[Future, Callable] = {}
+        executor = ThreadPoolExecutor(
+            max_workers=self.jobs, thread_name_prefix="filmweb-fetch"
+        )
+        try:
+            for fetch, store, movie_id in work:
+                pending[executor.submit(fetch, movie_id)] = store
+
+                # Keep a bounded number of requests queued up for the workers
+                if len(pending) >= self.jobs * 2:
+                    self.__store_completed__(pending)
+
+            while len(pending) > 0:
+                self.__store_completed__(pending)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def store_movie(self, movie: Movie | MovieNotModified) -> None:
+        if isinstance(movie, MovieNotModified):
+            self.touched_movies_batch.append(movie.id)
+        else:
+            self.movies_batch.append(movie)
+        self.__flush_if_due__()
+
+    def store_movie_rating(self, movie_rating: MovieRating) -> None:
+        self.movie_ratings_batch.append(movie_rating)
+        self.__flush_if_due__()
+
+    def flush(self) -> None:
+        movies, self.movies_batch = self.movies_batch, []
+        movie_ratings, self.movie_ratings_batch = self.movie_ratings_batch, []
+        touched_movies, self.touched_movies_batch = self.touched_movies_batch, []
+        self.flushed_at = time.monotonic()
+
+        self.db.upsert_movies(movies)
+        self.db.upsert_movie_ratings(movie_ratings)
+        self.db.touch_movies(touched_movies)
+
+    def backup_ratings(
+        self,
+        user_id: int,
+        pages: Iterator[list[UserRating]],
+        full_sync: bool | None = None,
+    ) -> None:
+        if full_sync is None:
+            full_sync = self.__is_full_sync__(user_id)
+        stored = self.db.get_stored_ratings(user_id)
+
+        movie_ids: set[int] = set()
+        changes = RatingChanges(0, 0, 0)
+        with closing(pages):
+            for ratings in pages:
+                changed = self.__changed_ratings__(stored, ratings)
+                changes += self.db.upsert_ratings_batch(user_id, changed)
+
+                self.backup_movies(list(rating.movie_id for rating in ratings))
+
+                movie_ids.update(rating.movie_id for rating in ratings)
+
+                # Votes are listed from the most recent ones, so once a whole
+                # page is already stored, so are all the following pages
+                if full_sync is False and len(changed) == 0:
+                    break
+
+        if full_sync is True:
+            changes += self.__reconcile_ratings__(user_id, movie_ids)
+        else:
+            # Movies from the skipped pages still have to be kept up-to-date
+            self.backup_movies(list(stored.keys() - movie_ids))
+
+        self.__log_rating_changes__(user_id, changes)
+
     def backup_user(self, user: UserDetails) -> None:
-        if (
-            self.db.should_update_user(user.id, 60) is False
-        ):  # TODO: change or remove TTL
-            self.logger.debug("User %s details are up-to-date", user.name)
+        if self.__is_user_up_to_date__(user):
             return None
 
-        ratings = self.api.fetch_user_ratings()
-        self.db.upsert_ratings(user.id, ratings)
-
-        for rating in ratings:
-            self.backup_movie(rating.movie_id)
+        full_sync = self.__is_full_sync__(user.id)
+        self.backup_ratings(
+            user.id,
+            self.api.iter_user_ratings(self.__prefetch__(full_sync)),
+            full_sync,
+        )
 
         friends = self.api.fetch_user_friends()
         if len(friends) > 0:
-            for friend in friends:
-                if (
-                    self.db.should_update_user(friend.id) is False
-                ):  # TODO: change or remove TTL
-                    self.logger.debug("Friend %s details are up-to-date", friend.name)
-                    continue
-
-                friend_ratings = self.api.fetch_friend_ratings(friend.name)
-                self.db.upsert_ratings(friend.id, friend_ratings)
-
-                for rating in friend_ratings:
-                    self.backup_movie(rating.movie_id)
+            for friend in self.__stale_friends__(friends):
+                full_sync = self.__is_full_sync__(friend.id)
+                self.backup_ratings(
+                    friend.id,
+                    self.api.iter_friend_ratings(
+                        friend.name, self.__prefetch__(full_sync)
+                    ),
+                    full_sync,
+                )
 
                 self.db.upsert_user_details(friend)
 
@@ -76,71 +257,435 @@ class FilmwebBackup:
     def backup(self) -> UserDetails:
         user_details = self.api.fetch_user_details()
 
-        self.backup_user(user_details)
+        try:
+            self.backup_user(user_details)
+        finally:
+            self.flush()
+
+        self.api.log_stats()
+        self.log_stats()
 
         return user_details
 
-    def export(self, user_details: UserDetails) -> None:
-        ratings_export = self.db.get_user_rating(user_details.id)
+    async def backup_movies_async(self, movie_ids: list[int]) -> None:
+        work = self.__plan_movies__(self.__unvisited_movies__(movie_ids))
 
-        safe_user_name = self.__get_valid_filename__(user_details.name)
-        with open(f"export/filmweb-{safe_user_name}.csv", "w", newline="") as csv_file:
-            export_file = csv.writer(
-                csv_file, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
-            )
-            export_file.writerow(
-                [
-                    "original_title",
-                    "international_title",
-                    "title",
-                    "year",
-                    "rate",
-                    "my_rate",
-                    "favorite",
-                    "view_date",
-                    "duration",
-                    "genres",
-                    "directors",
-                    "cast",
-                    "countries",
-                ]
-            )
-            export_file.writerows(
-                list(
-                    [
-                        re.original_title,
-                        re.international_title,
-                        re.title,
-                        re.year,
-                        re.rate,
-                        re.my_rate,
-                        re.favorite,
-                        re.view_date,
-                        re.duration,
-                        re.genres,
-                        re.directors,
-                        re.cast,
-                        re.countries,
-                    ]
-                    for re in ratings_export
+        # Coroutines only wait for the API, the results are written to the DB
+        # from the event loop thread one at a time
+        async with asyncio.TaskGroup() as tasks:
+            for fetch, store, movie_id in work:
+                tasks.create_task(self.__store_async__(fetch(movie_id), store))
+
+    async def backup_ratings_async(
+        self,
+        user_id: int,
+        pages: AsyncIterator[list[UserRating]],
+        full_sync: bool | None = None,
+    ) -> None:
+        if full_sync is None:
+            full_sync = self.__is_full_sync__(user_id)
+        stored = self.db.get_stored_ratings(user_id)
+
+        movie_ids: set[int] = set()
+        changes = RatingChanges(0, 0, 0)
+        async with aclosing(pages):
+            async for ratings in pages:
+                changed = self.__changed_ratings__(stored, ratings)
+                changes += self.db.upsert_ratings_batch(user_id, changed)
+
+                await self.backup_movies_async(
+                    list(rating.movie_id for rating in ratings)
                 )
+
+                movie_ids.update(rating.movie_id for rating in ratings)
+
+                # Votes are listed from the most recent ones, so once a whole
+                # page is already stored, so are all the following pages
+                if full_sync is False and len(changed) == 0:
+                    break
+
+        if full_sync is True:
+            changes += self.__reconcile_ratings__(user_id, movie_ids)
+        else:
+            # Movies from the skipped pages still have to be kept up-to-date
+            await self.backup_movies_async(list(stored.keys() - movie_ids))
+
+        self.__log_rating_changes__(user_id, changes)
+
+    async def backup_friend_async(self, friend: UserDetails) -> None:
+        full_sync = self.__is_full_sync__(friend.id)
+        await self.backup_ratings_async(
+            friend.id,
+            self.api.iter_friend_ratings(friend.name, self.__prefetch__(full_sync)),
+            full_sync,
+        )
+
+        self.db.upsert_user_details(friend)
+
+    async def backup_user_async(self, user: UserDetails) -> None:
+        if self.__is_user_up_to_date__(user):
+            return None
+
+        full_sync = self.__is_full_sync__(user.id)
+        await self.backup_ratings_async(
+            user.id,
+            self.api.iter_user_ratings(self.__prefetch__(full_sync)),
+            full_sync,
+        )
+
+        friends = await self.api.fetch_user_friends()
+        if len(friends) > 0:
+            async with asyncio.TaskGroup() as tasks:
+                for friend in self.__stale_friends__(friends):
+                    tasks.create_task(self.backup_friend_async(friend))
+
+            similar_users = await self.api.fetch_user_friends_similarities()
+            self.db.upsert_similar_users(user.id, similar_users)
+
+        self.db.upsert_user_details(user)
+
+    async def backup_async(self) -> UserDetails:
+        async with self.api:
+            user_details = await self.api.fetch_user_details()
+
+            try:
+                await self.backup_user_async(user_details)
+            finally:
+                self.flush()
+
+            self.api.log_stats()
+            self.log_stats()
+
+        return user_details
+
+    def close(self) -> None:
+        """
+        Closes the database and the on-disk cache of the API responses
+        """
+        response_cache = getattr(self.api, "response_cache", None)
+        if response_cache is not None:
+            response_cache.close()
+
+        self.db.con.close()
+
+    def log_stats(self) -> None:
+        self.logger.info(
+            "Backed up %s movies, avoided %s duplicate visits",
+            len(self.visited_movies),
+            self.duplicate_visits,
+        )
+        self.logger.info(
+            "Skipped %s known genres, directors, cast and countries, inserted %s new",
+            self.db.dimension_hits,
+            self.db.dimension_misses,
+        )
+
+    def export(self, user_details: UserDetails, force: bool = False) -> None:
+        manifest = ExportManifest()
+        file_name = self.__export_file_name__(user_details)
+        _, fingerprint = self.db.get_export_fingerprints([user_details.id]).get(
+            user_details.id, (0, None)
+        )
+
+        if force is False and manifest.is_current(
+            user_details.id, file_name, fingerprint
+        ):
+            self.logger.info(f"Export for user {user_details.name} is up-to-date")
+            return
+
+        exported, digest = self.__write_export__(
+            file_name, self.db.iter_user_rating(user_details.id)
+        )
+
+        manifest.update(user_details.id, file_name, fingerprint, digest)
+        manifest.save()
+
+        self.logger.info(
+            f"Exported information about {exported} movies for user {user_details.name}"
+        )
+
+    def export_all(self, force: bool = False, processes: int = 1) -> None:
+        started_at = time.perf_counter()
+        users = dict((user.id, user) for user in self.db.get_all_users())
+
+        # Only the users with a rating or a rated movie changed since their
+        # last export are exported again
+        manifest = ExportManifest()
+        export_state = self.db.get_export_fingerprints()
+        ratings_counts = dict(
+            (user_id, count) for user_id, (count, _) in export_state.items()
+        )
+        fingerprints = dict(
+            (user_id, fingerprint) for user_id, (_, fingerprint) in export_state.items()
+        )
+        stale_users = dict(
+            (user_id, user_details)
+            for user_id, user_details in users.items()
+            if force is True
+            or not manifest.is_current(
+                user_id,
+                self.__export_file_name__(user_details),
+                fingerprints.get(user_id),
+            )
+        )
+
+        if processes > 1 and len(stale_users) > 1:
+            exported, busy_time = self.__export_users_in_processes__(
+                stale_users, ratings_counts, processes
             )
+        else:
+            exported = self.__export_users__(stale_users)
+            busy_time = time.perf_counter() - started_at
+
+        for user_id, (file_name, _, digest) in exported.items():
+            manifest.update(user_id, file_name, fingerprints.get(user_id), digest)
+        manifest.save()
 
         self.logger.info(
-            f"Exported information about {len(ratings_export)} movies for user {user_details.name}"
+            f"Exported information about {sum(rows for _, rows, _ in exported.values())} movies for all {len(users)} users completed in {time.perf_counter() - started_at:.2f}s ({busy_time:.2f}s in {max(processes, 1)} processes), {len(users) - len(stale_users)} were up-to-date!"
+        )
+
+    def __export_users__(
+        self, users: dict[int, UserDetails]
+    ) -> dict[int, tuple[str, int, str]]:
+        """
+        Writes the export files of `users`, returning the file name, the number
+        of the exported ratings, and the content hash for each of them
+        """
+        exported: dict[int, tuple[str, int, str]] = {}
+
+        # All the ratings are read in a single pass ordered by the user, and
+        # each user's run of them goes to the user's own file
+        if len(users) > 0:
+            ratings = self.db.iter_all_user_ratings(list(users.keys()))
+            for user_id, user_ratings in groupby(ratings, key=itemgetter(0)):
+                user_details = users.get(user_id)
+                if user_details is None:
+                    continue
+
+                file_name = self.__export_file_name__(user_details)
+                rows, digest = self.__write_export__(
+                    file_name, (rating for _, rating in user_ratings)
+                )
+                exported[user_id] = (file_name, rows, digest)
+
+                self.logger.info(
+                    f"Exported information about {rows} movies for user {user_details.name}"
+                )
+
+        for user_id, user_details in users.items():
+            if user_id not in exported:
+                file_name = self.__export_file_name__(user_details)
+                _, digest = self.__write_export__(file_name, [])
+                exported[user_id] = (file_name, 0, digest)
+
+        return exported
+
+    def __export_users_in_processes__(
+        self,
+        users: dict[int, UserDetails],
+        ratings_counts: dict[int, int],
+        processes: int,
+    ) -> tuple[dict[int, tuple[str, int, str]], float]:
+        # The users are spread over the workers by their number of ratings, so
+        # the workers finish together
+        sizes = dict((user_id, ratings_counts.get(user_id, 0)) for user_id in users)
+        partitions: list[dict[int, UserDetails]] = [{} for _ in range(processes)]
+        loads = [0] * processes
+        for user_id in sorted(users, key=lambda user_id: sizes[user_id], reverse=True):
+            worker = loads.index(min(loads))
+            partitions[worker][user_id] = users[user_id]
+            loads[worker] += max(sizes[user_id], 1)
+
+        exported: dict[int, tuple[str, int, str]] = {}
+        busy_time = 0.0
+        # Forking a process with live threads, like the ones of the connection
+        # pool, may deadlock the workers, so they start from a fresh interpreter
+        with ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(
+                    export_users_worker, self.db.name, self.export_format, partition
+                )
+                for partition in partitions
+                if len(partition) > 0
+            ]
+            for future in futures:
+                worker_exported, worker_time = future.result()
+                exported.update(worker_exported)
+                busy_time += worker_time
+
+                # The spawned workers have no logging configured
+                for user_id, (_, rows, _) in worker_exported.items():
+                    self.logger.info(
+                        f"Exported information about {rows} movies for user {users[user_id].name}"
+                    )
+
+        return exported, busy_time
+
+    def __write_export__(
+        self, file_name: str, ratings: Iterable[MovieRatingDetails]
+    ) -> tuple[int, str]:
+        with atomic_write(file_name, "wb") as export_file:
+            hashing_file = HashingWriter(export_file)
+            exporter = EXPORT_FORMATS[self.export_format](hashing_file)
+            exported = exporter.write_rows(ratings)
+            exporter.close()
+
+        return exported, hashing_file.hexdigest()
+
+    def __export_file_name__(self, user_details: UserDetails) -> str:
+        safe_user_name = self.__get_valid_filename__(user_details.name)
+        extension = EXPORT_FORMATS[self.export_format].extension
+        return f"export/filmweb-{safe_user_name}.{extension}"
+
+    def __is_full_sync__(self, user_id: int) -> bool:
+        if self.incremental is False:
+            return True
+
+        return self.db.should_full_sync_ratings(user_id, self.full_sync_ttl)
+
+    def __prefetch__(self, full_sync: bool) -> int:
+        # An incremental sync usually stops after its first page, so the pages
+        # requested ahead of it would mostly be thrown away
+        return self.prefetch if full_sync is True else 1
+
+    def __changed_ratings__(
+        self, stored: dict[int, UserRating], ratings: list[UserRating]
+    ) -> list[UserRating]:
+        return list(
+            rating for rating in ratings if stored.get(rating.movie_id) != rating
         )
 
-    def export_all(self) -> None:
-        users = self.db.get_all_users()
+    def __reconcile_ratings__(self, user_id: int, movie_ids: set[int]) -> RatingChanges:
+        # Votes removed on Filmweb are no longer on any of the pages
+        changes = RatingChanges(0, 0, 0)
+        if len(movie_ids) > 0:
+            changes = self.db.remove_ratings_except(user_id, movie_ids)
 
-        for user_details in users:
-            self.export(user_details)
+        self.db.mark_full_sync_ratings(user_id)
 
+        return changes
+
+    def __log_rating_changes__(self, user_id: int, changes: RatingChanges) -> None:
         self.logger.info(
-            f"Exported information about movies for all {len(users)} users completed!"
+            "Ratings of user id %s: %s inserted, %s updated, %s removed",
+            user_id,
+            changes.inserted,
+            changes.updated,
+            changes.removed,
+        )
+
+    def __plan_movies__(
+        self, movie_ids: list[int]
+    ) -> list[tuple[Callable, Callable, int]]:
+        if len(movie_ids) == 0:
+            return []
+
+        # Check the whole batch with a single query per table, instead of two
+        # queries for every single movie
+        stale_movies = self.db.should_update_movies(movie_ids)
+        stale_movie_ratings = self.db.should_update_movie_ratings(movie_ids)
+
+        # Stored movies are only rewritten if they have changed since they
+        # were last fetched
+        stored_movies = (
+            self.db.get_stored_movies(stale_movies) if len(stale_movies) > 0 else set()
+        )
+
+        work: list[tuple[Callable, Callable, int]] = []
+        for movie_id in movie_ids:
+            if movie_id in stale_movies:
+                fetch_movie = (
+                    self.api.fetch_movie_details_if_modified
+                    if movie_id in stored_movies
+                    else self.api.fetch_movie_details
+                )
+                work.append((fetch_movie, self.store_movie, movie_id))
+            else:
+                self.logger.debug("Movie %s details are up-to-date", movie_id)
+
+            if movie_id in stale_movie_ratings:
+                work.append(
+                    (self.api.fetch_movie_rating, self.store_movie_rating, movie_id)
+                )
+            else:
+                self.logger.debug("Movie rating for movie %s are up-to-date", movie_id)
+
+        return work
+
+    def __is_user_up_to_date__(self, user: UserDetails) -> bool:
+        if (
+            self.db.should_update_user(user.id, 60) is False
+        ):  # TODO: change or remove TTL
+            self.logger.debug("User %s details are up-to-date", user.name)
+            return True
+
+        return False
+
+    def __stale_friends__(self, friends: list[UserDetails]) -> list[UserDetails]:
+        # TODO: change or remove TTL
+        stale_users = self.db.should_update_users(list(friend.id for friend in friends))
+
+        stale_friends: list[UserDetails] = []
+        for friend in friends:
+            if friend.id in stale_users:
+                stale_friends.append(friend)
+            else:
+                self.logger.debug("Friend %s details are up-to-date", friend.name)
+
+        return stale_friends
+
+    def __flush_if_due__(self) -> None:
+        pending = (
+            len(self.movies_batch)
+            + len(self.movie_ratings_batch)
+            + len(self.touched_movies_batch)
         )
+        if (
+            pending >= self.batch_size
+            or time.monotonic() - self.flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def __unvisited_movies__(self, movie_ids: list[int]) -> list[int]:
+        unvisited: list[int] = []
+        for movie_id in movie_ids:
+            if movie_id in self.visited_movies:
+                self.duplicate_visits += 1
+                continue
+
+            self.visited_movies.add(movie_id)
+            unvisited.append(movie_id)
+
+        return unvisited
+
+    def __store_completed__(self, pending: dict[Future, Callable]) -> None:
+        done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            store = pending.pop(future)
+            store(future.result())
+
+    async def __store_async__(self, fetch: Awaitable, store: Callable) -> None:
+        store(await fetch)
 
     def __get_valid_filename__(self, name: str) -> str:
         s = str(name).strip().replace(" ", "_")
         s = re.sub(r"(?u)[^-\w.]", "", s)
         return s
+
+
+def export_users_worker(
+    db_name: str, export_format: str, users: dict[int, UserDetails]
+) -> tuple[dict[int, tuple[str, int, str]], float]:
+    """
+    Exports `users` in a worker process, using its own read-only connection
+    """
+    started_at = time.perf_counter()
+    db = FilmwebDB(db_name, read_only=True)
+    try:
+        backup = FilmwebBackup(db, None, export_format=export_format)
+        return backup.__export_users__(users), time.perf_counter() - started_at
+    finally:
+        db.con.close()
@@ -0,0 +1,222 @@
+"""
+On-disk cache of the API responses, revalidated with conditional requests
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Mapping
+
+from .errors import FilmwebError
+
+# Returned by the conditional fetches for the responses that haven't changed
+NOT_MODIFIED = object()
+
+
+@dataclass
+class CachedResponse:
+    etag: str | None
+    last_modified: str | None
+    body: bytes
+
+    def validators(self) -> dict[str, str]:
+        """
+        Returns the headers asking the server to respond with 304 if the
+        response hasn't changed
+        """
+        headers: dict[str, str] = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+@dataclass
+class CacheLookup:
+    key: str
+    cached: CachedResponse | None
+
+
+class ResponseCache:
+    """
+    Keeps the compressed bodies of the responses with their `ETag` and
+    `Last-Modified` validators, keyed by the hash of the path and the locale.
+
+    Once the compressed bodies take more than `max_size` bytes, the least
+    recently used ones are evicted.
+    """
+
+    def __init__(
+        self, name: str = ".filmweb-cache.db", max_size: int = 256 * 1024 * 1024
+    ):
+        self.logger = logging.getLogger("filmweb.cache")
+
+        self.max_size = max_size
+        # Responses are read and stored by the fetching threads
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(name, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode = WAL;")
+        self.con.execute("PRAGMA synchronous = NORMAL;")
+        self.con.execute(
+            """
+              CREATE TABLE IF NOT EXISTS `response` (
+                `key` TEXT PRIMARY KEY,
+                `etag` TEXT,
+                `last_modified` TEXT,
+                `body` BLOB NOT NULL,
+                `size` INTEGER NOT NULL,
+                `accessed_at` REAL NOT NULL
+              );
+            """
+        )
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS response_accessed_idx ON response(accessed_at);"
+        )
+        self.con.commit()
+
+        self.size = self.con.execute(
+            "SELECT coalesce(sum(size), 0) FROM response;"
+        ).fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(path: str, locale: str) -> str:
+        return hashlib.sha256(f"{locale} {path}".encode("utf-8")).hexdigest()
+
+    def prepare(self, path: str, locale: str, headers: dict[str, str]) -> CacheLookup:
+        """
+        Looks up the cached response and adds its validators to the request
+        `headers`, so the server only sends the response if it has changed
+        """
+        lookup = CacheLookup(self.key(path, locale), None)
+        lookup.cached = self.get(lookup.key)
+        if lookup.cached is not None:
+            headers.update(lookup.cached.validators())
+
+        return lookup
+
+    def on_response(
+        self,
+        lookup: CacheLookup,
+        status: int,
+        headers: Mapping[str, str],
+        body: bytes,
+        if_modified: bool = False,
+    ) -> Any:
+        """
+        Returns the JSON response, taken from the cache if the server responded
+        it hasn't changed, or NOT_MODIFIED then if `if_modified` is set. Any
+        other response is stored for the next requests.
+
+        Raises FilmwebError if the server responds the response hasn't changed
+        when nothing was cached.
+        """
+        if status == 304 and lookup.cached is not None:
+            self.not_modified(lookup.key, lookup.cached)
+            if if_modified is True:
+                return NOT_MODIFIED
+            return json.loads(lookup.cached.body)
+        if status == 304:
+            # Nothing was cached, so no validators were sent with the request
+            raise FilmwebError("Not modified response to an unconditional request")
+
+        self.put(lookup.key, headers.get("ETag"), headers.get("Last-Modified"), body)
+
+        return json.loads(body)
+
+    def get(self, key: str) -> CachedResponse | None:
+        with self.lock:
+            row = self.con.execute(
+                "SELECT etag, last_modified, body FROM response WHERE key = ?;",
+                (key,),
+            ).fetchone()
+        if row is None:
+            return None
+
+        return CachedResponse(row[0], row[1], zlib.decompress(row[2]))
+
+    def put(
+        self, key: str, etag: str | None, last_modified: str | None, body: bytes
+    ) -> None:
+        """
+        Stores the response, unless it has no validators, as then it could
+        never be revalidated
+        """
+        if etag is None and last_modified is None:
+            with self.lock:
+                self.misses += 1
+            return
+
+        compressed = zlib.compress(body)
+        with self.lock:
+            self.misses += 1
+            previous = self.con.execute(
+                "SELECT size FROM response WHERE key = ?;", (key,)
+            ).fetchone()
+            self.con.execute(
+                """
+                  INSERT OR REPLACE INTO response (key, etag, last_modified, body, size, accessed_at)
+                    VALUES (?, ?, ?, ?, ?, ?);
+                """,
+                (key, etag, last_modified, compressed, len(compressed), time.time()),
+            )
+            self.size += len(compressed) - (previous[0] if previous else 0)
+            self.__evict__()
+            self.con.commit()
+
+    def not_modified(self, key: str, cached: CachedResponse) -> None:
+        """
+        Marks the cached response as still valid and recently used
+        """
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += len(cached.body)
+            self.con.execute(
+                "UPDATE response SET accessed_at = ? WHERE key = ?;",
+                (time.time(), key),
+            )
+            self.con.commit()
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def log_stats(self) -> None:
+        self.logger.info(
+            "Response cache hit ratio %.1f%% (%s hits, %s misses), saved %s bytes",
+            self.hit_ratio() * 100,
+            self.hits,
+            self.misses,
+            self.bytes_saved,
+        )
+
+    def close(self) -> None:
+        self.con.close()
+
+    def __evict__(self) -> None:
+        while self.size > self.max_size:
+            rows = self.con.execute(
+                "SELECT key, size FROM response ORDER BY accessed_at LIMIT 100;"
+            ).fetchall()
+            if len(rows) == 0:
+                self.size = 0
+                return
+
+            evicted: list[tuple[str]] = []
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                evicted.append((key,))
+                self.size -= size
+
+            self.con.executemany("DELETE FROM response WHERE key = ?;", evicted)
+            self.logger.debug("Evicted %s cached responses", len(evicted))
@@ -39,6 +39,11 @@ class Movie:
     countries: list[Country]
 
 
+@dataclass(eq=True, repr=True)
+class MovieNotModified:
+    id: int
+
+
 @dataclass(eq=True, repr=True)
 class MovieRating:
     movie_id: int
@@ -2,9 +2,13 @@
 SQLite DB interface to store all the information fetched from the Filmweb
 """
 
+import hashlib
+import json
 import logging
 import sqlite3
 from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
 
 from .data import Genre, Movie, MovieRating, UserDetails, UserRating, UserSimilarity
 
@@ -19,15 +23,176 @@ class MovieRatingDetails:
     international_title: str | None
     title: str | None
     year: int
-    rate: float
+    rate: float | None
     my_rate: int
     favorite: bool
     view_date: int
     duration: int | None
-    genres: str
-    directors: str
-    cast: str
-    countries: str
+    genres: str | None
+    directors: str | None
+    cast: str | None
+    countries: str | None
+
+
+@dataclass
+class RatingChanges:
+    """
+    Dataclass for storing the number of ratings changed by a sync
+    """
+
+    inserted: int
+    updated: int
+    removed: int
+
+    def __add__(self, other: "RatingChanges") -> "RatingChanges":
+        return RatingChanges(
+            self.inserted + other.inserted,
+            self.updated + other.updated,
+            self.removed + other.removed,
+        )
+
+
+@dataclass
+class DBProfile:
+    """
+    Dataclass for storing SQLite connection settings
+    """
+
+    journal_mode: str
+    synchronous: str
+    cache_size: int
+    mmap_size: int
+    temp_store: str
+    foreign_keys: bool
+
+
+# Ratings are stored before the details of the rated movies and users are
+# fetched, so the foreign keys can't be enforced while backing up
+PROFILES = {
+    # Every commit survives a power loss
+    "safe": DBProfile("WAL", "FULL", -16000, 0, "DEFAULT", False),
+    # Commits may be lost on a power loss, but never corrupt the database
+    "fast": DBProfile("WAL", "NORMAL", -64000, 268435456, "MEMORY", False),
+    # Nothing is synced to the disk, for the first backup of a big account
+    "bulk-load": DBProfile("WAL", "OFF", -256000, 1073741824, "MEMORY", False),
+}
+
+
+# Versioned schema changes applied on top of the base schema, in order. The
+# version of a migration is its position in the list, counting from 1, and is
+# stored in the `user_version` of the database once applied. The base schema
+# is only created for databases older than the last migration, so any change
+# to the schema has to be a new migration
+MIGRATIONS = [
+    # 1: Indexes for the per user lookups and the reverse link lookups
+    """
+      CREATE INDEX IF NOT EXISTS rating_user_idx
+        ON rating (user_id, movie_id, rate, favorite, view_date);
+      CREATE INDEX IF NOT EXISTS user_similarity_user_idx
+        ON user_similarity (user_id, similar_id);
+      CREATE INDEX IF NOT EXISTS movie_genres_genre_idx ON movie_genres (genre_id);
+      CREATE INDEX IF NOT EXISTS movie_directors_director_idx
+        ON movie_directors (director_id);
+      CREATE INDEX IF NOT EXISTS movie_cast_cast_idx ON movie_cast (cast_id);
+      CREATE INDEX IF NOT EXISTS movie_countries_country_idx
+        ON movie_countries (country_id);
+    """,
+    # 2: Timestamps are set by the upserts, instead of a second write by a trigger
+    """
+      DROP TRIGGER IF EXISTS user_inserted;
+      DROP TRIGGER IF EXISTS user_updated;
+      DROP TRIGGER IF EXISTS movie_inserted;
+      DROP TRIGGER IF EXISTS movie_updated;
+      DROP TRIGGER IF EXISTS movie_rating_inserted;
+      DROP TRIGGER IF EXISTS movie_rating_updated;
+    """,
+    # 3: Time of the last change of a rating, to tell which exports are stale
+    """
+      ALTER TABLE rating ADD COLUMN last_updated TEXT;
+    """,
+    # 4: Hash of the fetched content, to skip rewriting the unchanged movies
+    """
+      ALTER TABLE movie ADD COLUMN fingerprint TEXT;
+      ALTER TABLE movie_rating ADD COLUMN fingerprint TEXT;
+    """,
+    # 5: Time of the last real change of the fetched content, unlike the
+    # last_updated bumped on every refetch, to tell which exports are stale
+    """
+      ALTER TABLE movie ADD COLUMN content_changed_at TEXT;
+      ALTER TABLE movie_rating ADD COLUMN content_changed_at TEXT;
+      UPDATE movie SET content_changed_at = last_updated;
+      UPDATE movie_rating SET content_changed_at = last_updated;
+    """,
+]
+
+
+# Each of the movie facets is aggregated by a separate subquery, so a movie is
+# never multiplied by the number of its genres, directors, cast, and countries,
+# and the movies missing any of them are still exported
+MOVIE_FACETS = """
+  (
+    SELECT GROUP_CONCAT(DISTINCT g.name) FROM `movie_genres` mg
+      INNER JOIN `genre` g ON mg.genre_id = g.id
+    WHERE mg.movie_id = m.id
+  ) genres,
+  (
+    SELECT GROUP_CONCAT(DISTINCT d.name) FROM `movie_directors` md
+      INNER JOIN `director` d ON md.director_id = d.id
+    WHERE md.movie_id = m.id
+  ) directors,
+  (
+    SELECT GROUP_CONCAT(DISTINCT c.name) FROM `movie_cast` mc
+      INNER JOIN `cast` c ON mc.cast_id = c.id
+    WHERE mc.movie_id = m.id
+  ) cast,
+  (
+    SELECT GROUP_CONCAT(DISTINCT ct.code) FROM `movie_countries` mct
+      INNER JOIN `country` ct ON mct.country_id = ct.id
+    WHERE mct.movie_id = m.id
+  ) countries
+"""
+
+# Tables of the movie attributes shared by many movies
+DIMENSIONS = ["genre", "director", "cast", "country"]
+
+# Statements run for every synced or exported user, kept here so the tests can check
+# their query plans use the indexes
+SELECT_STORED_RATINGS = (
+    "SELECT movie_id, rate, favorite, view_date FROM rating WHERE user_id = :id;"
+)
+
+DELETE_RATINGS_EXCEPT = """
+  DELETE FROM rating WHERE user_id = :user_id
+    AND movie_id NOT IN (SELECT value FROM json_each(:movie_ids));
+"""
+
+DELETE_SIMILAR_USERS = "DELETE FROM user_similarity WHERE user_id = :user_id;"
+
+SELECT_USER_RATING = f"""
+  SELECT m.orig_title,
+    m.int_title,
+    m.title,
+    m.year,
+    round(mr.rate, 1) rate,
+    r.rate my_rate,
+    r.favorite,
+    r.view_date,
+    m.duration,
+    {MOVIE_FACETS}
+  FROM `rating` r
+    INNER JOIN `movie` m ON r.movie_id = m.id
+    LEFT JOIN `movie_rating` mr ON mr.movie_id = m.id
+  WHERE r.user_id = :id
+  ORDER BY m.id;
+"""
+
+
+def content_fingerprint(content: Movie | MovieRating) -> str:
+    """
+    Returns a hash of the fetched details of a movie or of its rating
+    """
+    serialized = json.dumps(asdict(content), sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
 
 
 class FilmwebDB:
@@ -35,11 +200,68 @@ class FilmwebDB:
     Filmweb database interface
     """
 
-    def __init__(self, name: str = "filmweb.db"):
+    def __init__(
+        self,
+        name: str = "filmweb.db",
+        profile: str | DBProfile = "safe",
+        read_only: bool = False,
+    ):
         self.logger = logging.getLogger("filmweb.db")
 
-        self.con = sqlite3.connect(name)
+        self.name = name
+        self.read_only = read_only
+        if read_only is True:
+            # Read-only connections, like the ones of the export workers, can't
+            # change the database even by accident
+            self.con = sqlite3.connect(
+                f"{Path(name).resolve().as_uri()}?mode=ro", uri=True
+            )
+        else:
+            self.con = sqlite3.connect(name)
+
+        self.profile = PROFILES[profile] if isinstance(profile, str) else profile
+        self.apply_profile(self.profile)
+
+        # Opening an up-to-date database only costs reading its schema version
+        if read_only is False and self.schema_version() < len(MIGRATIONS):
+            self.create_schema()
+            self.migrate()
+
+        # Genres, directors, cast, and countries repeat across most of the
+        # movies, so only the ones never seen before are inserted. Their ids
+        # are loaded on the first upsert, so the read-only connections never
+        # pay for it
+        self.dimensions: dict[str, set[int]] = {}
+        self.dimension_hits = 0
+        self.dimension_misses = 0
 
+    def load_dimensions(self, table: str) -> set[int]:
+        """
+        Load ids of all the stored genres, directors, cast, or countries
+        """
+        cur = self.con.cursor()
+        try:
+            self.dimensions[table] = set(
+                row[0] for row in cur.execute(f"SELECT id FROM `{table}`;")
+            )
+            return self.dimensions[table]
+        finally:
+            cur.close()
+
+    def schema_version(self) -> int:
+        """
+        Returns the number of the migrations applied to the database
+        """
+        cur = self.con.cursor()
+        try:
+            return cur.execute("PRAGMA user_version;").fetchone()[0]
+        finally:
+            cur.close()
+
+    def create_schema(self):
+        """
+        Create the base schema, all the later changes to it are migrations
+        """
         cur = self.con.cursor()
         try:
             cur.executescript(
@@ -123,6 +345,11 @@ class FilmwebDB:
                     FOREIGN KEY (movie_id) REFERENCES movie (id) ON DELETE CASCADE ON UPDATE CASCADE,
                     UNIQUE (movie_id, user_id)
                   );
+                  CREATE TABLE IF NOT EXISTS rating_sync(
+                    user_id INTEGER PRIMARY KEY,
+                    last_full_sync TEXT,
+                    FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE ON UPDATE CASCADE
+                  );
                   CREATE TABLE IF NOT EXISTS cast(
                     id INTEGER PRIMARY KEY,
                     name TEXT NOT NULL
@@ -146,46 +373,6 @@ class FilmwebDB:
                     UNIQUE (movie_id, country_id)
                   );
 
-                  CREATE TRIGGER IF NOT EXISTS user_inserted AFTER INSERT ON user
-                  FOR EACH ROW
-                  WHEN NEW.last_updated IS NULL
-                  BEGIN
-                    UPDATE user SET date_created = datetime(), last_updated = datetime() WHERE id = NEW.id;
-                  END;
-                  CREATE TRIGGER IF NOT EXISTS user_updated AFTER UPDATE ON user
-                  FOR EACH ROW
-                  WHEN OLD.last_updated = NEW.last_updated
-                  BEGIN
-                    UPDATE user SET last_updated = datetime() WHERE id = NEW.id;
-                  END;
-
-                  CREATE TRIGGER IF NOT EXISTS movie_inserted AFTER INSERT ON movie
-                  FOR EACH ROW
-                  WHEN NEW.last_updated IS NULL
-                  BEGIN
-                    UPDATE movie SET date_created = datetime(), last_updated = datetime() WHERE id = NEW.id;
-                  END;
-                  CREATE TRIGGER IF NOT EXISTS movie_updated AFTER UPDATE ON movie
-                  FOR EACH ROW
-                  WHEN OLD.last_updated = NEW.last_updated
-                  BEGIN
-                    UPDATE movie SET last_updated = datetime() WHERE id = NEW.id;
-                  END;
-
-                  CREATE TRIGGER IF NOT EXISTS movie_rating_inserted AFTER INSERT ON movie_rating
-                  FOR EACH ROW
-                  WHEN NEW.last_updated IS NULL
-                  BEGIN
-                    UPDATE movie_rating SET date_created = datetime(), last_updated = datetime()
-                    WHERE movie_id = NEW.movie_id;
-                  END;
-                  CREATE TRIGGER IF NOT EXISTS movie_rating_updated AFTER UPDATE ON movie_rating
-                  FOR EACH ROW
-                  WHEN OLD.last_updated = NEW.last_updated
-                  BEGIN
-                    UPDATE movie_rating SET last_updated = datetime() WHERE movie_id = NEW.movie_id;
-                  END;
-
                   COMMIT;
                 """
             )
@@ -196,9 +383,60 @@ class FilmwebDB:
         finally:
             cur.close()
 
-    def should_update_movie(self, movie_id: int, ttl: int = 604800) -> bool:
+    def migrate(self):
         """
-        Returns True if a movie doesn't exists or is older than 7 days
+        Apply all the migrations newer than the schema version of the database
+        """
+        version = self.schema_version()
+
+        cur = self.con.cursor()
+        try:
+            for migration_version, migration in enumerate(MIGRATIONS, start=1):
+                if migration_version <= version:
+                    continue
+
+                cur.executescript(
+                    f"""
+                      BEGIN;
+                      {migration}
+                      PRAGMA user_version = {migration_version};
+                      COMMIT;
+                    """
+                )
+
+                self.logger.debug("Database migrated to version %s", migration_version)
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def apply_profile(self, profile: DBProfile):
+        """
+        Set the journal mode, durability, and memory usage of the connection
+        """
+        cur = self.con.cursor()
+        try:
+            # WAL lets the readers, like an export, work while a backup is
+            # writing. The journal mode is stored in the database file, so a
+            # read-only connection can't change it
+            if self.read_only is False:
+                cur.execute(f"PRAGMA journal_mode = {profile.journal_mode};")
+            cur.execute(f"PRAGMA synchronous = {profile.synchronous};")
+            cur.execute(f"PRAGMA cache_size = {int(profile.cache_size)};")
+            cur.execute(f"PRAGMA mmap_size = {int(profile.mmap_size)};")
+            cur.execute(f"PRAGMA temp_store = {profile.temp_store};")
+            cur.execute(
+                f"PRAGMA foreign_keys = {'ON' if profile.foreign_keys else 'OFF'};"
+            )
+
+            self.logger.debug("Database profile set to %s", profile)
+        finally:
+            cur.close()
+
+    def should_update_user(self, user_id: int, ttl: int = 3600) -> bool:
+        """
+        Returns True if user doesn't exists or is older than 1 hour by default.
         """
         cur = self.con.cursor()
         try:
@@ -207,63 +445,145 @@ class FilmwebDB:
                   SELECT 
                     CASE 
                       WHEN NOT EXISTS (
-                        SELECT 1 FROM movie WHERE id = :id
+                        SELECT 1 FROM user WHERE id = :id
                       ) THEN 1
                       WHEN EXISTS (
-                        SELECT 1 FROM movie WHERE id = :id 
+                        SELECT 1 FROM user WHERE id = :id
                           AND (last_updated IS NULL OR unixepoch() - unixepoch(last_updated) > :ttl)
                       ) THEN 1
                       ELSE 0
                     END
                 """,
-                ({"id": movie_id, "ttl": ttl}),
+                ({"id": user_id, "ttl": ttl}),
             )
             return cur.fetchone()[0] == 1
         finally:
             cur.close()
 
+    def should_update_movie(self, movie_id: int, ttl: int = 604800) -> bool:
+        """
+        Returns True if a movie doesn't exists or is older than 7 days
+        """
+        return movie_id in self.should_update_movies([movie_id], ttl)
+
+    def should_update_movies(
+        self, movie_ids: Iterable[int], ttl: int = 604800
+    ) -> set[int]:
+        """
+        Returns ids of the movies that don't exist or are older than 7 days
+        """
+        cur = self.con.cursor()
+        try:
+            cur.execute(
+                """
+                  SELECT ids.value FROM json_each(:ids) ids
+                    LEFT JOIN movie m ON m.id = ids.value
+                   WHERE m.id IS NULL OR m.last_updated IS NULL
+                      OR unixepoch() - unixepoch(m.last_updated) > :ttl
+                """,
+                ({"ids": json.dumps(list(movie_ids)), "ttl": ttl}),
+            )
+            return set(row[0] for row in cur.fetchall())
+        finally:
+            cur.close()
+
+    def get_stored_movies(self, movie_ids: Iterable[int]) -> set[int]:
+        """
+        Returns ids of the movies that are already stored
+        """
+        cur = self.con.cursor()
+        try:
+            cur.execute(
+                """
+                  SELECT m.id FROM json_each(:ids) ids
+                    INNER JOIN movie m ON m.id = ids.value
+                """,
+                ({"ids": json.dumps(list(movie_ids))}),
+            )
+            return set(row[0] for row in cur.fetchall())
+        finally:
+            cur.close()
+
+    def touch_movies(self, movie_ids: list[int]):
+        """
+        Mark stored movies as up-to-date without rewriting their details
+        """
+        if len(movie_ids) == 0:
+            return
+
+        cur = self.con.cursor()
+        try:
+            self.__touch__(cur, "movie", "id", movie_ids)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        finally:
+            cur.close()
+
     def should_update_movie_rating(self, movie_id: int, ttl: int = 86400) -> bool:
         """
         Returns True if rating for a movie doesn't exists or is older than 24 hours
         """
+        return movie_id in self.should_update_movie_ratings([movie_id], ttl)
+
+    def should_update_movie_ratings(
+        self, movie_ids: Iterable[int], ttl: int = 86400
+    ) -> set[int]:
+        """
+        Returns ids of the movies with ratings that don't exist or are older than 24 hours
+        """
         cur = self.con.cursor()
         try:
             cur.execute(
                 """
-                  SELECT 
-                    CASE 
-                      WHEN NOT EXISTS (
-                        SELECT 1 FROM movie_rating WHERE movie_id = :id
-                      ) THEN 1
-                      WHEN EXISTS (
-                        SELECT 1 FROM movie_rating WHERE movie_id = :id
-                          AND (last_updated IS NULL OR unixepoch() - unixepoch(last_updated) > :ttl)
-                      ) THEN 1
-                      ELSE 0
-                    END
+                  SELECT ids.value FROM json_each(:ids) ids
+                    LEFT JOIN movie_rating mr ON mr.movie_id = ids.value
+                   WHERE mr.movie_id IS NULL OR mr.last_updated IS NULL
+                      OR unixepoch() - unixepoch(mr.last_updated) > :ttl
                 """,
-                ({"id": movie_id, "ttl": ttl}),
+                ({"ids": json.dumps(list(movie_ids)), "ttl": ttl}),
             )
-            return cur.fetchone()[0] == 1
+            return set(row[0] for row in cur.fetchall())
         finally:
             cur.close()
 
-    def should_update_user(self, user_id: int, ttl: int = 3600) -> bool:
+    def should_update_users(self, user_ids: Iterable[int], ttl: int = 3600) -> set[int]:
         """
-        Returns True if user doesn't exists or is older than 1 hour by default.
+        Returns ids of the users that don't exist or are older than 1 hour by default.
         """
         cur = self.con.cursor()
         try:
             cur.execute(
                 """
-                  SELECT 
-                    CASE 
+                  SELECT ids.value FROM json_each(:ids) ids
+                    LEFT JOIN user u ON u.id = ids.value
+                   WHERE u.id IS NULL OR u.last_updated IS NULL
+                      OR unixepoch() - unixepoch(u.last_updated) > :ttl
+                """,
+                ({"ids": json.dumps(list(user_ids)), "ttl": ttl}),
+            )
+            return set(row[0] for row in cur.fetchall())
+        finally:
+            cur.close()
+
+    def should_full_sync_ratings(self, user_id: int, ttl: int = 604800) -> bool:
+        """
+        Returns True if all the ratings of a user were never fetched or the last
+        time was over 7 days ago by default
+        """
+        cur = self.con.cursor()
+        try:
+            cur.execute(
+                """
+                  SELECT
+                    CASE
                       WHEN NOT EXISTS (
-                        SELECT 1 FROM user WHERE id = :id
+                        SELECT 1 FROM rating_sync WHERE user_id = :id
                       ) THEN 1
                       WHEN EXISTS (
-                        SELECT 1 FROM user WHERE id = :id
-                          AND (last_updated IS NULL OR unixepoch() - unixepoch(last_updated) > :ttl)
+                        SELECT 1 FROM rating_sync WHERE user_id = :id
+                          AND (last_full_sync IS NULL OR unixepoch() - unixepoch(last_full_sync) > :ttl)
                       ) THEN 1
                       ELSE 0
                     END
@@ -278,45 +598,78 @@ class FilmwebDB:
         """
         Upsert information about movie, genres, directors, cast, and countries
         """
+        self.upsert_movies([movie])
+
+    def upsert_movies(self, movies: list[Movie]):
+        """
+        Upsert information about a batch of movies, their genres, directors, cast,
+        and countries in a single transaction
+        """
+        if len(movies) == 0:
+            return
+
         cur = self.con.cursor()
         try:
-            cur.execute(
+            # Refetched movies are mostly unchanged, and then only their
+            # timestamp is updated instead of the movie and all of its links
+            fingerprints = dict(
+                (movie.id, content_fingerprint(movie)) for movie in movies
+            )
+            unchanged = self.__unchanged_content__(cur, "movie", "id", fingerprints)
+            self.__touch__(cur, "movie", "id", list(unchanged))
+            movies = list(movie for movie in movies if movie.id not in unchanged)
+
+            cur.executemany(
                 """
-                  INSERT INTO movie (id, orig_title, int_title, title, duration, year) 
-                    VALUES (:id, :orig_title, :int_title, :title, :duration, :year)
+                  INSERT INTO movie (id, date_created, last_updated, content_changed_at, orig_title, int_title, title, duration, year, fingerprint)
+                    VALUES (:id, datetime(), datetime(), datetime(), :orig_title, :int_title, :title, :duration, :year, :fingerprint)
                       ON CONFLICT (id)
-                        DO UPDATE SET orig_title = excluded.orig_title, int_title = excluded.int_title,
-                          title = excluded.title, duration = excluded.duration, year = excluded.year;
+                        DO UPDATE SET last_updated = excluded.last_updated, content_changed_at = excluded.content_changed_at,
+                          orig_title = excluded.orig_title, int_title = excluded.int_title, title = excluded.title,
+                          duration = excluded.duration, year = excluded.year, fingerprint = excluded.fingerprint;
                 """,
-                {
-                    "id": movie.id,
-                    "orig_title": movie.originalTitle,
-                    "int_title": movie.internationalTitle,
-                    "title": movie.title,
-                    "duration": movie.duration,
-                    "year": movie.year,
-                },
+                list(
+                    {
+                        "id": movie.id,
+                        "orig_title": movie.originalTitle,
+                        "int_title": movie.internationalTitle,
+                        "title": movie.title,
+                        "duration": movie.duration,
+                        "year": movie.year,
+                        "fingerprint": fingerprints[movie.id],
+                    }
+                    for movie in movies
+                ),
             )
 
-            genres = list(asdict(genre) for genre in movie.genres)
+            movie_ids = list({"movie_id": movie.id} for movie in movies)
+
+            genres = self.__unknown_dimensions__(
+                "genre", list(genre for movie in movies for genre in movie.genres)
+            )
             cur.executemany(
                 "INSERT INTO genre (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING;",
                 genres,
             )
 
             movie_genres = list(
-                {"movie_id": movie.id, "genre_id": genre.id} for genre in movie.genres
+                {"movie_id": movie.id, "genre_id": genre.id}
+                for movie in movies
+                for genre in movie.genres
             )
-            cur.execute(
+            cur.executemany(
                 "DELETE FROM movie_genres WHERE movie_id = :movie_id;",
-                {"movie_id": movie.id},
+                movie_ids,
             )
             cur.executemany(
                 "INSERT INTO movie_genres (movie_id, genre_id) VALUES (:movie_id, :genre_id) ON CONFLICT DO NOTHING;",
                 movie_genres,
             )
 
-            directors = list(asdict(director) for director in movie.directors)
+            directors = self.__unknown_dimensions__(
+                "director",
+                list(director for movie in movies for director in movie.directors),
+            )
             cur.executemany(
                 "INSERT INTO director (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING;",
                 directors,
@@ -324,11 +677,12 @@ class FilmwebDB:
 
             movie_directors = list(
                 {"movie_id": movie.id, "director_id": director.id}
+                for movie in movies
                 for director in movie.directors
             )
-            cur.execute(
+            cur.executemany(
                 "DELETE FROM movie_directors WHERE movie_id = :movie_id;",
-                {"movie_id": movie.id},
+                movie_ids,
             )
             cur.executemany(
                 """
@@ -338,25 +692,32 @@ class FilmwebDB:
                 movie_directors,
             )
 
-            cast = list(asdict(cast) for cast in movie.cast)
+            cast = self.__unknown_dimensions__(
+                "cast", list(cast for movie in movies for cast in movie.cast)
+            )
             cur.executemany(
                 "INSERT INTO cast (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING;",
                 cast,
             )
 
             movie_cast = list(
-                {"movie_id": movie.id, "cast_id": cast.id} for cast in movie.cast
+                {"movie_id": movie.id, "cast_id": cast.id}
+                for movie in movies
+                for cast in movie.cast
             )
-            cur.execute(
+            cur.executemany(
                 "DELETE FROM movie_cast WHERE movie_id = :movie_id;",
-                {"movie_id": movie.id},
+                movie_ids,
             )
             cur.executemany(
                 "INSERT INTO movie_cast (movie_id, cast_id) VALUES (:movie_id, :cast_id) ON CONFLICT DO NOTHING;",
                 movie_cast,
             )
 
-            countries = list(asdict(country) for country in movie.countries)
+            countries = self.__unknown_dimensions__(
+                "country",
+                list(country for movie in movies for country in movie.countries),
+            )
             cur.executemany(
                 "INSERT INTO country (id, code) VALUES (:id, :code) ON CONFLICT DO NOTHING;",
                 countries,
@@ -364,11 +725,12 @@ class FilmwebDB:
 
             movie_countries = list(
                 {"movie_id": movie.id, "country_id": country.id}
+                for movie in movies
                 for country in movie.countries
             )
-            cur.execute(
+            cur.executemany(
                 "DELETE FROM movie_countries WHERE movie_id = :movie_id;",
-                {"movie_id": movie.id},
+                movie_ids,
             )
             cur.executemany(
                 """
@@ -380,7 +742,19 @@ class FilmwebDB:
 
             self.con.commit()
 
-            self.logger.debug("Stored movie details for movie id %s", movie.id)
+            self.__remember_dimensions__("genre", genres)
+            self.__remember_dimensions__("director", directors)
+            self.__remember_dimensions__("cast", cast)
+            self.__remember_dimensions__("country", countries)
+
+            self.logger.debug(
+                "Stored movie details for %s movies, %s were unchanged",
+                len(movies),
+                len(unchanged),
+            )
+        except Exception:
+            self.con.rollback()
+            raise
         finally:
             cur.close()
 
@@ -388,27 +762,60 @@ class FilmwebDB:
         """
         Upsert the information about movie rating
         """
+        self.upsert_movie_ratings([rating])
+
+    def upsert_movie_ratings(self, ratings: list[MovieRating]):
+        """
+        Upsert the information about a batch of movie ratings in a single transaction
+        """
+        if len(ratings) == 0:
+            return
+
         cur = self.con.cursor()
         try:
-            cur.execute(
+            fingerprints = dict(
+                (rating.movie_id, content_fingerprint(rating)) for rating in ratings
+            )
+            unchanged = self.__unchanged_content__(
+                cur, "movie_rating", "movie_id", fingerprints
+            )
+            self.__touch__(cur, "movie_rating", "movie_id", list(unchanged))
+            ratings = list(
+                rating for rating in ratings if rating.movie_id not in unchanged
+            )
+
+            cur.executemany(
                 """
-                INSERT INTO movie_rating (movie_id, count, rate, countWantToSee, countVote1, countVote2, countVote3,
-                  countVote4, countVote5, countVote6, countVote7, countVote8, countVote9, countVote10)
-                VALUES (:movie_id, :count, :rate, :countWantToSee, :countVote1, :countVote2, :countVote3, :countVote4,
-                  :countVote5, :countVote6, :countVote7, :countVote8, :countVote9, :countVote10)
+                INSERT INTO movie_rating (movie_id, date_created, last_updated, content_changed_at, count, rate,
+                  countWantToSee, countVote1, countVote2, countVote3, countVote4, countVote5, countVote6, countVote7,
+                  countVote8, countVote9, countVote10, fingerprint)
+                VALUES (:movie_id, datetime(), datetime(), datetime(), :count, :rate, :countWantToSee, :countVote1,
+                  :countVote2, :countVote3, :countVote4, :countVote5, :countVote6, :countVote7, :countVote8, :countVote9,
+                  :countVote10, :fingerprint)
                 ON CONFLICT (movie_id)
-                  DO UPDATE SET count = excluded.count, rate = excluded.rate, countWantToSee = excluded.countWantToSee,
+                  DO UPDATE SET last_updated = excluded.last_updated, content_changed_at = excluded.content_changed_at,
+                  count = excluded.count, rate = excluded.rate, countWantToSee = excluded.countWantToSee,
                   countVote1 = excluded.countVote1, countVote2 = excluded.countVote2, countVote3 = excluded.countVote3,
                   countVote4 = excluded.countVote4, countVote5 = excluded.countVote5, countVote6 = excluded.countVote6,
                   countVote7 = excluded.countVote7, countVote8 = excluded.countVote8, countVote9 = excluded.countVote9,
-                  countVote10 = excluded.countVote10;
+                  countVote10 = excluded.countVote10, fingerprint = excluded.fingerprint;
                 """,
-                asdict(rating),
+                list(
+                    asdict(rating) | {"fingerprint": fingerprints[rating.movie_id]}
+                    for rating in ratings
+                ),
             )
 
             self.con.commit()
 
-            self.logger.debug("Stored movie rating for movie id %s", rating.movie_id)
+            self.logger.debug(
+                "Stored movie ratings for %s movies, %s were unchanged",
+                len(ratings),
+                len(unchanged),
+            )
+        except Exception:
+            self.con.rollback()
+            raise
         finally:
             cur.close()
 
@@ -421,7 +828,7 @@ class FilmwebDB:
 
         cur = self.con.cursor()
         try:
-            rows = list(asdict(genre) for genre in genres)
+            rows = self.__unknown_dimensions__("genre", genres)
             cur.executemany(
                 "INSERT INTO genre (id, name) VALUES (:id, :name) ON CONFLICT DO NOTHING;",
                 rows,
@@ -429,6 +836,8 @@ class FilmwebDB:
 
             self.con.commit()
 
+            self.__remember_dimensions__("genre", rows)
+
             self.logger.debug("Stored %s movie genres!", len(genres))
         finally:
             cur.close()
@@ -441,9 +850,10 @@ class FilmwebDB:
         try:
             cur.execute(
                 """
-                  INSERT INTO user (id, name, display_name)
-                  VALUES (:id, :name, :display_name)
-                    ON CONFLICT (id) DO UPDATE SET name = excluded.name, display_name = excluded.display_name;
+                  INSERT INTO user (id, date_created, last_updated, name, display_name)
+                  VALUES (:id, datetime(), datetime(), :name, :display_name)
+                    ON CONFLICT (id) DO UPDATE SET last_updated = excluded.last_updated, name = excluded.name,
+                      display_name = excluded.display_name;
                 """,
                 asdict(user_details),
             )
@@ -454,18 +864,44 @@ class FilmwebDB:
         finally:
             cur.close()
 
-    def upsert_ratings(self, user_id: int, ratings: list[UserRating]):
+    def upsert_ratings(self, user_id: int, ratings: list[UserRating]) -> RatingChanges:
         """
-        Upsert information about movies rated by a user
+        Reconcile the stored ratings of a user with the given full list of movies rated by
+        the user, writing only the new, changed, and removed ones
         """
         if len(ratings) == 0:
-            return
+            return RatingChanges(0, 0, 0)
+
+        changes = self.upsert_ratings_batch(user_id, ratings)
+        changes += self.remove_ratings_except(
+            user_id, set(rating.movie_id for rating in ratings)
+        )
+
+        return changes
+
+    def upsert_ratings_batch(
+        self, user_id: int, ratings: list[UserRating]
+    ) -> RatingChanges:
+        """
+        Upsert a batch of movies rated by a user, keeping the other ratings of the user,
+        and return the number of the inserted and the changed ratings
+        """
+        if len(ratings) == 0:
+            return RatingChanges(0, 0, 0)
 
         cur = self.con.cursor()
         try:
             cur.execute(
-                "DELETE FROM rating WHERE user_id = :user_id;", {"user_id": user_id}
+                """
+                  SELECT COUNT(*) FROM json_each(:movie_ids) ids
+                    INNER JOIN rating r ON r.user_id = :user_id AND r.movie_id = ids.value
+                """,
+                {
+                    "user_id": user_id,
+                    "movie_ids": json.dumps(list(set(r.movie_id for r in ratings))),
+                },
             )
+            stored = cur.fetchone()[0]
 
             rows = list(
                 {
@@ -479,15 +915,70 @@ class FilmwebDB:
             )
             cur.executemany(
                 """
-                  INSERT INTO rating (user_id, movie_id, rate, favorite, view_date)
-                  VALUES (:user_id, :movie_id, :rate, :favorite, :view_date);
+                  INSERT INTO rating (user_id, movie_id, rate, favorite, view_date, last_updated)
+                  VALUES (:user_id, :movie_id, :rate, :favorite, :view_date, datetime())
+                    ON CONFLICT (movie_id, user_id) DO UPDATE SET rate = excluded.rate,
+                      favorite = excluded.favorite, view_date = excluded.view_date,
+                      last_updated = excluded.last_updated
+                    WHERE rate != excluded.rate OR favorite != excluded.favorite
+                      OR view_date != excluded.view_date;
                 """,
                 rows,
             )
+            # Rows that didn't change are left untouched by the update
+            inserted = len(set(rating.movie_id for rating in ratings)) - stored
+            changes = RatingChanges(inserted, max(cur.rowcount - inserted, 0), 0)
 
             self.con.commit()
 
-            self.logger.debug("Stored user ratings for user id %s", user_id)
+            self.logger.debug(
+                "Stored user ratings for user id %s: %s", user_id, changes
+            )
+
+            return changes
+        finally:
+            cur.close()
+
+    def remove_ratings_except(
+        self, user_id: int, movie_ids: Iterable[int]
+    ) -> RatingChanges:
+        """
+        Remove ratings of a user for all the movies except the given ones
+        """
+        cur = self.con.cursor()
+        try:
+            cur.execute(
+                DELETE_RATINGS_EXCEPT,
+                {"user_id": user_id, "movie_ids": json.dumps(list(movie_ids))},
+            )
+
+            self.con.commit()
+
+            self.logger.debug(
+                "Removed %s stale user ratings for user id %s", cur.rowcount, user_id
+            )
+
+            return RatingChanges(0, 0, cur.rowcount)
+        finally:
+            cur.close()
+
+    def mark_full_sync_ratings(self, user_id: int):
+        """
+        Store the time all the ratings of a user were fetched
+        """
+        cur = self.con.cursor()
+        try:
+            cur.execute(
+                """
+                  INSERT INTO rating_sync (user_id, last_full_sync) VALUES (:user_id, datetime())
+                    ON CONFLICT (user_id) DO UPDATE SET last_full_sync = excluded.last_full_sync;
+                """,
+                {"user_id": user_id},
+            )
+
+            self.con.commit()
+
+            self.logger.debug("Stored full ratings sync for user id %s", user_id)
         finally:
             cur.close()
 
@@ -500,10 +991,7 @@ class FilmwebDB:
 
         cur = self.con.cursor()
         try:
-            cur.execute(
-                "DELETE FROM user_similarity WHERE user_id = :user_id;",
-                {"user_id": user_id},
-            )
+            cur.execute(DELETE_SIMILAR_USERS, {"user_id": user_id})
 
             rows = list(
                 {
@@ -528,60 +1016,195 @@ class FilmwebDB:
         finally:
             cur.close()
 
+    def get_stored_ratings(self, user_id: int) -> dict[int, UserRating]:
+        """
+        Returns all the stored ratings of a user by the movie id
+        """
+        cur = self.con.cursor()
+        try:
+            cur.execute(SELECT_STORED_RATINGS, {"id": user_id})
+            return dict(
+                (
+                    rating[0],
+                    UserRating(
+                        movie_id=rating[0],
+                        rate=rating[1],
+                        favorite=(rating[2] == 1),
+                        view_date=rating[3],
+                    ),
+                )
+                for rating in cur.fetchall()
+            )
+        finally:
+            cur.close()
+
     def get_user_rating(self, user_id: int) -> list[MovieRatingDetails]:
         """
         Returns a list of movies rated by user, with details of the rating and the movies
         """
+        return list(self.iter_user_rating(user_id))
+
+    def iter_user_rating(
+        self, user_id: int, chunk_size: int = 1000
+    ) -> Iterator[MovieRatingDetails]:
+        """
+        Yields movies rated by user, with details of the rating and the movies, reading
+        them from the database `chunk_size` rows at a time
+        """
         cur = self.con.cursor()
         try:
+            cur.execute(SELECT_USER_RATING, {"id": user_id})
+            while True:
+                ratings = cur.fetchmany(chunk_size)
+                if len(ratings) == 0:
+                    break
+
+                for rating in ratings:
+                    yield MovieRatingDetails(
+                        original_title=rating[0],
+                        international_title=rating[1],
+                        title=rating[2],
+                        year=rating[3],
+                        rate=rating[4],
+                        my_rate=rating[5],
+                        favorite=(rating[6] == 1),
+                        view_date=rating[7],
+                        duration=rating[8],
+                        genres=rating[9],
+                        directors=rating[10],
+                        cast=rating[11],
+                        countries=rating[12],
+                    )
+        finally:
+            cur.close()
+
+    def iter_all_user_ratings(
+        self, user_ids: Iterable[int] | None = None, chunk_size: int = 1000
+    ) -> Iterator[tuple[int, MovieRatingDetails]]:
+        """
+        Yields movies rated by all the users, or only the given ones, ordered by the user
+        id, with details of the rating and the movies, reading them from the database
+        `chunk_size` rows at a time.
+
+        The details of every rated movie are aggregated only once, no matter how many
+        users rated it.
+        """
+        users_filter = "true"
+        params = {}
+        if user_ids is not None:
+            users_filter = "user_id IN (SELECT value FROM json_each(:user_ids))"
+            params["user_ids"] = json.dumps(list(user_ids))
+
+        cur = self.con.cursor()
+        try:
+            cur.execute("DROP TABLE IF EXISTS temp.movie_export;")
             cur.execute(
-                """
-                  SELECT m.orig_title,
-                    m.int_title,
-                    m.title,
-                    m.year,
-                    round(mr.rate, 1) rate,
+                f"""
+                  CREATE TEMP TABLE movie_export AS
+                    SELECT m.id,
+                      m.orig_title,
+                      m.int_title,
+                      m.title,
+                      m.year,
+                      round(mr.rate, 1) rate,
+                      m.duration,
+                      {MOVIE_FACETS}
+                    FROM `movie` m
+                      LEFT JOIN `movie_rating` mr ON mr.movie_id = m.id
+                    WHERE m.id IN (SELECT movie_id FROM `rating` WHERE {users_filter});
+                """,
+                params,
+            )
+            cur.execute(
+                "CREATE UNIQUE INDEX temp.movie_export_idx ON movie_export (id);"
+            )
+
+            cur.execute(
+                f"""
+                  SELECT r.user_id,
+                    e.orig_title,
+                    e.int_title,
+                    e.title,
+                    e.year,
+                    e.rate,
                     r.rate my_rate,
                     r.favorite,
                     r.view_date,
-                    m.duration,
-                    GROUP_CONCAT(distinct g.name) genres,
-                    GROUP_CONCAT(distinct d.name) directors,
-                    GROUP_CONCAT(distinct c.name) cast,
-                    GROUP_CONCAT(distinct ct.code) countries
-                  FROM `movie` m
-                    INNER JOIN `rating` r ON r.movie_id = m.id
-                    INNER JOIN `movie_genres` mg ON mg.movie_id = m.id
-                    INNER JOIN `genre` g ON mg.genre_id = g.id
-                    INNER JOIN `movie_rating` mr ON mr.movie_id = m.id
-                    INNER JOIN `movie_directors` md ON md.movie_id = m.id
-                    INNER JOIN `director` d ON md.director_id = d.id
-                    INNER JOIN `movie_cast` mc ON mc.movie_id = m.id
-                    INNER JOIN `cast` c ON mc.cast_id = c.id
-                    INNER JOIN `movie_countries` mct ON mct.movie_id = m.id
-                    INNER JOIN `country` ct ON mct.country_id = ct.id
-                  WHERE r.user_id = :id
-                  GROUP BY m.id;
+                    e.duration,
+                    e.genres,
+                    e.directors,
+                    e.cast,
+                    e.countries
+                  FROM `rating` r
+                    INNER JOIN temp.movie_export e ON r.movie_id = e.id
+                  WHERE {users_filter}
+                  ORDER BY r.user_id, r.movie_id;
                 """,
-                ({"id": user_id}),
+                params,
             )
-            return list(
-                MovieRatingDetails(
-                    original_title=rating[0],
-                    international_title=rating[1],
-                    title=rating[2],
-                    year=rating[3],
-                    rate=rating[4],
-                    my_rate=rating[5],
-                    favorite=(rating[6] == 1),
-                    view_date=rating[7],
-                    duration=rating[8],
-                    genres=rating[9],
-                    directors=rating[10],
-                    cast=rating[11],
-                    countries=rating[12],
-                )
-                for rating in cur.fetchall()
+            while True:
+                ratings = cur.fetchmany(chunk_size)
+                if len(ratings) == 0:
+                    break
+
+                for rating in ratings:
+                    yield rating[0], MovieRatingDetails(
+                        original_title=rating[1],
+                        international_title=rating[2],
+                        title=rating[3],
+                        year=rating[4],
+                        rate=rating[5],
+                        my_rate=rating[6],
+                        favorite=(rating[7] == 1),
+                        view_date=rating[8],
+                        duration=rating[9],
+                        genres=rating[10],
+                        directors=rating[11],
+                        cast=rating[12],
+                        countries=rating[13],
+                    )
+        finally:
+            cur.execute("DROP TABLE IF EXISTS temp.movie_export;")
+            cur.close()
+
+    def get_export_fingerprints(
+        self, user_ids: Iterable[int] | None = None
+    ) -> dict[int, tuple[int, str]]:
+        """
+        Returns the number of ratings and a fingerprint of the exported data of all the
+        users, or only the given ones. The fingerprint changes whenever a rating of the
+        user or any of the rated movies is changed, but not when an unchanged movie is
+        only fetched again
+        """
+        users_filter = "true"
+        params = {}
+        if user_ids is not None:
+            users_filter = "u.id IN (SELECT value FROM json_each(:user_ids))"
+            params["user_ids"] = json.dumps(list(user_ids))
+
+        cur = self.con.cursor()
+        try:
+            # The number of ratings changes when a rating is removed, all the
+            # other changes update one of the timestamps
+            cur.execute(
+                f"""
+                  SELECT u.id,
+                    COUNT(r.movie_id),
+                    MAX(r.last_updated),
+                    MAX(m.content_changed_at),
+                    MAX(mr.content_changed_at)
+                  FROM `user` u
+                    LEFT JOIN `rating` r ON r.user_id = u.id
+                    LEFT JOIN `movie` m ON m.id = r.movie_id
+                    LEFT JOIN `movie_rating` mr ON mr.movie_id = r.movie_id
+                  WHERE {users_filter}
+                  GROUP BY u.id;
+                """,
+                params,
+            )
+            return dict(
+                (row[0], (row[1], "|".join(str(value) for value in row[1:])))
+                for row in cur.fetchall()
             )
         finally:
             cur.close()
@@ -603,3 +1226,47 @@ class FilmwebDB:
             )
         finally:
             cur.close()
+
+    def __unchanged_content__(
+        self, cur: sqlite3.Cursor, table: str, key: str, fingerprints: dict[int, str]
+    ) -> set[int]:
+        cur.execute(
+            f"""
+              SELECT t.`{key}` FROM json_each(:fingerprints) f
+                INNER JOIN `{table}` t ON t.`{key}` = json_extract(f.value, '$[0]')
+                  AND t.fingerprint = json_extract(f.value, '$[1]')
+            """,
+            ({"fingerprints": json.dumps(list(fingerprints.items()))}),
+        )
+        return set(row[0] for row in cur.fetchall())
+
+    def __touch__(self, cur: sqlite3.Cursor, table: str, key: str, ids: list[int]):
+        if len(ids) == 0:
+            return
+
+        cur.execute(
+            f"""
+              UPDATE `{table}` SET last_updated = datetime()
+               WHERE `{key}` IN (SELECT value FROM json_each(:ids));
+            """,
+            ({"ids": json.dumps(ids)}),
+        )
+
+    def __unknown_dimensions__(self, table: str, values: list) -> list[dict]:
+        known = self.dimensions.get(table)
+        if known is None:
+            known = self.load_dimensions(table)
+
+        unknown: dict[int, dict] = {}
+        for value in values:
+            if value.id in known or value.id in unknown:
+                self.dimension_hits += 1
+            else:
+                self.dimension_misses += 1
+                unknown[value.id] = asdict(value)
+
+        return list(unknown.values())
+
+    def __remember_dimensions__(self, table: str, rows: list[dict]):
+        # Only called after a commit, so a rolled back value is inserted again
+        self.dimensions[table].update(row["id"] for row in rows)
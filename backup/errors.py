@@ -0,0 +1,11 @@
+"""
+Errors raised while fetching the data from the Filmweb
+"""
+
+
+class FilmwebError(Exception):
+    pass
+
+
+class FilmwebInvalidTokenError(FilmwebError):
+    pass
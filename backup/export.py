@@ -0,0 +1,411 @@
+"""
+Helpers to write the exported files and keep track of them between the runs
+"""
+
+import csv
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import struct
+import sys
+import tempfile
+from abc import ABC, abstractmethod
+from array import array
+from contextlib import contextmanager
+from dataclasses import astuple
+from datetime import datetime, timezone
+from typing import IO, Any, Iterable, Iterator
+
+from .db import MovieRatingDetails
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+EXPORT_COLUMNS = [
+    ("original_title", "str"),
+    ("international_title", "str"),
+    ("title", "str"),
+    ("year", "int"),
+    ("rate", "float"),
+    ("my_rate", "int"),
+    ("favorite", "bool"),
+    ("view_date", "int"),
+    ("duration", "int"),
+    ("genres", "str"),
+    ("directors", "str"),
+    ("cast", "str"),
+    ("countries", "str"),
+]
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w", **kwargs) -> Iterator[IO]:
+    """
+    Opens a temporary file next to `path`, which replaces it only once it's
+    completely written, so a reader never sees a partial export
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode, **kwargs) as file:
+            yield file
+
+        # Temporary files are only readable by the owner, unlike a new file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class HashingWriter(io.RawIOBase):
+    """
+    Passes all the written bytes to `file`, keeping the SHA-256 hash of them
+    """
+
+    def __init__(self, file: IO[bytes]):
+        super().__init__()
+        self.file = file
+        self.hash = hashlib.sha256()
+        self.written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.hash.update(data)
+        self.file.write(data)
+        self.written += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.written
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+class Exporter(ABC):
+    """
+    Writes the exported ratings to a binary `file` in one of the formats
+    """
+
+    extension = ""
+
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+
+    @abstractmethod
+    def write_rows(self, ratings: Iterable[MovieRatingDetails]) -> int:
+        """
+        Writes the ratings and returns the number of them
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class CsvExporter(Exporter):
+    extension = "csv"
+
+    def __init__(self, file: IO[bytes]):
+        super().__init__(file)
+        self.text_file = io.TextIOWrapper(
+            self.__compressed__(file), encoding="utf-8", newline=""
+        )
+        self.writer = csv.writer(
+            self.text_file, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
+        )
+        self.writer.writerow([name for name, _ in EXPORT_COLUMNS])
+
+    def __compressed__(self, file: IO[bytes]) -> IO[bytes]:
+        return file
+
+    def write_rows(self, ratings: Iterable[MovieRatingDetails]) -> int:
+        exported = 0
+        # Rows are written as they are read from the database, so the
+        # memory usage doesn't depend on the number of ratings
+        for rating in ratings:
+            self.writer.writerow(astuple(rating))
+            exported += 1
+
+        return exported
+
+    def close(self) -> None:
+        compressed = self.text_file.detach()
+        if compressed is not self.file:
+            compressed.close()
+
+
+class GzipCsvExporter(CsvExporter):
+    extension = "csv.gz"
+
+    def __compressed__(self, file: IO[bytes]) -> IO[bytes]:
+        # The modification time is left out, so the same ratings always give
+        # the same file
+        return gzip.GzipFile(fileobj=file, mode="wb", mtime=0)
+
+
+class ZstdCsvExporter(CsvExporter):
+    extension = "csv.zst"
+
+    def __compressed__(self, file: IO[bytes]) -> IO[bytes]:
+        return zstandard.ZstdCompressor().stream_writer(file, closefd=False)
+
+
+class JsonLinesExporter(Exporter):
+    extension = "jsonl"
+
+    def write_rows(self, ratings: Iterable[MovieRatingDetails]) -> int:
+        exported = 0
+        for rating in ratings:
+            row = dict(zip((name for name, _ in EXPORT_COLUMNS), astuple(rating)))
+            self.file.write(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+            self.file.write(b"\n")
+            exported += 1
+
+        return exported
+
+
+class ParquetExporter(Exporter):
+    extension = "parquet"
+
+    def __init__(self, file: IO[bytes], row_group_size: int = 10000):
+        super().__init__(file)
+        self.row_group_size = row_group_size
+        types = {
+            "str": pyarrow.string(),
+            "int": pyarrow.int64(),
+            "float": pyarrow.float64(),
+            "bool": pyarrow.bool_(),
+        }
+        self.schema = pyarrow.schema(
+            [(name, types[type_name]) for name, type_name in EXPORT_COLUMNS]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(
+            pyarrow.PythonFile(file, mode="w"), self.schema
+        )
+
+    def write_rows(self, ratings: Iterable[MovieRatingDetails]) -> int:
+        exported = 0
+        for rows in batched_columns(ratings, self.row_group_size):
+            self.writer.write_batch(
+                pyarrow.RecordBatch.from_pydict(
+                    dict(zip(self.schema.names, rows)), schema=self.schema
+                )
+            )
+            exported += len(rows[0])
+
+        return exported
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class ColumnarExporter(Exporter):
+    """
+    Writes a compact, typed columnar file used when pyarrow isn't installed.
+
+    The file starts with the `FWCOL1` magic, followed by the row groups. Each
+    row group is a little-endian uint32 length of its JSON header, listing the
+    number of rows and the byte size of each column, and then the columns in
+    the `EXPORT_COLUMNS` order:
+    - int: a byte null mask and int64 values,
+    - float: float64 values with NaN as null,
+    - bool: a byte per value,
+    - str: int32 lengths, -1 for null, and the concatenated UTF-8 values.
+    """
+
+    extension = "fwcol"
+    magic = b"FWCOL1"
+
+    def __init__(self, file: IO[bytes], row_group_size: int = 10000):
+        super().__init__(file)
+        self.row_group_size = row_group_size
+        self.file.write(self.magic)
+
+    def write_rows(self, ratings: Iterable[MovieRatingDetails]) -> int:
+        exported = 0
+        for rows in batched_columns(ratings, self.row_group_size):
+            blobs = [
+                encode_column(type_name, values)
+                for (_, type_name), values in zip(EXPORT_COLUMNS, rows)
+            ]
+            header = json.dumps(
+                {"rows": len(rows[0]), "sizes": [len(blob) for blob in blobs]}
+            ).encode("utf-8")
+            self.file.write(struct.pack("<I", len(header)))
+            self.file.write(header)
+            for blob in blobs:
+                self.file.write(blob)
+            exported += len(rows[0])
+
+        return exported
+
+
+def batched_columns(
+    ratings: Iterable[MovieRatingDetails], size: int
+) -> Iterator[list[list[Any]]]:
+    columns: list[list[Any]] = [[] for _ in EXPORT_COLUMNS]
+    for rating in ratings:
+        for column, value in zip(columns, astuple(rating)):
+            column.append(value)
+        if len(columns[0]) >= size:
+            yield columns
+            columns = [[] for _ in EXPORT_COLUMNS]
+
+    if len(columns[0]) > 0:
+        yield columns
+
+
+def encode_column(type_name: str, values: list[Any]) -> bytes:
+    if type_name == "int":
+        mask = array("b", (value is not None for value in values))
+        numbers = array("q", (value or 0 for value in values))
+        return to_little_endian(mask) + to_little_endian(numbers)
+    if type_name == "float":
+        numbers = array("d", (math.nan if value is None else value for value in values))
+        return to_little_endian(numbers)
+    if type_name == "bool":
+        return to_little_endian(array("b", (bool(value) for value in values)))
+
+    encoded = [None if value is None else value.encode("utf-8") for value in values]
+    lengths = array("i", (-1 if value is None else len(value) for value in encoded))
+    return to_little_endian(lengths) + b"".join(value or b"" for value in encoded)
+
+
+def decode_column(type_name: str, rows: int, blob: bytes) -> list[Any]:
+    if type_name == "int":
+        mask = from_little_endian("b", blob[:rows])
+        numbers = from_little_endian("q", blob[rows:])
+        return [number if present else None for present, number in zip(mask, numbers)]
+    if type_name == "float":
+        return [
+            None if math.isnan(number) else number
+            for number in from_little_endian("d", blob)
+        ]
+    if type_name == "bool":
+        return [bool(value) for value in from_little_endian("b", blob)]
+
+    lengths = from_little_endian("i", blob[: rows * 4])
+    values: list[str | None] = []
+    offset = rows * 4
+    for length in lengths:
+        if length < 0:
+            values.append(None)
+        else:
+            values.append(blob[offset : offset + length].decode("utf-8"))
+            offset += length
+    return values
+
+
+def to_little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":  # pragma: no cover
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_little_endian(typecode: str, blob: bytes) -> array:
+    values = array(typecode, blob)
+    if sys.byteorder == "big":  # pragma: no cover
+        values.byteswap()
+    return values
+
+
+def read_columnar(file: IO[bytes]) -> Iterator[dict[str, Any]]:
+    """
+    Reads back the rows of a file written by `ColumnarExporter`
+    """
+    if file.read(len(ColumnarExporter.magic)) != ColumnarExporter.magic:
+        raise ValueError("Not a columnar export file")
+
+    while header_size := file.read(4):
+        header = json.loads(file.read(struct.unpack("<I", header_size)[0]))
+        columns = [
+            decode_column(type_name, header["rows"], file.read(size))
+            for (_, type_name), size in zip(EXPORT_COLUMNS, header["sizes"])
+        ]
+        for values in zip(*columns):
+            yield dict(zip((name for name, _ in EXPORT_COLUMNS), values))
+
+
+def export_formats() -> dict[str, type[Exporter]]:
+    """
+    Lists the export formats available with the installed libraries
+    """
+    formats: dict[str, type[Exporter]] = {
+        "csv": CsvExporter,
+        "csv.gz": GzipCsvExporter,
+        "jsonl": JsonLinesExporter,
+    }
+    if zstandard is not None:
+        formats["csv.zst"] = ZstdCsvExporter
+    formats["fwcol"] = ColumnarExporter
+    if pyarrow is not None:
+        formats["parquet"] = ParquetExporter
+    # The best columnar format available, see the extension of the exported
+    # files for the one used
+    formats["columnar"] = formats.get("parquet", ColumnarExporter)
+
+    return formats
+
+
+EXPORT_FORMATS = export_formats()
+
+
+class ExportManifest:
+    """
+    Keeps the fingerprint of the exported data and the content hash of the
+    export file of each user, so the users with no changes since their last
+    export can be skipped
+    """
+
+    def __init__(self, path: str = "export/manifest.json"):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                self.entries = json.load(manifest_file)
+
+    def is_current(self, user_id: int, file_name: str, fingerprint: str | None) -> bool:
+        entry = self.entries.get(str(user_id))
+        if entry is None or fingerprint is None:
+            return False
+
+        return (
+            entry["file"] == file_name
+            and entry["fingerprint"] == fingerprint
+            and os.path.exists(file_name)
+        )
+
+    def update(
+        self, user_id: int, file_name: str, fingerprint: str | None, digest: str
+    ) -> None:
+        self.entries[str(user_id)] = {
+            "file": file_name,
+            "fingerprint": fingerprint,
+            "sha256": digest,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def save(self) -> None:
+        with atomic_write(self.path) as manifest_file:
+            json.dump(self.entries, manifest_file, indent=2, sort_keys=True)
@@ -0,0 +1,235 @@
+"""
+Token bucket rate limiting shared by the threaded and the asyncio API clients
+"""
+
+import asyncio
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Returns the number of seconds to wait from the value of the `Retry-After`
+    header, which can be either a number of seconds or an HTTP date
+    """
+    if not isinstance(value, str) or value.strip() == "":
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Returns the exponential backoff delay for a retry attempt (starting from 1)
+    with a random jitter, so retrying callers don't come back all at once
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def endpoint_class(path: str) -> str:
+    """
+    Returns the class of an API endpoint that shares a rate limit, e.g.
+    `/film/*/preview` for `/film/123/preview` or `/logged/*` for any of the
+    endpoints that require authentication
+    """
+    path = path.split("?", 1)[0].removeprefix("/api/v1")
+    segments = list(
+        "*" if segment.isdigit() else segment for segment in path.strip("/").split("/")
+    )
+    if segments[0] == "logged":
+        return "/logged/*"
+
+    return "/" + "/".join(segments)
+
+
+def validate_limit(rate: float, burst: int) -> None:
+    """
+    Raises ValueError unless the `rate` is positive and the `burst` allows at
+    least a single request, as otherwise no request could ever be sent
+    """
+    if rate <= 0:
+        raise ValueError(f"Rate must be greater than 0, got {rate}")
+    if burst < 1:
+        raise ValueError(f"Burst must be at least 1, got {burst}")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, refilled with `rate` tokens per second up to
+    `burst` tokens.
+
+    The rate adapts to the server responses: it's cut by `decrease` every time
+    the server throttles the requests and raised by `increase` after each
+    `rate` worth of successful responses, but never above the initial rate.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        min_rate: float = 0.1,
+        increase: float = 0.5,
+        decrease: float = 0.5,
+        cooldown: float = 1.0,
+    ):
+        validate_limit(rate, burst)
+
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.successes = 0
+        self.throttled = float("-inf")
+        self.lock = threading.Lock()
+
+    def __refill__(self, now: float) -> None:
+        # While paused the last update is set in the future, and no tokens are
+        # added until that moment
+        if now > self.updated:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token from the bucket and returns the number of seconds the
+        caller has to wait before it can be used
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.__refill__(now)
+
+            # The bucket may go into debt, so the waiting callers are queued up
+            # fairly one after another instead of racing for the next token
+            self.tokens -= 1
+
+            delay = max(0.0, self.updated - now)
+            if self.tokens < 0:
+                delay += -self.tokens / self.rate
+
+            return delay
+
+    def on_success(self) -> None:
+        with self.lock:
+            if self.rate >= self.max_rate:
+                return
+
+            self.successes += 1
+            if self.successes >= self.rate:
+                self.__refill__(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self.successes = 0
+
+    def on_throttle(self, retry_after: float | None = None) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.__refill__(now)
+            self.successes = 0
+
+            # All the requests in flight are likely to be throttled together,
+            # so decrease the rate only once for all of them
+            if now - self.throttled >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.throttled = now
+
+            if retry_after is not None and retry_after > 0:
+                self.tokens = min(self.tokens, 0.0)
+                self.updated = max(self.updated, now + retry_after)
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """
+    Keeps a separate token bucket per host and endpoint class. By default all
+    of them use the same `rate` and `burst`, which can be overridden per
+    endpoint class with `limits`.
+    """
+
+    def __init__(
+        self,
+        rate: float = 5.0,
+        burst: int = 5,
+        limits: dict[str, tuple[float, int]] | None = None,
+        min_rate: float = 0.1,
+    ):
+        # Buckets are created on the first request, so the limits are checked
+        # upfront instead
+        validate_limit(rate, burst)
+        for limit_rate, limit_burst in (limits or {}).values():
+            validate_limit(limit_rate, limit_burst)
+
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits if limits is not None else {}
+        self.min_rate = min_rate
+
+        self.buckets: dict[tuple[str, str], TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url: str) -> TokenBucket:
+        parts = urlsplit(url)
+        key = (parts.netloc, endpoint_class(parts.path))
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                rate, burst = self.limits.get(key[1], (self.rate, self.burst))
+                bucket = TokenBucket(rate, burst, self.min_rate)
+                self.buckets[key] = bucket
+
+            return bucket
+
+    def acquire(self, url: str) -> None:
+        self.bucket(url).acquire()
+
+    async def acquire_async(self, url: str) -> None:
+        await self.bucket(url).acquire_async()
+
+    def on_success(self, url: str) -> None:
+        self.bucket(url).on_success()
+
+    def on_throttle(self, url: str, retry_after: float | None = None) -> None:
+        self.bucket(url).on_throttle(retry_after)
+
+    def effective_rate(self, url: str) -> float:
+        return self.bucket(url).rate
+
+    def effective_rates(self) -> dict[str, float]:
+        """
+        Returns the current rate of each endpoint class
+        """
+        with self.lock:
+            return dict(
+                (f"{host}{endpoint}", bucket.rate)
+                for (host, endpoint), bucket in self.buckets.items()
+            )
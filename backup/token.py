@@ -0,0 +1,165 @@
+"""
+On-disk cache of the JWT token shared by the runs of the backup
+"""
+
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+def decode_expiry(token: str | None) -> float | None:
+    """
+    Returns the `exp` claim of a JWT token as a UNIX timestamp, or None if the
+    token can't be decoded
+    """
+    if not isinstance(token, str) or token.count(".") != 2:
+        return None
+
+    payload = token.split(".")[1]
+    try:
+        claims = json.loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+    expiry = claims.get("exp") if isinstance(claims, dict) else None
+    if isinstance(expiry, bool) or not isinstance(expiry, (int, float)):
+        return None
+
+    return float(expiry)
+
+
+@dataclass
+class CachedToken:
+    token: str
+    expires_at: float
+
+    def expires_in(self) -> float:
+        return self.expires_at - time.time()
+
+
+class TokenCache:
+    """
+    Keeps the JWT token with its expiry in a file only readable by its owner.
+
+    The token is stored with a hash of the secret it was fetched with, so
+    switching to another account never reuses the previous one's token.
+    """
+
+    def __init__(self, secret: str, path: str = ".filmweb-jwt.json"):
+        self.logger = logging.getLogger("filmweb.token")
+
+        self.path = path
+        self.secret_hash = hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+    def load(self) -> CachedToken | None:
+        try:
+            with open(self.path) as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if (
+            not isinstance(entry, dict)
+            or entry.get("secret_sha256") != self.secret_hash
+        ):
+            return None
+
+        token = entry.get("token")
+        expires_at = decode_expiry(token)
+        if expires_at is None:
+            return None
+
+        return CachedToken(token, expires_at)
+
+    def load_fresh(self, stale_token: str | None, margin: float) -> CachedToken | None:
+        """
+        Returns the cached token, unless it's the stale one or it expires in
+        less than `margin` seconds
+        """
+        cached = self.load()
+        if cached is None or cached.token == stale_token:
+            return None
+        if cached.expires_in() <= margin:
+            return None
+
+        return cached
+
+    def save(self, token: str | None) -> CachedToken | None:
+        """
+        Stores the token, unless it's not a JWT with an expiry, as then it
+        can't be known whether it's still valid on the next run
+        """
+        expires_at = decode_expiry(token)
+        if expires_at is None:
+            return None
+
+        directory = os.path.dirname(self.path) or "."
+        # Temporary files are created only readable and writable by the owner
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory, prefix=f".{os.path.basename(self.path)}.", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump(
+                    {"secret_sha256": self.secret_hash, "token": token}, cache_file
+                )
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self.logger.debug("Cached the JWT token valid until %s", expires_at)
+
+        return CachedToken(token, expires_at)
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """
+        Holds an exclusive lock shared by all the processes using the cache,
+        so only one of them fetches a new token at a time
+        """
+        fd = self.__acquire__()
+        try:
+            yield
+        finally:
+            self.__release__(fd)
+
+    @asynccontextmanager
+    async def lock_async(self) -> AsyncIterator[None]:
+        # Waiting for another process mustn't block the event loop
+        fd = await asyncio.to_thread(self.__acquire__)
+        try:
+            yield
+        finally:
+            self.__release__(fd)
+
+    def __acquire__(self) -> int | None:
+        if fcntl is None:  # pragma: no cover
+            return None
+
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def __release__(self, fd: int | None) -> None:
+        if fd is None:  # pragma: no cover
+            return
+
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
@@ -0,0 +1,77 @@
+"""
+Compares the write throughput of the FilmwebDB performance profiles
+
+    python -m benchmarks.bench_db_profiles --movies 10000
+"""
+
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from backup.db import PROFILES, FilmwebDB
+
+from .dataset import (
+    generate_movie_ratings,
+    generate_movies,
+    generate_ratings,
+    generate_users,
+)
+
+
+def bench_profile(profile: str, movies, movie_ratings, users, ratings) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = FilmwebDB(os.path.join(tmp_dir, "filmweb.db"), profile)
+
+        timings = {}
+
+        start = time.perf_counter()
+        for movie in movies[:1000]:
+            db.upsert_movie(movie)
+        timings["upsert_movie x1000"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(0, len(movies), 100):
+            db.upsert_movies(movies[i : i + 100])
+            db.upsert_movie_ratings(movie_ratings[i : i + 100])
+        timings[f"upsert_movies x{len(movies)}"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for user in users:
+            db.upsert_ratings_batch(user.id, ratings[user.id])
+            db.upsert_user_details(user)
+        timings[f"upsert_ratings_batch x{len(users)}"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for user in users:
+            db.get_user_rating(user.id)
+        timings[f"get_user_rating x{len(users)}"] = time.perf_counter() - start
+
+        db.con.close()
+
+        return timings
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--movies", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--ratings", type=int, default=2000)
+    args = parser.parse_args()
+
+    movies = generate_movies(args.movies)
+    movie_ratings = generate_movie_ratings(movies)
+    users = generate_users(args.users)
+    ratings = dict(
+        (user.id, generate_ratings(movies, args.ratings, seed=user.id))
+        for user in users
+    )
+
+    for profile in PROFILES:
+        timings = bench_profile(profile, movies, movie_ratings, users, ratings)
+        for name, seconds in timings.items():
+            print(f"{profile:<10} {name:<30} {seconds:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares the export query with the previous one, which joined all the movie
+facets at once and grouped the resulting fan-out
+
+    python -m benchmarks.bench_export --movies 50000
+"""
+
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from backup.db import FilmwebDB
+
+from .dataset import generate_movie_ratings, generate_movies, generate_ratings
+
+JOIN_FAN_OUT_QUERY = """
+  SELECT m.orig_title, m.int_title, m.title, m.year, round(mr.rate, 1) rate,
+    r.rate my_rate, r.favorite, r.view_date, m.duration,
+    GROUP_CONCAT(distinct g.name) genres,
+    GROUP_CONCAT(distinct d.name) directors,
+    GROUP_CONCAT(distinct c.name) cast,
+    GROUP_CONCAT(distinct ct.code) countries
+  FROM `movie` m
+    INNER JOIN `rating` r ON r.movie_id = m.id
+    INNER JOIN `movie_genres` mg ON mg.movie_id = m.id
+    INNER JOIN `genre` g ON mg.genre_id = g.id
+    INNER JOIN `movie_rating` mr ON mr.movie_id = m.id
+    INNER JOIN `movie_directors` md ON md.movie_id = m.id
+    INNER JOIN `director` d ON md.director_id = d.id
+    INNER JOIN `movie_cast` mc ON mc.movie_id = m.id
+    INNER JOIN `cast` c ON mc.cast_id = c.id
+    INNER JOIN `movie_countries` mct ON mct.movie_id = m.id
+    INNER JOIN `country` ct ON mct.country_id = ct.id
+  WHERE r.user_id = :id
+  GROUP BY m.id;
+"""
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--movies", type=int, default=50000)
+    parser.add_argument(
+        "--skip-fan-out",
+        help="Don't run the previous query for comparison",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    movies = generate_movies(args.movies)
+    movie_ratings = generate_movie_ratings(movies)
+    ratings = generate_ratings(movies, len(movies))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = FilmwebDB(os.path.join(tmp_dir, "filmweb.db"), "bulk-load")
+        for i in range(0, len(movies), 1000):
+            db.upsert_movies(movies[i : i + 1000])
+            db.upsert_movie_ratings(movie_ratings[i : i + 1000])
+        db.upsert_ratings_batch(1, ratings)
+
+        start = time.perf_counter()
+        exported = db.get_user_rating(1)
+        print(
+            f"get_user_rating      {len(exported):>8} rows {time.perf_counter() - start:8.3f}s"
+        )
+
+        if args.skip_fan_out is False:
+            start = time.perf_counter()
+            exported = db.con.execute(JOIN_FAN_OUT_QUERY, {"id": 1}).fetchall()
+            print(
+                f"join fan-out query   {len(exported):>8} rows {time.perf_counter() - start:8.3f}s"
+            )
+
+        db.con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Synthetic, but realistically shaped, Filmweb data for the benchmarks
+"""
+
+import random
+
+from backup.data import (
+    Cast,
+    Country,
+    Director,
+    Genre,
+    Movie,
+    MovieRating,
+    UserDetails,
+    UserRating,
+)
+
+
+def generate_movies(count: int, seed: int = 42) -> list[Movie]:
+    rng = random.Random(seed)
+
+    genres = list(Genre(id, f"genre {id}") for id in range(1, 40))
+    directors = list(Director(id, f"director {id}") for id in range(1, count // 4 + 2))
+    cast = list(Cast(id, f"cast {id}") for id in range(1, count * 2 + 2))
+    countries = list(Country(id, f"c{id}") for id in range(1, 120))
+
+    return list(
+        Movie(
+            id=movie_id,
+            title=f"tytuł {movie_id}",
+            originalTitle=f"title {movie_id}",
+            internationalTitle=None if movie_id % 3 else f"int title {movie_id}",
+            year=rng.randint(1920, 2024),
+            genres=rng.sample(genres, rng.randint(1, 3)),
+            duration=rng.randint(70, 200),
+            directors=rng.sample(directors, rng.randint(1, 2)),
+            cast=rng.sample(cast, rng.randint(5, 15)),
+            countries=rng.sample(countries, rng.randint(1, 3)),
+        )
+        for movie_id in range(1, count + 1)
+    )
+
+
+def generate_movie_ratings(movies: list[Movie], seed: int = 42) -> list[MovieRating]:
+    rng = random.Random(seed)
+
+    return list(
+        MovieRating(
+            movie.id,
+            rng.randint(10, 100000),
+            round(rng.uniform(1, 10), 2),
+            rng.randint(0, 10000),
+            *(rng.randint(0, 10000) for _ in range(10)),
+        )
+        for movie in movies
+    )
+
+
+def generate_users(count: int) -> list[UserDetails]:
+    return list(UserDetails(id, f"user{id}", None) for id in range(1, count + 1))
+
+
+def generate_ratings(
+    movies: list[Movie], per_user: int, seed: int = 42
+) -> list[UserRating]:
+    rng = random.Random(seed)
+
+    return list(
+        UserRating(
+            movie.id,
+            rng.randint(1, 10),
+            rng.random() < 0.05,
+            rng.randint(20000101, 20241231),
+        )
+        for movie in rng.sample(movies, min(per_user, len(movies)))
+    )
@@ -1,7 +1,10 @@
+import asyncio
 import logging
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 
 from backup.backup import FilmwebBackup
+from backup.db import PROFILES
+from backup.export import EXPORT_FORMATS
 from backup.utils.logging import RotatingFileOnStartHandler
 
 
@@ -33,6 +36,20 @@ def setup_logging(level=logging.DEBUG, log_file="logs/app.log") -> logging.Logge
     return logger
 
 
+def positive_float(value: str) -> float:
+    number = float(value)
+    if number <= 0:
+        raise ArgumentTypeError(f"must be greater than 0, got {value}")
+    return number
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 def parse_args(args: list[str] | None = None) -> Namespace:
     """Define CLI parameters"""
 
@@ -59,6 +76,111 @@ def parse_args(args: list[str] | None = None) -> Namespace:
         help="Should export user details incl. friends",
         action="store_true",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of movies fetched concurrently",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        help="Use the asyncio client to fetch the data",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="Maximum number of requests in flight when using --async",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help="Fetch only the new votes, with a full sync once a week",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Number of pages of ratings requested ahead during a full sync",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--rate",
+        help="Maximum number of requests per second for each endpoint",
+        type=positive_float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--burst",
+        help="Number of requests that can be sent at once above the --rate",
+        type=positive_int,
+        default=5,
+    )
+    parser.add_argument(
+        "--pool-size",
+        help="Maximum number of kept-alive connections to Filmweb",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--force-export",
+        help="Export also the users with no changes since their last export",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--token-cache",
+        help="File keeping the JWT token between the runs",
+        default=".filmweb-jwt.json",
+    )
+    parser.add_argument(
+        "--no-token-cache",
+        help="Fetch a new JWT token on every run instead of caching it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--response-cache",
+        help="File keeping the movie details responses to revalidate them with the server",
+        default=".filmweb-cache.db",
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        help="Maximum size of the response cache in MB",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--no-response-cache",
+        help="Always download the full responses instead of caching them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--format",
+        help="Format of the exported files, 'columnar' is 'parquet' when pyarrow is installed and 'fwcol' otherwise",
+        dest="export_format",
+        choices=list(EXPORT_FORMATS.keys()),
+        default="csv",
+    )
+    parser.add_argument(
+        "--export-processes",
+        help="Number of processes exporting the users in parallel with --extended-export",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of fetched movies written to the database in a single transaction",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--db-profile",
+        help="SQLite durability and memory settings, 'bulk-load' is the fastest but unsafe on a power loss",
+        choices=list(PROFILES.keys()),
+        default="safe",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -80,18 +202,41 @@ def main(argv: list[str] | None = None) -> int:
         log_level = logging.INFO
     logger = setup_logging(level=log_level)
 
+    filmweb = None
     try:
-        filmweb = FilmwebBackup.from_secret(args.token)
-        user = filmweb.backup()
+        filmweb = FilmwebBackup.from_secret(
+            args.token,
+            pool_size=args.pool_size,
+            jobs=args.jobs,
+            use_async=args.use_async,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            burst=args.burst,
+            prefetch=args.prefetch,
+            incremental=args.incremental,
+            batch_size=args.batch_size,
+            db_profile=args.db_profile,
+            export_format=args.export_format,
+            token_cache=None if args.no_token_cache else args.token_cache,
+            response_cache=None if args.no_response_cache else args.response_cache,
+            response_cache_size=args.response_cache_size * 1024 * 1024,
+        )
+        if args.use_async:
+            user = asyncio.run(filmweb.backup_async())
+        else:
+            user = filmweb.backup()
 
         if args.export or args.extended_export:
             if args.extended_export:
-                filmweb.export_all()
+                filmweb.export_all(args.force_export, args.export_processes)
             else:
-                filmweb.export(user)
+                filmweb.export(user, args.force_export)
     except Exception as e:
         logger.error(e, stack_info=True)
         return 1
+    finally:
+        if filmweb is not None:
+            filmweb.close()
 
     return 0
 
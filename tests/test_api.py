@@ -1,24 +1,32 @@
+import os
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, Mock, call, patch
 
 import requests
 
 from backup.api import FilmwebAPI, FilmwebError
+from backup.cache import NOT_MODIFIED, ResponseCache
 from backup.data import (
     Cast,
     Country,
     Director,
     Genre,
     Movie,
+    MovieNotModified,
     MovieRating,
     UserDetails,
     UserRating,
     UserSimilarity,
 )
+from backup.token import TokenCache, decode_expiry
+from tests.test_token import make_jwt
 
 
 class TestFilmwebAPI(unittest.TestCase):
-    @patch("backup.api.requests.post")
+    @patch("backup.api.requests.Session.post")
     def setUp(self, mock_requests: Mock):
         mock_response = MagicMock()
         mock_response.cookies.get.return_value = "jwt"
@@ -26,7 +34,7 @@ class TestFilmwebAPI(unittest.TestCase):
 
         self.api = FilmwebAPI("secret")
 
-    @patch("backup.api.requests.post")
+    @patch("backup.api.requests.Session.post")
     def test_fetch_token(self, mock_requests: Mock):
         # given
         mock_response = MagicMock()
@@ -47,7 +55,34 @@ class TestFilmwebAPI(unittest.TestCase):
             timeout=10,
         )
 
-    @patch("backup.api.requests.get")
+    @patch("backup.api.requests.Session.post")
+    def test_session_pool_size(self, mock_requests: Mock):
+        # given
+        mock_response = MagicMock()
+        mock_response.cookies.get.return_value = "jwt"
+        mock_requests.return_value = mock_response
+
+        # when
+        api = FilmwebAPI("secret", pool_size=4)
+        # then
+        adapter = api.session.get_adapter("https://www.filmweb.pl/api/v1/jwt")
+        self.assertEqual(adapter._pool_maxsize, 4)
+        # and
+        self.assertIs(api.session.get_adapter("https://example.com"), adapter)
+
+    def test_connection_stats(self):
+        # given
+        adapter = self.api.session.get_adapter("https://www.filmweb.pl")
+        pool = adapter.poolmanager.connection_from_url("https://www.filmweb.pl")
+        pool.num_requests = 10
+        pool.num_connections = 2
+
+        # when
+        result = self.api.connection_stats()
+        # then
+        self.assertEqual(result, (10, 2))
+
+    @patch("backup.api.requests.Session.get")
     def test_fetch_fails(self, mock_requests: Mock):
         # given
         mock_response = MagicMock()
@@ -70,7 +105,7 @@ class TestFilmwebAPI(unittest.TestCase):
         # and
         mock_requests.assert_called_once()
 
-    @patch("backup.api.requests.get")
+    @patch("backup.api.requests.Session.get")
     @patch("backup.api.FilmwebAPI.fetch_token")
     def test_fetch_fails_updates_jwt_token(
         self, mock_fetch_token: Mock, mock_requests: Mock
@@ -113,7 +148,226 @@ class TestFilmwebAPI(unittest.TestCase):
         # and
         mock_fetch_token.assert_called_once()
 
-    @patch("backup.api.requests.get")
+    @patch("backup.api.requests.Session.post")
+    def test_cached_token(self, mock_requests: Mock):
+        # given
+        token = make_jwt(time.time() + 3600)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = TokenCache("secret", os.path.join(tmp_dir, "jwt.json"))
+            cache.save(token)
+
+            # when
+            api = FilmwebAPI("secret", token_cache=cache)
+        # then
+        self.assertEqual(api.__token__, token)
+        mock_requests.assert_not_called()
+
+    @patch("backup.api.requests.Session.post")
+    def test_token_cached_after_fetch(self, mock_requests: Mock):
+        # given
+        token = make_jwt(time.time() + 3600)
+        mock_response = MagicMock()
+        mock_response.cookies.get.return_value = token
+        mock_requests.return_value = mock_response
+        # and
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = TokenCache("secret", os.path.join(tmp_dir, "jwt.json"))
+            cache.save(make_jwt(time.time() - 10))
+
+            # when
+            api = FilmwebAPI("secret", token_cache=cache)
+            # then
+            self.assertEqual(api.__token__, token)
+            self.assertEqual(cache.load().token, token)
+            mock_requests.assert_called_once()
+
+    @patch("backup.api.requests.Session.get")
+    @patch("backup.api.FilmwebAPI.fetch_token")
+    def test_token_refreshed_before_expiry(
+        self, mock_fetch_token: Mock, mock_requests: Mock
+    ):
+        # given
+        expiring_token = make_jwt(time.time() + 30)
+        new_token = make_jwt(time.time() + 3600)
+        self.api.__token__ = expiring_token
+        self.api.token_expires_at = decode_expiry(expiring_token)
+        # and
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch_token():
+            started.set()
+            release.wait(5)
+            return new_token
+
+        mock_fetch_token.side_effect = fetch_token
+        mock_requests.return_value.status_code = 200
+        mock_requests.return_value.json.return_value = {}
+
+        # when
+        for _ in range(3):
+            self.api.fetch("/test", True)
+        # then
+        self.assertTrue(started.wait(5))
+        self.assertEqual(
+            list(
+                call.kwargs["cookies"]["JWT"] for call in mock_requests.call_args_list
+            ),
+            [expiring_token] * 3,
+        )
+
+        # when
+        release.set()
+        self.api.token_refresher.join(5)
+        self.api.fetch("/test", True)
+        # then
+        self.assertEqual(mock_requests.call_args.kwargs["cookies"]["JWT"], new_token)
+        mock_fetch_token.assert_called_once()
+
+    @patch("backup.api.requests.Session.get")
+    @patch("backup.api.FilmwebAPI.fetch_token")
+    def test_expired_token_refreshed_before_request(
+        self, mock_fetch_token: Mock, mock_requests: Mock
+    ):
+        # given
+        expired_token = make_jwt(time.time() - 10)
+        new_token = make_jwt(time.time() + 3600)
+        self.api.__token__ = expired_token
+        self.api.token_expires_at = decode_expiry(expired_token)
+        mock_fetch_token.return_value = new_token
+        mock_requests.return_value.status_code = 200
+        mock_requests.return_value.json.return_value = {}
+
+        # when
+        self.api.fetch("/test", True)
+        # then
+        self.assertEqual(mock_requests.call_args.kwargs["cookies"]["JWT"], new_token)
+        mock_fetch_token.assert_called_once()
+
+    @patch("backup.api.requests.Session.get")
+    def test_fetch_revalidates_cached_response(self, mock_requests: Mock):
+        # given
+        ok_response = MagicMock()
+        ok_response.status_code = 200
+        ok_response.headers = {"ETag": '"v1"'}
+        ok_response.content = b'{"year": 2000}'
+        ok_response.json.return_value = {"year": 2000}
+        not_modified_response = MagicMock()
+        not_modified_response.status_code = 304
+        mock_requests.side_effect = [
+            ok_response,
+            not_modified_response,
+            not_modified_response,
+        ]
+        # and
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.api.response_cache = ResponseCache(os.path.join(tmp_dir, "cache.db"))
+
+            # when
+            first = self.api.fetch("/film/1/preview")
+            second = self.api.fetch("/film/1/preview")
+            third = self.api.fetch("/film/1/preview", if_modified=True)
+            # then
+            self.assertEqual(first, {"year": 2000})
+            self.assertEqual(second, {"year": 2000})
+            self.assertIs(third, NOT_MODIFIED)
+            # and
+            self.assertEqual(
+                list(call.kwargs["headers"] for call in mock_requests.call_args_list),
+                [
+                    {"X-Locale": "pl_PL"},
+                    {"X-Locale": "pl_PL", "If-None-Match": '"v1"'},
+                    {"X-Locale": "pl_PL", "If-None-Match": '"v1"'},
+                ],
+            )
+            self.assertEqual(self.api.response_cache.hits, 2)
+            self.assertEqual(self.api.response_cache.bytes_saved, 28)
+            self.api.response_cache.close()
+
+    @patch("backup.api.requests.Session.get")
+    def test_fetch_authenticated_not_cached(self, mock_requests: Mock):
+        # given
+        mock_requests.return_value.status_code = 200
+        mock_requests.return_value.headers = {"ETag": '"v1"'}
+        mock_requests.return_value.json.return_value = []
+        # and
+        self.api.response_cache = MagicMock()
+
+        # when
+        self.api.fetch("/logged/info", True)
+        # then
+        self.api.response_cache.prepare.assert_not_called()
+        self.api.response_cache.on_response.assert_not_called()
+
+    @patch("backup.api.FilmwebAPI.fetch")
+    def test_fetch_movie_details_if_modified(self, mock_fetch: Mock):
+        # given
+        mock_fetch.return_value = NOT_MODIFIED
+
+        # when
+        result = self.api.fetch_movie_details_if_modified(1)
+        # then
+        self.assertEqual(result, MovieNotModified(1))
+        mock_fetch.assert_called_once_with("/film/1/preview", if_modified=True)
+
+    @patch("backup.api.time.sleep")
+    @patch("backup.api.requests.Session.get")
+    def test_fetch_throttled_retries(self, mock_requests: Mock, mock_sleep: Mock):
+        # given
+        throttled_response = MagicMock()
+        throttled_response.status_code = 429
+        throttled_response.headers = {"Retry-After": "2"}
+        throttled_response.raise_for_status.side_effect = requests.HTTPError(
+            "429 Client Error: Too Many Requests"
+        )
+        ok_response = MagicMock()
+        ok_response.status_code = 200
+        ok_response.json.return_value = {"status": "ok"}
+        mock_requests.side_effect = [throttled_response, ok_response]
+        # and
+        self.api.rate_limiter = MagicMock()
+        self.api.rate_limiter.effective_rate.return_value = 2.5
+
+        # when
+        result = self.api.fetch("/test")
+        # then
+        self.assertEqual(result, {"status": "ok"})
+        self.assertEqual(mock_requests.call_count, 2)
+        # and
+        self.api.rate_limiter.on_throttle.assert_called_once_with(
+            "https://www.filmweb.pl/api/v1/test", 2.0
+        )
+        self.api.rate_limiter.on_success.assert_called_once_with(
+            "https://www.filmweb.pl/api/v1/test"
+        )
+        mock_sleep.assert_called_once()
+
+    @patch("backup.api.time.sleep")
+    @patch("backup.api.requests.Session.get")
+    def test_fetch_throttled_fails_after_retries(
+        self, mock_requests: Mock, mock_sleep: Mock
+    ):
+        # given
+        mock_response = MagicMock()
+        mock_response.status_code = 503
+        mock_response.headers = {}
+        mock_response.raise_for_status.side_effect = requests.HTTPError(
+            "503 Server Error: Service Unavailable"
+        )
+        mock_requests.return_value = mock_response
+
+        # expect
+        with self.assertRaises(FilmwebError) as e:
+            self.api.fetch("/test")
+        self.assertEqual(e.exception.args[0], "Failed to fetch data after 5 retries!")
+        # and
+        self.assertEqual(mock_requests.call_count, 5)
+        self.assertEqual(mock_sleep.call_count, 4)
+        # and
+        delays = list(c.args[0] for c in mock_sleep.call_args_list)
+        self.assertEqual(delays, sorted(delays))
+
+    @patch("backup.api.requests.Session.get")
     def test_fetch_204(self, mock_requests: Mock):
         # given
         mock_response = MagicMock()
@@ -133,7 +387,7 @@ class TestFilmwebAPI(unittest.TestCase):
             timeout=10,
         )
 
-    @patch("backup.api.requests.get")
+    @patch("backup.api.requests.Session.get")
     def test_fetch_succeeds(self, mock_requests: Mock):
         # given
         mock_response = MagicMock()
@@ -233,6 +487,45 @@ class TestFilmwebAPI(unittest.TestCase):
             ]
         )
 
+    @patch("backup.api.FilmwebAPI.fetch")
+    def test_iter_pages_prefetch(self, mock_fetch: Mock):
+        # given
+        pages = {
+            "/test?page=1": [1, 2],
+            "/test?page=2": [3],
+            "/test?page=3": [4],
+        }
+        mock_fetch.side_effect = lambda path, _: pages.get(path, [])
+
+        # when
+        result = list(self.api.iter_pages("/test", prefetch=3))
+        # then
+        self.assertEqual(result, [[1, 2], [3], [4]])
+        # and
+        requested = set(c.args[0] for c in mock_fetch.call_args_list)
+        self.assertIn("/test?page=4", requested)
+        self.assertLessEqual(len(requested), 6)
+
+    @patch("backup.api.FilmwebAPI.fetch")
+    def test_iter_user_ratings(self, mock_fetch: Mock):
+        # given
+        mock_fetch.side_effect = [
+            [{"rate": 8, "entity": 743825, "favorite": True, "viewDate": 20231220}],
+            [{"rate": 7, "entity": 875717, "viewDate": 20221218}],
+            [],
+        ]
+
+        # when
+        result = self.api.iter_user_ratings()
+        # then
+        self.assertEqual(next(result), [UserRating(743825, 8, True, 20231220)])
+        self.assertEqual(mock_fetch.call_count, 1)
+        # and
+        self.assertEqual(next(result), [UserRating(875717, 7, False, 20221218)])
+        self.assertEqual(mock_fetch.call_count, 2)
+        # and
+        self.assertIsNone(next(result, None))
+
     @patch("backup.api.FilmwebAPI.fetch")
     def test_fetch_user_friends(self, mock_fetch: Mock):
         # given
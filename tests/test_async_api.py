@@ -0,0 +1,319 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock, Mock, call, patch
+
+import aiohttp
+
+from backup.api import FilmwebError
+from backup.async_api import AsyncFilmwebAPI
+from backup.cache import NOT_MODIFIED, ResponseCache
+from backup.data import Movie, UserRating
+from backup.ratelimit import RateLimiter
+from backup.token import TokenCache, decode_expiry
+from tests.test_token import make_jwt
+
+
+def mock_response(status: int = 200, json=None, error: Exception | None = None):
+    response = MagicMock()
+    response.status = status
+    response.json = AsyncMock(return_value=json)
+    response.read = AsyncMock(return_value=b"")
+    if error is not None:
+        response.raise_for_status.side_effect = error
+    # and
+    context = MagicMock()
+    context.__aenter__.return_value = response
+    return context
+
+
+def response_error(status: int) -> aiohttp.ClientResponseError:
+    return aiohttp.ClientResponseError(MagicMock(), (), status=status)
+
+
+class TestAsyncFilmwebAPI(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.api = AsyncFilmwebAPI(
+            "secret", concurrency=2, rate_limiter=RateLimiter(1000, 1000)
+        )
+        self.api.session = MagicMock()
+        self.api.__token__ = "jwt"
+
+    async def test_fetch_token(self):
+        # given
+        jwt = MagicMock()
+        jwt.value = "new-jwt"
+        context = mock_response()
+        context.__aenter__.return_value.cookies.get.return_value = jwt
+        self.api.session.post.return_value = context
+
+        # when
+        result = await self.api.fetch_token()
+        # then
+        self.assertEqual(result, "new-jwt")
+        # and
+        self.api.session.post.assert_called_once_with(
+            "https://www.filmweb.pl/api/v1/jwt", cookies={"_artuser_prm": "secret"}
+        )
+
+    async def test_fetch_succeeds(self):
+        # given
+        self.api.session.get.return_value = mock_response(json={"status": "ok"})
+
+        # when
+        result = await self.api.fetch("/test", True)
+        # then
+        self.assertEqual(result, {"status": "ok"})
+        # and
+        self.api.session.get.assert_called_once_with(
+            "https://www.filmweb.pl/api/v1/test",
+            headers={"X-Locale": "pl_PL"},
+            cookies={"JWT": "jwt"},
+        )
+
+    async def test_fetch_revalidates_cached_response(self):
+        # given
+        ok_response = mock_response(json={"year": 2000})
+        ok_response.__aenter__.return_value.headers = {"ETag": '"v1"'}
+        ok_response.__aenter__.return_value.read = AsyncMock(
+            return_value=b'{"year": 2000}'
+        )
+        self.api.session.get.side_effect = [
+            ok_response,
+            mock_response(status=304),
+            mock_response(status=304),
+        ]
+        # and
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.api.response_cache = ResponseCache(os.path.join(tmp_dir, "cache.db"))
+
+            # when
+            with patch(
+                "backup.async_api.asyncio.to_thread", wraps=asyncio.to_thread
+            ) as mock_to_thread:
+                first = await self.api.fetch("/film/1/preview")
+                second = await self.api.fetch("/film/1/preview")
+                third = await self.api.fetch("/film/1/preview", if_modified=True)
+            # then
+            self.assertEqual(first, {"year": 2000})
+            self.assertEqual(second, {"year": 2000})
+            self.assertIs(third, NOT_MODIFIED)
+            # and
+            self.assertEqual(mock_to_thread.call_count, 6)
+            self.assertEqual(
+                self.api.session.get.call_args.kwargs["headers"],
+                {"X-Locale": "pl_PL", "If-None-Match": '"v1"'},
+            )
+            self.api.response_cache.close()
+
+    async def test_fetch_204(self):
+        # given
+        self.api.session.get.return_value = mock_response(status=204)
+
+        # when
+        result = await self.api.fetch("/test", True)
+        # then
+        self.assertIsNone(result)
+
+    async def test_fetch_fails(self):
+        # given
+        self.api.session.get.return_value = mock_response(
+            status=401, error=response_error(401)
+        )
+
+        # expect
+        with self.assertRaises(FilmwebError) as e:
+            await self.api.fetch("/test", True)
+        self.assertEqual(
+            e.exception.args[0], "Failed to fetch data due to unhandled exception"
+        )
+        # and
+        self.api.session.get.assert_called_once()
+
+    @patch("backup.async_api.AsyncFilmwebAPI.fetch_token")
+    async def test_fetch_fails_updates_jwt_token(self, mock_fetch_token: Mock):
+        # given
+        self.api.session.get.side_effect = [
+            mock_response(status=400, error=response_error(400)),
+            mock_response(json={"status": "ok"}),
+        ]
+        # and
+        mock_fetch_token.return_value = "new-jwt"
+
+        # when
+        result = await self.api.fetch("/test", True)
+        # then
+        self.assertEqual(result, {"status": "ok"})
+        # and
+        self.api.session.get.assert_has_calls(
+            [
+                call(
+                    "https://www.filmweb.pl/api/v1/test",
+                    headers={"X-Locale": "pl_PL"},
+                    cookies={"JWT": "jwt"},
+                ),
+                call(
+                    "https://www.filmweb.pl/api/v1/test",
+                    headers={"X-Locale": "pl_PL"},
+                    cookies={"JWT": "new-jwt"},
+                ),
+            ]
+        )
+        mock_fetch_token.assert_called_once()
+
+    @patch("backup.async_api.AsyncFilmwebAPI.fetch_token")
+    async def test_refresh_token_single_flight(self, mock_fetch_token: Mock):
+        # given
+        mock_fetch_token.return_value = "new-jwt"
+
+        # when
+        await asyncio.gather(*(self.api.refresh_token("jwt") for _ in range(5)))
+        # then
+        self.assertEqual(self.api.__token__, "new-jwt")
+        mock_fetch_token.assert_called_once()
+
+    @patch("backup.async_api.AsyncFilmwebAPI.fetch_token")
+    async def test_token_refreshed_before_expiry(self, mock_fetch_token: Mock):
+        # given
+        expiring_token = make_jwt(time.time() + 30)
+        new_token = make_jwt(time.time() + 3600)
+        self.api.__token__ = expiring_token
+        self.api.token_expires_at = decode_expiry(expiring_token)
+        mock_fetch_token.return_value = new_token
+
+        # when
+        tokens = await asyncio.gather(*(self.api.current_token() for _ in range(5)))
+        # then
+        self.assertEqual(tokens, [expiring_token] * 5)
+
+        # when
+        await self.api.token_refresher
+        # then
+        self.assertEqual(await self.api.current_token(), new_token)
+        mock_fetch_token.assert_called_once()
+
+    @patch("backup.async_api.AsyncFilmwebAPI.fetch_token")
+    async def test_open_with_cached_token(self, mock_fetch_token: Mock):
+        # given
+        token = make_jwt(time.time() + 3600)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = TokenCache("secret", os.path.join(tmp_dir, "jwt.json"))
+            cache.save(token)
+            api = AsyncFilmwebAPI("secret", token_cache=cache)
+
+            # when
+            await api.open()
+            await api.close()
+        # then
+        self.assertEqual(api.__token__, token)
+        mock_fetch_token.assert_not_called()
+
+    async def test_fetch_respects_concurrency(self):
+        # given
+        in_flight = 0
+        max_in_flight = 0
+
+        async def enter():
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0)
+            return response
+
+        async def leave(*args):
+            nonlocal in_flight
+            in_flight -= 1
+
+        response = MagicMock()
+        response.status = 200
+        response.json = AsyncMock(return_value={})
+        context = MagicMock()
+        context.__aenter__.side_effect = enter
+        context.__aexit__.side_effect = leave
+        self.api.session.get.return_value = context
+
+        # when
+        await asyncio.gather(*(self.api.fetch(f"/test/{i}") for i in range(10)))
+        # then
+        self.assertEqual(self.api.session.get.call_count, 10)
+        self.assertEqual(max_in_flight, 2)
+
+    @patch("backup.async_api.AsyncFilmwebAPI.fetch")
+    async def test_fetch_user_ratings(self, mock_fetch: Mock):
+        # given
+        mock_fetch.side_effect = [
+            [{"rate": 8, "entity": 743825, "favorite": True, "viewDate": 20231220}],
+            [{"rate": 8, "entity": 875717, "viewDate": 20221218}],
+            [],
+        ]
+
+        # when
+        result = await self.api.fetch_user_ratings()
+        # then
+        self.assertEqual(
+            result,
+            [
+                UserRating(743825, 8, True, 20231220),
+                UserRating(875717, 8, False, 20221218),
+            ],
+        )
+        # and
+        mock_fetch.assert_has_calls(
+            [
+                call("/logged/vote/title/film?page=1", True),
+                call("/logged/vote/title/film?page=2", True),
+                call("/logged/vote/title/film?page=3", True),
+            ]
+        )
+
+    @patch("backup.async_api.AsyncFilmwebAPI.fetch")
+    async def test_iter_pages_prefetch(self, mock_fetch: Mock):
+        # given
+        pages = {
+            "/test?page=1": [1, 2],
+            "/test?page=2": [3],
+            "/test?page=3": [4],
+        }
+        mock_fetch.side_effect = lambda path, _: pages.get(path, [])
+
+        # when
+        result = [page async for page in self.api.iter_pages("/test", prefetch=3)]
+        # then
+        self.assertEqual(result, [[1, 2], [3], [4]])
+        # and
+        requested = list(c.args[0] for c in mock_fetch.call_args_list)
+        self.assertEqual(
+            requested[:3], ["/test?page=1", "/test?page=2", "/test?page=3"]
+        )
+        self.assertLessEqual(len(requested), 6)
+
+    @patch("backup.async_api.AsyncFilmwebAPI.fetch")
+    async def test_fetch_movie_details(self, mock_fetch: Mock):
+        # given
+        mock_fetch.return_value = {
+            "year": 2006,
+            "originalTitle": {"title": "Renaissance"},
+        }
+
+        # when
+        result = await self.api.fetch_movie_details(743825)
+        # then
+        self.assertEqual(
+            result,
+            Movie(
+                id=743825,
+                title=None,
+                originalTitle="Renaissance",
+                internationalTitle=None,
+                year=2006,
+                genres=[],
+                directors=[],
+                duration=None,
+                countries=[],
+                cast=[],
+            ),
+        )
+        # and
+        mock_fetch.assert_called_once_with("/film/743825/preview")
@@ -1,11 +1,43 @@
+import json
+import os
+import tempfile
+import threading
 import unittest
-from unittest.mock import MagicMock, Mock, call, patch
+from unittest.mock import AsyncMock, MagicMock, Mock, call, patch
 
 from backup.backup import FilmwebBackup
-from backup.data import UserDetails
+from backup.data import Genre, Movie, MovieNotModified, UserDetails, UserRating
+from backup.db import FilmwebDB, MovieRatingDetails, RatingChanges
 
 
 class TestFilmwebBackup(unittest.TestCase):
+    @patch("backup.backup.FilmwebAPI")
+    @patch("backup.backup.FilmwebDB")
+    def test_from_secret_pool_size(self, _: Mock, mock_api: Mock):
+        # when
+        FilmwebBackup.from_secret(
+            "secret",
+            pool_size=10,
+            jobs=10,
+            prefetch=4,
+            token_cache=None,
+            response_cache=None,
+        )
+        # then
+        self.assertEqual(mock_api.call_args.args[1], 14)
+
+    def test_close(self):
+        # given
+        mock_api = MagicMock()
+        mock_db = MagicMock()
+        backup = FilmwebBackup(mock_db, mock_api)
+
+        # when
+        backup.close()
+        # then
+        mock_api.response_cache.close.assert_called_once()
+        mock_db.con.close.assert_called_once()
+
     def test_backup_movie_no_update_needed(self):
         # given
         mock_api = MagicMock()
@@ -51,8 +83,7 @@ class TestFilmwebBackup(unittest.TestCase):
         mock_api.fetch_movie_rating.assert_called_once_with(1)
         mock_db.upsert_movie_rating.assert_called_once_with(mock_movie_rating)
 
-    @patch("backup.backup.FilmwebBackup.backup_movie")
-    def test_backup_user(self, mock_backup_movie: Mock):
+    def test_backup_user(self):
         # given
         mock_user_details = MagicMock()
         mock_user_details.id = 1
@@ -67,14 +98,23 @@ class TestFilmwebBackup(unittest.TestCase):
         mock_movie_rating = MagicMock()
         # and
         mock_api = MagicMock()
-        mock_api.fetch_user_ratings.return_value = [mock_user_rating]
+        mock_api.iter_user_ratings.return_value = (
+            page for page in [[mock_user_rating]]
+        )
         mock_api.fetch_user_friends.return_value = [mock_friend_details]
         mock_api.fetch_user_friends_similarities.return_value = [mock_user_similarity]
-        mock_api.fetch_friend_ratings.return_value = [mock_friend_rating]
+        mock_api.iter_friend_ratings.return_value = (
+            page for page in [[mock_friend_rating]]
+        )
         mock_api.fetch_movie_rating.return_value = mock_movie_rating
         # and
         mock_db = MagicMock()
+        mock_db.upsert_ratings_batch.return_value = RatingChanges(1, 0, 0)
+        mock_db.remove_ratings_except.return_value = RatingChanges(0, 0, 1)
         mock_db.should_update_user.return_value = True
+        mock_db.should_update_users.return_value = {mock_friend_details.id}
+        mock_db.should_update_movies.return_value = set()
+        mock_db.should_update_movie_ratings.return_value = {2}
         # and
         backup = FilmwebBackup(mock_db, mock_api)
 
@@ -82,28 +122,650 @@ class TestFilmwebBackup(unittest.TestCase):
         backup.backup_user(mock_user_details)
         # then
         mock_api.fetch_user_friends_similarities.assert_called_once()
-        mock_api.fetch_user_ratings.assert_called_once()
-        mock_api.fetch_friend_ratings.assert_called_once_with(mock_friend_details.name)
-        # and
-        mock_db.should_update_user.assert_has_calls(
-            [call(mock_user_details.id, 60), call(mock_friend_details.id)]
+        mock_api.iter_user_ratings.assert_called_once_with(4)
+        mock_api.iter_friend_ratings.assert_called_once_with(
+            mock_friend_details.name, 4
         )
+        # and
+        mock_db.should_update_user.assert_called_once_with(mock_user_details.id, 60)
+        mock_db.should_update_users.assert_called_once_with([mock_friend_details.id])
         mock_db.upsert_user_details.assert_has_calls(
             [call(mock_friend_details), call(mock_user_details)]
         )
-        mock_db.upsert_ratings.assert_has_calls(
+        mock_db.upsert_ratings_batch.assert_has_calls(
             [
                 call(mock_user_details.id, [mock_user_rating]),
                 call(mock_friend_details.id, [mock_friend_rating]),
             ]
         )
+        mock_db.remove_ratings_except.assert_has_calls(
+            [
+                call(mock_user_details.id, {mock_user_rating.movie_id}),
+                call(mock_friend_details.id, {mock_friend_rating.movie_id}),
+            ]
+        )
         mock_db.upsert_similar_users.assert_called_once_with(
             mock_user_details.id, [mock_user_similarity]
         )
         # and
-        mock_backup_movie.assert_has_calls(
+        mock_db.should_update_movies.assert_called_once_with([2])
+        mock_api.fetch_movie_details.assert_not_called()
+        mock_api.fetch_movie_rating.assert_called_once_with(2)
+        self.assertEqual(stored(mock_db.upsert_movie_ratings), [])
+        # and
+        backup.flush()
+        self.assertEqual(stored(mock_db.upsert_movie_ratings), [mock_movie_rating])
+        self.assertEqual(backup.duplicate_visits, 1)
+
+    def test_backup_user_up_to_date(self):
+        # given
+        mock_api = MagicMock()
+        mock_db = MagicMock()
+        mock_db.should_update_user.return_value = False
+        backup = FilmwebBackup(mock_db, mock_api)
+
+        # when
+        backup.backup_user(UserDetails(1, "janedoe", None))
+        # then
+        mock_db.should_update_user.assert_called_once_with(1, 60)
+        mock_api.iter_user_ratings.assert_not_called()
+        mock_db.upsert_user_details.assert_not_called()
+
+    @patch("backup.backup.FilmwebBackup.backup_movies")
+    def test_backup_ratings_streams_pages(self, mock_backup_movies: Mock):
+        # given
+        first_page = [
+            UserRating(1, 8, False, 20200101),
+            UserRating(2, 7, True, 20200102),
+        ]
+        second_page = [UserRating(3, 6, False, 20200103)]
+        # and
+        mock_db = MagicMock()
+        mock_db.upsert_ratings_batch.return_value = RatingChanges(1, 0, 0)
+        mock_db.remove_ratings_except.return_value = RatingChanges(0, 0, 1)
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock())
+
+        # when
+        with self.assertLogs("filmweb.backup") as logs:
+            backup.backup_ratings(1, (page for page in [first_page, second_page]))
+        # then
+        self.assertIn(
+            "Ratings of user id 1: 2 inserted, 0 updated, 1 removed", logs.output[-1]
+        )
+        mock_db.upsert_ratings_batch.assert_has_calls(
+            [call(1, first_page), call(1, second_page)]
+        )
+        mock_backup_movies.assert_has_calls([call([1, 2]), call([3])])
+        mock_db.remove_ratings_except.assert_called_once_with(1, {1, 2, 3})
+
+    def test_backup_ratings_without_ratings(self):
+        # given
+        mock_db = MagicMock()
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock())
+
+        # when
+        backup.backup_ratings(1, (page for page in []))
+        # then
+        mock_db.upsert_ratings_batch.assert_not_called()
+        mock_db.remove_ratings_except.assert_not_called()
+
+    @patch("backup.backup.FilmwebBackup.backup_movies")
+    def test_backup_ratings_incremental_stops_on_unchanged_page(
+        self, mock_backup_movies: Mock
+    ):
+        # given
+        first_page = [
+            UserRating(1, 8, False, 20200101),
+            UserRating(2, 7, True, 20200102),
+        ]
+        second_page = [UserRating(3, 6, False, 20200103)]
+        third_page = [UserRating(4, 5, False, 20200104)]
+        # and
+        mock_db = MagicMock()
+        mock_db.upsert_ratings_batch.return_value = RatingChanges(1, 0, 0)
+        mock_db.remove_ratings_except.return_value = RatingChanges(0, 0, 1)
+        mock_db.should_full_sync_ratings.return_value = False
+        mock_db.get_stored_ratings.return_value = {
+            1: UserRating(1, 8, False, 20200101),
+            2: UserRating(2, 5, True, 20200102),
+            3: UserRating(3, 6, False, 20200103),
+            4: UserRating(4, 5, False, 20200104),
+        }
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock(), incremental=True)
+
+        # when
+        backup.backup_ratings(
+            1, (page for page in [first_page, second_page, third_page])
+        )
+        # then
+        mock_db.upsert_ratings_batch.assert_has_calls(
+            [call(1, [UserRating(2, 7, True, 20200102)]), call(1, [])]
+        )
+        self.assertEqual(mock_db.upsert_ratings_batch.call_count, 2)
+        # and
+        mock_backup_movies.assert_has_calls([call([1, 2]), call([3]), call([4])])
+        mock_db.remove_ratings_except.assert_not_called()
+        mock_db.mark_full_sync_ratings.assert_not_called()
+
+    @patch("backup.backup.FilmwebBackup.backup_movies")
+    def test_backup_ratings_incremental_full_sync(self, mock_backup_movies: Mock):
+        # given
+        first_page = [UserRating(1, 8, False, 20200101)]
+        second_page = [UserRating(2, 7, True, 20200102)]
+        # and
+        mock_db = MagicMock()
+        mock_db.should_full_sync_ratings.return_value = True
+        mock_db.get_stored_ratings.return_value = {
+            1: UserRating(1, 8, False, 20200101),
+            2: UserRating(2, 7, True, 20200102),
+            3: UserRating(3, 6, False, 20200103),
+        }
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock(), incremental=True)
+
+        # when
+        backup.backup_ratings(1, (page for page in [first_page, second_page]))
+        # then
+        mock_db.should_full_sync_ratings.assert_called_once_with(1, 604800)
+        mock_backup_movies.assert_has_calls([call([1]), call([2])])
+        mock_db.remove_ratings_except.assert_called_once_with(1, {1, 2})
+        mock_db.mark_full_sync_ratings.assert_called_once_with(1)
+
+    @patch("backup.backup.FilmwebBackup.backup_ratings")
+    def test_backup_user_incremental_prefetch(self, mock_backup_ratings: Mock):
+        # given
+        mock_user_details = UserDetails(1, "janedoe", None)
+        mock_friend_details = UserDetails(3, "johndoe", None)
+        # and
+        mock_api = MagicMock()
+        mock_api.fetch_user_friends.return_value = [mock_friend_details]
+        # and
+        mock_db = MagicMock()
+        mock_db.should_update_user.return_value = True
+        mock_db.should_update_users.return_value = {mock_friend_details.id}
+        mock_db.should_full_sync_ratings.side_effect = lambda user_id, ttl: (
+            user_id == mock_friend_details.id
+        )
+        # and
+        backup = FilmwebBackup(mock_db, mock_api, incremental=True, prefetch=4)
+
+        # when
+        backup.backup_user(mock_user_details)
+        # then
+        mock_api.iter_user_ratings.assert_called_once_with(1)
+        mock_api.iter_friend_ratings.assert_called_once_with("johndoe", 4)
+        # and
+        mock_backup_ratings.assert_has_calls(
             [
-                call(mock_user_rating.movie_id),
-                call(mock_friend_rating.movie_id),
+                call(1, mock_api.iter_user_ratings.return_value, False),
+                call(3, mock_api.iter_friend_ratings.return_value, True),
             ]
         )
+        self.assertEqual(mock_db.should_full_sync_ratings.call_count, 2)
+
+    def test_backup_movies_once_per_run(self):
+        # given
+        mock_api = MagicMock()
+        # and
+        mock_db = MagicMock()
+        mock_db.should_update_movies.side_effect = lambda movie_ids: set(movie_ids)
+        mock_db.should_update_movie_ratings.return_value = set()
+        # and
+        backup = FilmwebBackup(mock_db, mock_api)
+
+        # when
+        backup.backup_movies([1, 2, 2])
+        backup.backup_movies([2, 3, 1])
+        backup.backup_movies([3])
+        # then
+        mock_db.should_update_movies.assert_has_calls([call([1, 2]), call([3])])
+        self.assertEqual(mock_db.should_update_movies.call_count, 2)
+        mock_api.fetch_movie_details.assert_has_calls([call(1), call(2), call(3)])
+        self.assertEqual(mock_api.fetch_movie_details.call_count, 3)
+        self.assertEqual(backup.duplicate_visits, 4)
+
+    def test_backup_movies_revalidates_stored_movies(self):
+        # given
+        mock_api = MagicMock()
+        mock_api.fetch_movie_details.return_value = "movie 1"
+        mock_api.fetch_movie_details_if_modified.return_value = MovieNotModified(2)
+        # and
+        mock_db = MagicMock()
+        mock_db.should_update_movies.return_value = {1, 2}
+        mock_db.get_stored_movies.return_value = {2, 3}
+        mock_db.should_update_movie_ratings.return_value = set()
+        # and
+        backup = FilmwebBackup(mock_db, mock_api)
+
+        # when
+        backup.backup_movies([1, 2, 3])
+        backup.flush()
+        # then
+        mock_db.get_stored_movies.assert_called_once_with({1, 2})
+        mock_api.fetch_movie_details.assert_called_once_with(1)
+        mock_api.fetch_movie_details_if_modified.assert_called_once_with(2)
+        # and
+        mock_db.upsert_movies.assert_called_once_with(["movie 1"])
+        mock_db.touch_movies.assert_called_once_with([2])
+
+    def test_store_movies_in_batches(self):
+        # given
+        mock_db = MagicMock()
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock(), batch_size=3)
+
+        # when
+        backup.store_movie("movie 1")
+        backup.store_movie_rating("rating 1")
+        # then
+        mock_db.upsert_movies.assert_not_called()
+
+        # when
+        backup.store_movie("movie 2")
+        # then
+        mock_db.upsert_movies.assert_called_once_with(["movie 1", "movie 2"])
+        mock_db.upsert_movie_ratings.assert_called_once_with(["rating 1"])
+
+    @patch("backup.backup.time.monotonic")
+    def test_store_movies_flushed_after_interval(self, mock_monotonic: Mock):
+        # given
+        mock_monotonic.return_value = 100.0
+        mock_db = MagicMock()
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock(), flush_interval=5.0)
+
+        # when
+        backup.store_movie("movie 1")
+        # then
+        mock_db.upsert_movies.assert_not_called()
+
+        # when
+        mock_monotonic.return_value = 105.0
+        backup.store_movie_rating("rating 1")
+        # then
+        mock_db.upsert_movies.assert_called_once_with(["movie 1"])
+        mock_db.upsert_movie_ratings.assert_called_once_with(["rating 1"])
+
+    def chdir_to_tmp_dir(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        os.mkdir(os.path.join(tmp_dir.name, "export"))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+
+    def test_export(self):
+        # given
+        self.chdir_to_tmp_dir()
+        # and
+        mock_db = MagicMock()
+        mock_db.iter_user_rating.return_value = (
+            MovieRatingDetails(
+                f"title {movie_id}",
+                None,
+                None,
+                2000,
+                None,
+                8,
+                False,
+                20200101,
+                None,
+                "genre",
+                None,
+                None,
+                "pl",
+            )
+            for movie_id in [1, 2]
+        )
+        mock_db.get_export_fingerprints.return_value = {1: (2, "2|2020-01-01 00:00:00")}
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock())
+
+        # when
+        with self.assertLogs("filmweb.backup") as logs:
+            backup.export(UserDetails(1, "jane doe", None))
+        # then
+        mock_db.iter_user_rating.assert_called_once_with(1)
+        with open("export/filmweb-jane_doe.csv") as csv_file:
+            self.assertEqual(
+                csv_file.read().splitlines(),
+                [
+                    "original_title,international_title,title,year,rate,my_rate,favorite,view_date,duration,genres,directors,cast,countries",
+                    "title 1,,,2000,,8,False,20200101,,genre,,,pl",
+                    "title 2,,,2000,,8,False,20200101,,genre,,,pl",
+                ],
+            )
+        self.assertIn("Exported information about 2 movies", logs.output[0])
+
+        # when
+        with self.assertLogs("filmweb.backup") as logs:
+            backup.export(UserDetails(1, "jane doe", None))
+        # then
+        mock_db.iter_user_rating.assert_called_once_with(1)
+        self.assertIn("Export for user jane doe is up-to-date", logs.output[0])
+
+        # when
+        mock_db.get_export_fingerprints.return_value = {1: (2, "2|2020-01-02 00:00:00")}
+        backup.export(UserDetails(1, "jane doe", None))
+        # then
+        self.assertEqual(mock_db.iter_user_rating.call_count, 2)
+
+    def test_export_format(self):
+        # given
+        self.chdir_to_tmp_dir()
+        # and
+        mock_db = MagicMock()
+        mock_db.iter_user_rating.return_value = iter(
+            [
+                MovieRatingDetails(
+                    "title 1",
+                    None,
+                    None,
+                    2000,
+                    7.5,
+                    8,
+                    True,
+                    20200101,
+                    120,
+                    None,
+                    None,
+                    None,
+                    "pl",
+                )
+            ]
+        )
+        mock_db.get_export_fingerprints.return_value = {1: (1, "1|2020-01-01 00:00:00")}
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock(), export_format="jsonl")
+
+        # when
+        backup.export(UserDetails(1, "jane doe", None))
+        # then
+        with open("export/filmweb-jane_doe.jsonl") as jsonl_file:
+            self.assertEqual(
+                [json.loads(line) for line in jsonl_file],
+                [
+                    {
+                        "original_title": "title 1",
+                        "international_title": None,
+                        "title": None,
+                        "year": 2000,
+                        "rate": 7.5,
+                        "my_rate": 8,
+                        "favorite": True,
+                        "view_date": 20200101,
+                        "duration": 120,
+                        "genres": None,
+                        "directors": None,
+                        "cast": None,
+                        "countries": "pl",
+                    }
+                ],
+            )
+        with open("export/manifest.json") as manifest_file:
+            self.assertEqual(
+                json.load(manifest_file)["1"]["file"], "export/filmweb-jane_doe.jsonl"
+            )
+
+    def test_export_all(self):
+        # given
+        self.chdir_to_tmp_dir()
+        # and
+        rating = MovieRatingDetails(
+            "title",
+            None,
+            None,
+            2000,
+            None,
+            8,
+            False,
+            20200101,
+            None,
+            None,
+            None,
+            None,
+            None,
+        )
+        # and
+        mock_db = MagicMock()
+        mock_db.get_all_users.return_value = [
+            UserDetails(1, "janedoe", None),
+            UserDetails(2, "johndoe", None),
+            UserDetails(3, "jimdoe", None),
+        ]
+        mock_db.iter_all_user_ratings.return_value = iter(
+            [(1, rating), (1, rating), (3, rating), (4, rating)]
+        )
+        mock_db.get_export_fingerprints.return_value = {
+            1: (2, "2"),
+            2: (0, "0"),
+            3: (1, "1"),
+        }
+        # and
+        backup = FilmwebBackup(mock_db, MagicMock())
+
+        # when
+        backup.export_all()
+        # then
+        mock_db.iter_all_user_ratings.assert_called_once_with([1, 2, 3])
+        mock_db.iter_user_rating.assert_not_called()
+        # and
+        for name, rows in [("janedoe", 2), ("johndoe", 0), ("jimdoe", 1)]:
+            with open(f"export/filmweb-{name}.csv") as csv_file:
+                self.assertEqual(len(csv_file.read().splitlines()), rows + 1)
+        self.assertCountEqual(
+            os.listdir("export"),
+            [
+                "filmweb-janedoe.csv",
+                "filmweb-johndoe.csv",
+                "filmweb-jimdoe.csv",
+                "manifest.json",
+            ],
+        )
+
+        # when
+        mock_db.get_export_fingerprints.return_value = {
+            1: (2, "2"),
+            2: (1, "1"),
+            3: (1, "1"),
+        }
+        mock_db.iter_all_user_ratings.return_value = iter([(2, rating)])
+        backup.export_all()
+        # then
+        mock_db.iter_all_user_ratings.assert_called_with([2])
+        with open("export/filmweb-johndoe.csv") as csv_file:
+            self.assertEqual(len(csv_file.read().splitlines()), 2)
+
+        # when
+        backup.export_all()
+        # then
+        self.assertEqual(mock_db.iter_all_user_ratings.call_count, 2)
+
+    def test_export_all_in_processes(self):
+        # given
+        self.chdir_to_tmp_dir()
+        # and
+        db = FilmwebDB("filmweb.db")
+        db.upsert_movies(
+            list(
+                Movie(
+                    id=movie_id,
+                    title=None,
+                    originalTitle=f"title {movie_id}",
+                    internationalTitle=None,
+                    year=2000,
+                    genres=[Genre(1, "genre")],
+                    directors=[],
+                    duration=None,
+                    countries=[],
+                    cast=[],
+                )
+                for movie_id in [1, 2, 3]
+            )
+        )
+        for user_id, name, movie_ids in [
+            (1, "janedoe", [1, 2, 3]),
+            (2, "johndoe", [2]),
+            (3, "jimdoe", []),
+        ]:
+            db.upsert_user_details(UserDetails(user_id, name, None))
+            db.upsert_ratings_batch(
+                user_id,
+                list(
+                    UserRating(movie_id, 5, False, 20200101) for movie_id in movie_ids
+                ),
+            )
+        # and
+        backup = FilmwebBackup(db, MagicMock())
+
+        # when
+        with self.assertLogs("filmweb.backup") as logs:
+            backup.export_all(processes=2)
+        # then
+        for name, rows in [("janedoe", 3), ("johndoe", 1), ("jimdoe", 0)]:
+            with open(f"export/filmweb-{name}.csv") as csv_file:
+                self.assertEqual(len(csv_file.read().splitlines()), rows + 1)
+        with open("export/manifest.json") as manifest_file:
+            self.assertCountEqual(json.load(manifest_file).keys(), ["1", "2", "3"])
+        self.assertIn(
+            "Exported information about 4 movies for all 3 users", logs.output[-1]
+        )
+        self.assertIn("in 2 processes", logs.output[-1])
+        self.assertIn(
+            "INFO:filmweb.backup:Exported information about 3 movies for user janedoe",
+            logs.output,
+        )
+
+        # when
+        with self.assertLogs("filmweb.backup") as logs:
+            backup.export_all(processes=2)
+        # then
+        self.assertIn("3 were up-to-date", logs.output[-1])
+
+    def test_backup_movies_concurrently(self):
+        # given
+        main_thread = threading.get_ident()
+        writer_threads = set()
+        # and
+        mock_api = MagicMock()
+        mock_api.fetch_movie_details.side_effect = lambda movie_id: f"movie {movie_id}"
+        mock_api.fetch_movie_rating.side_effect = lambda movie_id: f"rating {movie_id}"
+        # and
+        mock_db = MagicMock()
+        mock_db.should_update_movies.return_value = {1, 3, 4, 5}
+        mock_db.should_update_movie_ratings.return_value = {1, 2, 3, 4, 5}
+        mock_db.upsert_movies.side_effect = lambda _: writer_threads.add(
+            threading.get_ident()
+        )
+        mock_db.upsert_movie_ratings.side_effect = lambda _: writer_threads.add(
+            threading.get_ident()
+        )
+        # and
+        backup = FilmwebBackup(mock_db, mock_api, jobs=4, batch_size=3)
+
+        # when
+        backup.backup_movies([1, 2, 3, 4, 5])
+        backup.flush()
+        # then
+        self.assertEqual(mock_api.fetch_movie_details.call_count, 4)
+        self.assertEqual(mock_api.fetch_movie_rating.call_count, 5)
+        # and
+        self.assertCountEqual(
+            stored(mock_db.upsert_movies),
+            ["movie 1", "movie 3", "movie 4", "movie 5"],
+        )
+        self.assertCountEqual(
+            stored(mock_db.upsert_movie_ratings),
+            [f"rating {movie_id}" for movie_id in [1, 2, 3, 4, 5]],
+        )
+        # and
+        self.assertEqual(writer_threads, {main_thread})
+
+
+def stored(upsert: Mock) -> list:
+    return list(item for args in upsert.call_args_list for item in args.args[0])
+
+
+async def async_iter(items: list):
+    for item in items:
+        yield item
+
+
+class TestFilmwebBackupAsync(unittest.IsolatedAsyncioTestCase):
+    async def test_backup_user_async_up_to_date(self):
+        # given
+        mock_api = AsyncMock()
+        mock_api.iter_user_ratings = Mock()
+        mock_db = MagicMock()
+        mock_db.should_update_user.return_value = False
+        backup = FilmwebBackup(mock_db, mock_api)
+
+        # when
+        await backup.backup_user_async(UserDetails(1, "janedoe", None))
+        # then
+        mock_db.should_update_user.assert_called_once_with(1, 60)
+        mock_api.iter_user_ratings.assert_not_called()
+        mock_db.upsert_user_details.assert_not_called()
+
+    async def test_backup_user_async(self):
+        # given
+        mock_user_details = UserDetails(1, "janedoe", None)
+        mock_friend_details = UserDetails(3, "johndoe", None)
+        mock_user_rating = MagicMock()
+        mock_user_rating.movie_id = 2
+        mock_friend_rating = MagicMock()
+        mock_friend_rating.movie_id = 4
+        mock_other_friend_rating = MagicMock()
+        mock_other_friend_rating.movie_id = 2
+        mock_user_similarity = MagicMock()
+        # and
+        mock_api = AsyncMock()
+        mock_api.iter_user_ratings = Mock(return_value=async_iter([[mock_user_rating]]))
+        mock_api.fetch_user_friends.return_value = [mock_friend_details]
+        mock_api.fetch_user_friends_similarities.return_value = [mock_user_similarity]
+        mock_api.iter_friend_ratings = Mock(
+            return_value=async_iter([[mock_friend_rating, mock_other_friend_rating]])
+        )
+        mock_api.fetch_movie_details.side_effect = lambda movie_id: f"movie {movie_id}"
+        mock_api.fetch_movie_rating.side_effect = lambda movie_id: f"rating {movie_id}"
+        # and
+        mock_db = MagicMock()
+        mock_db.upsert_ratings_batch.return_value = RatingChanges(1, 0, 0)
+        mock_db.remove_ratings_except.return_value = RatingChanges(0, 0, 1)
+        mock_db.should_update_user.return_value = True
+        mock_db.should_update_users.return_value = {3}
+        mock_db.should_update_movies.side_effect = lambda movie_ids: set(movie_ids)
+        mock_db.should_update_movie_ratings.side_effect = lambda movie_ids: set(
+            movie_ids
+        )
+        # and
+        backup = FilmwebBackup(mock_db, mock_api)
+
+        # when
+        await backup.backup_user_async(mock_user_details)
+        backup.flush()
+        # then
+        mock_api.iter_friend_ratings.assert_called_once_with("johndoe", 4)
+        # and
+        mock_db.upsert_ratings_batch.assert_has_calls(
+            [
+                call(mock_user_details.id, [mock_user_rating]),
+                call(
+                    mock_friend_details.id,
+                    [mock_friend_rating, mock_other_friend_rating],
+                ),
+            ]
+        )
+        self.assertCountEqual(stored(mock_db.upsert_movies), ["movie 2", "movie 4"])
+        self.assertEqual(backup.duplicate_visits, 1)
+        self.assertCountEqual(
+            stored(mock_db.upsert_movie_ratings), ["rating 2", "rating 4"]
+        )
+        mock_db.upsert_similar_users.assert_called_once_with(
+            mock_user_details.id, [mock_user_similarity]
+        )
+        mock_db.upsert_user_details.assert_has_calls(
+            [call(mock_friend_details), call(mock_user_details)]
+        )
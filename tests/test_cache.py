@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+
+from backup.api import FilmwebError
+from backup.cache import NOT_MODIFIED, CachedResponse, ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.name = os.path.join(self.tmp_dir.name, "cache.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_put_and_get(self):
+        # given
+        cache = ResponseCache(self.name)
+        key = ResponseCache.key("/film/1/preview", "pl_PL")
+        body = b'{"year": 2000}' * 100
+
+        # when
+        cache.put(key, '"etag"', "Wed, 21 Oct 2015 07:28:00 GMT", body)
+        cache.close()
+        # then
+        cache = ResponseCache(self.name)
+        cached = cache.get(key)
+        self.assertEqual(cached.body, body)
+        self.assertEqual(
+            cached.validators(),
+            {
+                "If-None-Match": '"etag"',
+                "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+            },
+        )
+        # and
+        self.assertLess(cache.size, len(body))
+        self.assertIsNone(cache.get(ResponseCache.key("/film/1/preview", "en_US")))
+
+    def test_put_without_validators(self):
+        # given
+        cache = ResponseCache(self.name)
+        key = ResponseCache.key("/film/1/preview", "pl_PL")
+
+        # when
+        cache.put(key, None, None, b"{}")
+        # then
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.misses, 1)
+
+    def test_not_modified_stats(self):
+        # given
+        cache = ResponseCache(self.name)
+        cached = CachedResponse('"etag"', None, b"12345")
+
+        # when
+        cache.put("a", '"etag"', None, b"12345")
+        cache.not_modified("a", cached)
+        cache.not_modified("a", cached)
+        cache.not_modified("a", cached)
+        # then
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        self.assertEqual(cache.hit_ratio(), 0.75)
+        self.assertEqual(cache.bytes_saved, 15)
+        # and
+        with self.assertLogs("filmweb.cache") as logs:
+            cache.log_stats()
+        self.assertIn("hit ratio 75.0%", logs.output[0])
+
+    def test_prepare_and_on_response(self):
+        # given
+        cache = ResponseCache(self.name)
+        headers = {"X-Locale": "pl_PL"}
+
+        # when
+        lookup = cache.prepare("/film/1/preview", "pl_PL", headers)
+        result = cache.on_response(lookup, 200, {"ETag": '"v1"'}, b'{"year": 2000}')
+        # then
+        self.assertIsNone(lookup.cached)
+        self.assertEqual(headers, {"X-Locale": "pl_PL"})
+        self.assertEqual(result, {"year": 2000})
+
+        # when
+        headers = {"X-Locale": "pl_PL"}
+        lookup = cache.prepare("/film/1/preview", "pl_PL", headers)
+        # then
+        self.assertEqual(headers, {"X-Locale": "pl_PL", "If-None-Match": '"v1"'})
+        self.assertEqual(cache.on_response(lookup, 304, {}, b""), {"year": 2000})
+        self.assertIs(cache.on_response(lookup, 304, {}, b"", True), NOT_MODIFIED)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_on_response_not_modified_without_cached_response(self):
+        # given
+        cache = ResponseCache(self.name)
+        lookup = cache.prepare("/film/1/preview", "pl_PL", {})
+
+        # expect
+        with self.assertRaises(FilmwebError):
+            cache.on_response(lookup, 304, {}, b"")
+        self.assertIsNone(cache.get(lookup.key))
+
+    def test_evicts_least_recently_used(self):
+        # given
+        cache = ResponseCache(self.name, max_size=250)
+        body = os.urandom(100)
+        cache.put("a", '"a"', None, body)
+        cache.put("b", '"b"', None, body)
+        cache.not_modified("a", cache.get("a"))
+
+        # when
+        cache.put("c", '"c"', None, body)
+        # then
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertLessEqual(cache.size, 250)
@@ -1,21 +1,55 @@
 import datetime
+import os
+import sqlite3
+import tempfile
 import unittest
+from unittest.mock import patch
 
-from backup.data import Cast, Country, Director, Genre, Movie, MovieRating, UserDetails
-from backup.db import FilmwebDB
+from backup.data import (
+    Cast,
+    Country,
+    Director,
+    Genre,
+    Movie,
+    MovieRating,
+    UserDetails,
+    UserRating,
+)
+from backup.db import (
+    DELETE_RATINGS_EXCEPT,
+    DELETE_SIMILAR_USERS,
+    MIGRATIONS,
+    PROFILES,
+    SELECT_STORED_RATINGS,
+    SELECT_USER_RATING,
+    DBProfile,
+    FilmwebDB,
+    MovieRatingDetails,
+    RatingChanges,
+)
 
 
 class TestFilmwebDB(unittest.TestCase):
     def setUp(self):
         self.db = FilmwebDB("file::memory:")
 
-    def test_trigger_movie_inserted_without_last_updated(self):
+    def test_upsert_movie_inserted_sets_timestamps(self):
         # given
         cur = self.db.con.cursor()
-        cur.execute(
-            "INSERT INTO movie (id, orig_title, year) VALUES (1, 'title', 2000);"
+        self.db.upsert_movie(
+            Movie(
+                id=1,
+                title=None,
+                originalTitle="title",
+                internationalTitle=None,
+                year=2000,
+                genres=[],
+                directors=[],
+                duration=None,
+                countries=[],
+                cast=[],
+            )
         )
-        self.db.con.commit()
 
         # when
         result = cur.execute(
@@ -33,7 +67,7 @@ class TestFilmwebDB(unittest.TestCase):
             datetime.timedelta(minutes=1),
         )
 
-    def test_trigger_movie_inserted_with_last_updated(self):
+    def test_explicit_timestamps_movie_inserted_with_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -49,7 +83,7 @@ class TestFilmwebDB(unittest.TestCase):
         self.assertIsNone(result[0])
         self.assertEqual(result[1], "2000-01-01 00:00:00")
 
-    def test_trigger_movie_updated_without_last_updated(self):
+    def test_upsert_movie_updated_sets_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -57,8 +91,20 @@ class TestFilmwebDB(unittest.TestCase):
         )
         self.db.con.commit()
         # and
-        cur.execute("UPDATE movie SET title = 'title' WHERE id = 1;")
-        self.db.con.commit()
+        self.db.upsert_movie(
+            Movie(
+                id=1,
+                title=None,
+                originalTitle="title",
+                internationalTitle=None,
+                year=2000,
+                genres=[],
+                directors=[],
+                duration=None,
+                countries=[],
+                cast=[],
+            )
+        )
 
         # when
         result = cur.execute(
@@ -72,7 +118,7 @@ class TestFilmwebDB(unittest.TestCase):
             datetime.timedelta(minutes=1),
         )
 
-    def test_trigger_movie_updated_with_last_updated(self):
+    def test_explicit_timestamps_movie_updated_with_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -93,13 +139,12 @@ class TestFilmwebDB(unittest.TestCase):
         self.assertEqual(result[0], "2000-01-01 00:00:00")
         self.assertEqual(result[1], "2001-01-01 00:00:00")
 
-    def test_trigger_movie_rating_inserted_without_last_updated(self):
+    def test_upsert_movie_rating_inserted_sets_timestamps(self):
         # given
         cur = self.db.con.cursor()
-        cur.execute(
-            "INSERT INTO movie_rating (movie_id, count, rate, countWantToSee, countVote1, countVote2, countVote3, countVote4, countVote5, countVote6, countVote7, countVote8, countVote9, countVote10) VALUES (1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);"
+        self.db.upsert_movie_rating(
+            MovieRating(1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
         )
-        self.db.con.commit()
 
         # when
         result = cur.execute(
@@ -117,7 +162,7 @@ class TestFilmwebDB(unittest.TestCase):
             datetime.timedelta(minutes=1),
         )
 
-    def test_trigger_movie_rating_inserted_with_last_updated(self):
+    def test_explicit_timestamps_movie_rating_inserted_with_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -133,7 +178,7 @@ class TestFilmwebDB(unittest.TestCase):
         self.assertIsNone(result[0])
         self.assertEqual(result[1], "2000-01-01 00:00:00")
 
-    def test_trigger_movie_rating_updated_without_last_updated(self):
+    def test_upsert_movie_rating_updated_sets_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -141,8 +186,9 @@ class TestFilmwebDB(unittest.TestCase):
         )
         self.db.con.commit()
         # and
-        cur.execute("UPDATE movie_rating SET countWantToSee = 1 WHERE movie_id = 1;")
-        self.db.con.commit()
+        self.db.upsert_movie_rating(
+            MovieRating(1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        )
 
         # when
         result = cur.execute(
@@ -156,7 +202,7 @@ class TestFilmwebDB(unittest.TestCase):
             datetime.timedelta(minutes=1),
         )
 
-    def test_trigger_movie_rating_updated_with_last_updated(self):
+    def test_explicit_timestamps_movie_rating_updated_with_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -177,11 +223,10 @@ class TestFilmwebDB(unittest.TestCase):
         self.assertEqual(result[0], "2000-01-01 00:00:00")
         self.assertEqual(result[1], "2001-01-01 00:00:00")
 
-    def test_trigger_user_inserted_without_last_updated(self):
+    def test_upsert_user_details_inserted_sets_timestamps(self):
         # given
         cur = self.db.con.cursor()
-        cur.execute("INSERT INTO user (id, name) VALUES (1, 'johndoe');")
-        self.db.con.commit()
+        self.db.upsert_user_details(UserDetails(1, "johndoe", None))
 
         # when
         result = cur.execute(
@@ -199,7 +244,7 @@ class TestFilmwebDB(unittest.TestCase):
             datetime.timedelta(minutes=1),
         )
 
-    def test_trigger_user_inserted_with_last_updated(self):
+    def test_explicit_timestamps_user_inserted_with_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -215,7 +260,7 @@ class TestFilmwebDB(unittest.TestCase):
         self.assertIsNone(result[0])
         self.assertEqual(result[1], "2000-01-01 00:00:00")
 
-    def test_trigger_user_updated_without_last_updated(self):
+    def test_upsert_user_details_updated_sets_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -223,8 +268,7 @@ class TestFilmwebDB(unittest.TestCase):
         )
         self.db.con.commit()
         # and
-        cur.execute("UPDATE user SET name = 'janedoe' WHERE id = 1;")
-        self.db.con.commit()
+        self.db.upsert_user_details(UserDetails(1, "janedoe", None))
 
         # when
         result = cur.execute(
@@ -238,7 +282,7 @@ class TestFilmwebDB(unittest.TestCase):
             datetime.timedelta(minutes=1),
         )
 
-    def test_trigger_user_updated_with_last_updated(self):
+    def test_explicit_timestamps_user_updated_with_last_updated(self):
         # given
         cur = self.db.con.cursor()
         cur.execute(
@@ -269,7 +313,7 @@ class TestFilmwebDB(unittest.TestCase):
         # given
         cur = self.db.con.cursor()
         cur.execute(
-            "INSERT INTO movie (id, orig_title, year) VALUES (1, 'John Doe Movie', 2020);"
+            "INSERT INTO movie (id, last_updated, orig_title, year) VALUES (1, datetime(), 'John Doe Movie', 2020);"
         )
         self.db.con.commit()
 
@@ -301,7 +345,7 @@ class TestFilmwebDB(unittest.TestCase):
         # given
         cur = self.db.con.cursor()
         cur.execute(
-            "INSERT INTO movie_rating (movie_id, count, rate, countWantToSee, countVote1, countVote2, countVote3, countVote4, countVote5, countVote6, countVote7, countVote8, countVote9, countVote10) VALUES (1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);"
+            "INSERT INTO movie_rating (movie_id, last_updated, count, rate, countWantToSee, countVote1, countVote2, countVote3, countVote4, countVote5, countVote6, countVote7, countVote8, countVote9, countVote10) VALUES (1, datetime(), 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);"
         )
         self.db.con.commit()
 
@@ -332,7 +376,9 @@ class TestFilmwebDB(unittest.TestCase):
     def test_should_update_user_fresh_user(self):
         # given
         cur = self.db.con.cursor()
-        cur.execute("INSERT INTO user (id, name) VALUES (1, 'johndoe');")
+        cur.execute(
+            "INSERT INTO user (id, last_updated, name) VALUES (1, datetime(), 'johndoe');"
+        )
         self.db.con.commit()
 
         # when
@@ -353,6 +399,65 @@ class TestFilmwebDB(unittest.TestCase):
         # then
         self.assertTrue(result)
 
+    def test_should_update_movies(self):
+        # given
+        cur = self.db.con.cursor()
+        cur.execute(
+            "INSERT INTO movie (id, last_updated, orig_title, year) VALUES (1, datetime(), 'John Doe Movie', 2020), (2, datetime('now', '-8 days'), 'Jane Doe Movie', 2020);"
+        )
+
+        # expect
+        self.assertEqual(self.db.should_update_movies([1, 2, 3]), {2, 3})
+        self.assertEqual(self.db.should_update_movies([1, 2], 9 * 24 * 60 * 60), set())
+        self.assertEqual(self.db.should_update_movies([]), set())
+
+    def test_get_stored_movies(self):
+        # given
+        cur = self.db.con.cursor()
+        cur.execute(
+            "INSERT INTO movie (id, last_updated, orig_title, year) VALUES (1, datetime(), 'John Doe Movie', 2020), (2, datetime('now', '-8 days'), 'Jane Doe Movie', 2020);"
+        )
+
+        # expect
+        self.assertEqual(self.db.get_stored_movies([2, 3]), {2})
+        self.assertEqual(self.db.get_stored_movies([]), set())
+
+    def test_touch_movies(self):
+        # given
+        cur = self.db.con.cursor()
+        cur.execute(
+            "INSERT INTO movie (id, last_updated, orig_title, year) VALUES (1, datetime('now', '-8 days'), 'John Doe Movie', 2020), (2, datetime('now', '-8 days'), 'Jane Doe Movie', 2020);"
+        )
+
+        # when
+        self.db.touch_movies([1, 3])
+        # then
+        self.assertEqual(self.db.should_update_movies([1, 2, 3]), {2, 3})
+        self.assertEqual(
+            cur.execute("SELECT orig_title FROM movie WHERE id = 1;").fetchone(),
+            ("John Doe Movie",),
+        )
+
+    def test_should_update_movie_ratings(self):
+        # given
+        cur = self.db.con.cursor()
+        cur.execute(
+            "INSERT INTO movie_rating (movie_id, last_updated, count, rate, countWantToSee, countVote1, countVote2, countVote3, countVote4, countVote5, countVote6, countVote7, countVote8, countVote9, countVote10) VALUES (1, datetime(), 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0), (2, datetime('now', '-2 days'), 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);"
+        )
+
+        # expect
+        self.assertEqual(self.db.should_update_movie_ratings([1, 2, 3]), {2, 3})
+
+    def test_should_update_users(self):
+        # given
+        cur = self.db.con.cursor()
+        cur.execute(
+            "INSERT INTO user (id, name, last_updated) VALUES (1, 'fresh', datetime()), (2, 'stale', datetime('now', '-2 hours'));"
+        )
+
+        # expect
+        self.assertEqual(self.db.should_update_users([1, 2, 3]), {2, 3})
+
     def test_upsert_user_details_on_conflict(self):
         # given
         cur = self.db.con.cursor()
@@ -688,3 +793,848 @@ class TestFilmwebDB(unittest.TestCase):
             len(cur.execute("SELECT c.code FROM country c;").fetchall()), 2
         )
         self.assertEqual(len(cur.execute("SELECT c.name FROM cast c ;").fetchall()), 2)
+
+    def test_upsert_movies(self):
+        # given
+        cur = self.db.con.cursor()
+        self.db.upsert_movie(
+            Movie(
+                id=1,
+                title=None,
+                originalTitle="title",
+                internationalTitle=None,
+                year=2006,
+                genres=[Genre(1, "genre"), Genre(2, "other genre")],
+                directors=[Director(1, "director")],
+                duration=96,
+                countries=[Country(1, "country")],
+                cast=[Cast(1, "cast")],
+            )
+        )
+
+        # when
+        self.db.upsert_movies(
+            [
+                Movie(
+                    id=1,
+                    title="tytul",
+                    originalTitle="title",
+                    internationalTitle=None,
+                    year=2006,
+                    genres=[Genre(2, "other genre")],
+                    directors=[Director(1, "director")],
+                    duration=96,
+                    countries=[Country(1, "country")],
+                    cast=[Cast(1, "cast"), Cast(2, "other cast")],
+                ),
+                Movie(
+                    id=2,
+                    title=None,
+                    originalTitle="other title",
+                    internationalTitle=None,
+                    year=2010,
+                    genres=[Genre(1, "genre")],
+                    directors=[Director(2, "other director")],
+                    duration=120,
+                    countries=[Country(2, "other country")],
+                    cast=[Cast(2, "other cast")],
+                ),
+            ]
+        )
+        # then
+        self.assertEqual(
+            cur.execute("SELECT id, title FROM movie ORDER BY id;").fetchall(),
+            [(1, "tytul"), (2, None)],
+        )
+        self.assertEqual(
+            cur.execute(
+                "SELECT movie_id, genre_id FROM movie_genres ORDER BY movie_id, genre_id;"
+            ).fetchall(),
+            [(1, 2), (2, 1)],
+        )
+        self.assertEqual(
+            cur.execute(
+                "SELECT movie_id, cast_id FROM movie_cast ORDER BY movie_id, cast_id;"
+            ).fetchall(),
+            [(1, 1), (1, 2), (2, 2)],
+        )
+        self.assertEqual(
+            cur.execute(
+                "SELECT movie_id, director_id FROM movie_directors ORDER BY movie_id;"
+            ).fetchall(),
+            [(1, 1), (2, 2)],
+        )
+        self.assertEqual(
+            cur.execute(
+                "SELECT movie_id, country_id FROM movie_countries ORDER BY movie_id;"
+            ).fetchall(),
+            [(1, 1), (2, 2)],
+        )
+
+    def test_upsert_movies_skips_known_dimensions(self):
+        # given
+        movie = Movie(
+            id=1,
+            title=None,
+            originalTitle="title",
+            internationalTitle=None,
+            year=2006,
+            genres=[Genre(1, "genre"), Genre(2, "other genre")],
+            directors=[Director(1, "director")],
+            duration=96,
+            countries=[Country(1, "pl")],
+            cast=[Cast(1, "cast")],
+        )
+        self.db.upsert_movies([movie])
+        self.assertEqual((self.db.dimension_hits, self.db.dimension_misses), (0, 5))
+
+        # when
+        movie.id = 2
+        movie.genres = [Genre(2, "other genre"), Genre(3, "new genre")]
+        self.db.upsert_movies([movie])
+        # then
+        self.assertEqual((self.db.dimension_hits, self.db.dimension_misses), (4, 6))
+        self.assertEqual(self.db.dimensions["genre"], {1, 2, 3})
+        # and
+        cur = self.db.con.cursor()
+        self.assertEqual(
+            cur.execute("SELECT id FROM genre ORDER BY id;").fetchall(),
+            [(1,), (2,), (3,)],
+        )
+        self.assertEqual(
+            cur.execute(
+                "SELECT genre_id FROM movie_genres WHERE movie_id = 2 ORDER BY genre_id;"
+            ).fetchall(),
+            [(2,), (3,)],
+        )
+
+    def test_known_dimensions_loaded_on_first_upsert(self):
+        # given
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            name = os.path.join(tmp_dir, "filmweb.db")
+            db = FilmwebDB(name)
+            db.upsert_genres([Genre(1, "genre")])
+            db.con.close()
+
+            # when
+            db = FilmwebDB(name)
+            # then
+            self.assertEqual(db.dimensions, {})
+
+            # when
+            db.upsert_genres([Genre(1, "genre"), Genre(2, "other")])
+            # then
+            self.assertEqual(db.dimensions, {"genre": {1, 2}})
+            self.assertEqual((db.dimension_hits, db.dimension_misses), (1, 1))
+            db.con.close()
+
+            # when
+            reader = FilmwebDB(name, read_only=True)
+            reader.get_stored_ratings(1)
+            # then
+            self.assertEqual(reader.dimensions, {})
+            reader.con.close()
+
+    def test_upsert_movie_ratings(self):
+        # given
+        ratings = list(
+            MovieRating(
+                movie_id=movie_id,
+                count=movie_id * 10,
+                rate=7.5,
+                countWantToSee=1,
+                countVote1=0,
+                countVote2=0,
+                countVote3=0,
+                countVote4=0,
+                countVote5=0,
+                countVote6=0,
+                countVote7=0,
+                countVote8=0,
+                countVote9=0,
+                countVote10=0,
+            )
+            for movie_id in [1, 2, 3]
+        )
+
+        # when
+        self.db.upsert_movie_ratings(ratings)
+        # then
+        cur = self.db.con.cursor()
+        self.assertEqual(
+            cur.execute(
+                "SELECT movie_id, count FROM movie_rating ORDER BY movie_id;"
+            ).fetchall(),
+            [(1, 10), (2, 20), (3, 30)],
+        )
+
+    def test_upsert_movies_unchanged_only_touched(self):
+        # given
+        movie = Movie(
+            id=1,
+            title=None,
+            originalTitle="title",
+            internationalTitle=None,
+            year=2000,
+            genres=[Genre(1, "genre")],
+            directors=[Director(1, "director")],
+            duration=None,
+            countries=[],
+            cast=[],
+        )
+        self.db.upsert_movies([movie])
+        # and
+        cur = self.db.con.cursor()
+        cur.execute(
+            "UPDATE movie SET last_updated = datetime('now', '-8 days'), orig_title = 'edited';"
+        )
+        self.db.con.commit()
+
+        # when
+        self.db.upsert_movies([movie])
+        # then
+        self.assertEqual(self.db.should_update_movies([1]), set())
+        self.assertEqual(
+            cur.execute("SELECT orig_title FROM movie WHERE id = 1;").fetchone(),
+            ("edited",),
+        )
+
+        # when
+        movie.genres = [Genre(2, "other genre")]
+        self.db.upsert_movies([movie])
+        # then
+        self.assertEqual(
+            cur.execute("SELECT orig_title FROM movie WHERE id = 1;").fetchone(),
+            ("title",),
+        )
+        self.assertEqual(
+            cur.execute(
+                "SELECT genre_id FROM movie_genres WHERE movie_id = 1;"
+            ).fetchall(),
+            [(2,)],
+        )
+
+    def test_upsert_movie_ratings_unchanged_only_touched(self):
+        # given
+        rating = MovieRating(1, 10, 7.5, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.db.upsert_movie_ratings([rating])
+        # and
+        cur = self.db.con.cursor()
+        cur.execute(
+            "UPDATE movie_rating SET last_updated = datetime('now', '-2 days'), count = 0;"
+        )
+        self.db.con.commit()
+
+        # when
+        self.db.upsert_movie_ratings([rating])
+        # then
+        self.assertEqual(self.db.should_update_movie_ratings([1]), set())
+        self.assertEqual(
+            cur.execute("SELECT count FROM movie_rating;").fetchone(), (0,)
+        )
+
+        # when
+        rating.count = 11
+        self.db.upsert_movie_ratings([rating])
+        # then
+        self.assertEqual(
+            cur.execute("SELECT count FROM movie_rating;").fetchone(), (11,)
+        )
+
+    def test_get_user_rating(self):
+        # given
+        self.db.upsert_movies(
+            [
+                Movie(
+                    id=1,
+                    title="tytul",
+                    originalTitle="title",
+                    internationalTitle=None,
+                    year=2006,
+                    genres=[Genre(1, "genre"), Genre(2, "other genre")],
+                    directors=[Director(1, "director"), Director(2, "other director")],
+                    duration=96,
+                    countries=[Country(1, "pl"), Country(2, "us")],
+                    cast=[Cast(1, "cast"), Cast(2, "other cast"), Cast(3, "cast")],
+                ),
+                Movie(
+                    id=2,
+                    title=None,
+                    originalTitle="other title",
+                    internationalTitle=None,
+                    year=2010,
+                    genres=[Genre(1, "genre")],
+                    directors=[],
+                    duration=None,
+                    countries=[],
+                    cast=[],
+                ),
+            ]
+        )
+        self.db.upsert_movie_rating(
+            MovieRating(1, 100, 7.46, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        )
+        self.db.upsert_ratings_batch(
+            1,
+            [UserRating(2, 5, False, 20200102), UserRating(1, 8, True, 20200101)],
+        )
+        self.db.upsert_ratings_batch(2, [UserRating(1, 3, False, 20200103)])
+
+        # when
+        result = self.db.get_user_rating(1)
+        # then
+        self.assertEqual(
+            result,
+            [
+                MovieRatingDetails(
+                    original_title="title",
+                    international_title=None,
+                    title="tytul",
+                    year=2006,
+                    rate=7.5,
+                    my_rate=8,
+                    favorite=True,
+                    view_date=20200101,
+                    duration=96,
+                    genres="genre,other genre",
+                    directors="director,other director",
+                    cast="cast,other cast",
+                    countries="pl,us",
+                ),
+                MovieRatingDetails(
+                    original_title="other title",
+                    international_title=None,
+                    title=None,
+                    year=2010,
+                    rate=None,
+                    my_rate=5,
+                    favorite=False,
+                    view_date=20200102,
+                    duration=None,
+                    genres="genre",
+                    directors=None,
+                    cast=None,
+                    countries=None,
+                ),
+            ],
+        )
+
+    def test_upsert_ratings(self):
+        # given
+        cur = self.db.con.cursor()
+        self.db.upsert_ratings_batch(2, [UserRating(1, 5, False, 20200101)])
+
+        # when
+        result = self.db.upsert_ratings(
+            1,
+            [
+                UserRating(1, 8, False, 20200101),
+                UserRating(2, 7, True, 20200102),
+                UserRating(3, 6, False, 20200103),
+            ],
+        )
+        # then
+        self.assertEqual(result, RatingChanges(inserted=3, updated=0, removed=0))
+
+        # when
+        result = self.db.upsert_ratings(
+            1,
+            [
+                UserRating(1, 8, False, 20200101),
+                UserRating(2, 9, True, 20200102),
+                UserRating(4, 4, False, 20200104),
+            ],
+        )
+        # then
+        self.assertEqual(result, RatingChanges(inserted=1, updated=1, removed=1))
+        self.assertEqual(
+            cur.execute(
+                "SELECT user_id, movie_id, rate FROM rating ORDER BY user_id, movie_id;"
+            ).fetchall(),
+            [(1, 1, 8), (1, 2, 9), (1, 4, 4), (2, 1, 5)],
+        )
+
+    def test_upsert_ratings_without_changes(self):
+        # given
+        ratings = [UserRating(1, 8, False, 20200101), UserRating(2, 7, True, 20200102)]
+        self.db.upsert_ratings(1, ratings)
+        total_changes = self.db.con.total_changes
+
+        # when
+        result = self.db.upsert_ratings(1, ratings)
+        # then
+        self.assertEqual(result, RatingChanges(inserted=0, updated=0, removed=0))
+        self.assertEqual(self.db.get_stored_ratings(1), {1: ratings[0], 2: ratings[1]})
+        # and
+        self.assertEqual(self.db.con.total_changes, total_changes)
+
+    def test_iter_user_rating(self):
+        # given
+        self.db.upsert_movies(
+            list(
+                Movie(
+                    id=movie_id,
+                    title=None,
+                    originalTitle=f"title {movie_id}",
+                    internationalTitle=None,
+                    year=2000,
+                    genres=[],
+                    directors=[],
+                    duration=None,
+                    countries=[],
+                    cast=[],
+                )
+                for movie_id in [1, 2, 3]
+            )
+        )
+        self.db.upsert_ratings_batch(
+            1, list(UserRating(movie_id, 5, False, 20200101) for movie_id in [3, 1, 2])
+        )
+
+        # when
+        result = self.db.iter_user_rating(1, chunk_size=2)
+        # then
+        self.assertEqual(
+            list(rating.original_title for rating in result),
+            ["title 1", "title 2", "title 3"],
+        )
+
+    def test_iter_all_user_ratings(self):
+        # given
+        self.db.upsert_movies(
+            list(
+                Movie(
+                    id=movie_id,
+                    title=None,
+                    originalTitle=f"title {movie_id}",
+                    internationalTitle=None,
+                    year=2000,
+                    genres=[Genre(1, "genre")],
+                    directors=[],
+                    duration=None,
+                    countries=[],
+                    cast=[],
+                )
+                for movie_id in [1, 2, 3]
+            )
+        )
+        self.db.upsert_ratings_batch(
+            2, list(UserRating(movie_id, 5, False, 20200101) for movie_id in [3, 1])
+        )
+        self.db.upsert_ratings_batch(1, [UserRating(2, 7, True, 20200102)])
+
+        # when
+        result = list(self.db.iter_all_user_ratings(chunk_size=2))
+        # then
+        self.assertEqual(
+            list(
+                (user_id, rating.original_title, rating.my_rate, rating.genres)
+                for user_id, rating in result
+            ),
+            [
+                (1, "title 2", 7, "genre"),
+                (2, "title 1", 5, "genre"),
+                (2, "title 3", 5, "genre"),
+            ],
+        )
+        # and
+        self.assertEqual(
+            list(
+                (user_id, rating.original_title)
+                for user_id, rating in self.db.iter_all_user_ratings([1])
+            ),
+            [(1, "title 2")],
+        )
+        # and
+        cur = self.db.con.cursor()
+        self.assertEqual(
+            cur.execute(
+                "SELECT name FROM sqlite_temp_master WHERE name = 'movie_export';"
+            ).fetchall(),
+            [],
+        )
+
+    def test_get_export_fingerprints(self):
+        # given
+        self.db.upsert_user_details(UserDetails(1, "janedoe", None))
+        self.db.upsert_user_details(UserDetails(2, "johndoe", None))
+        self.db.upsert_ratings_batch(
+            1, [UserRating(1, 8, False, 20200101), UserRating(2, 7, True, 20200102)]
+        )
+        cur = self.db.con.cursor()
+        cur.execute("UPDATE rating SET last_updated = '2000-01-01 00:00:00';")
+        fingerprints = self.db.get_export_fingerprints()
+
+        # expect
+        self.assertEqual(
+            fingerprints,
+            {
+                1: (2, "2|2000-01-01 00:00:00|None|None"),
+                2: (0, "0|None|None|None"),
+            },
+        )
+        self.assertEqual(self.db.get_export_fingerprints([2]), {2: fingerprints[2]})
+
+        # when
+        self.db.remove_ratings_except(1, [2])
+        # then
+        self.assertNotEqual(self.db.get_export_fingerprints()[1], fingerprints[1])
+
+        # when
+        fingerprints = self.db.get_export_fingerprints()
+        self.db.upsert_ratings_batch(1, [UserRating(2, 9, True, 20200102)])
+        # then
+        self.assertNotEqual(self.db.get_export_fingerprints()[1], fingerprints[1])
+
+    def test_get_export_fingerprints_unchanged_refetch(self):
+        # given
+        movie = Movie(
+            id=1,
+            title=None,
+            originalTitle="title",
+            internationalTitle=None,
+            year=2000,
+            genres=[],
+            directors=[],
+            duration=None,
+            countries=[],
+            cast=[],
+        )
+        rating = MovieRating(1, 10, 7.5, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.db.upsert_user_details(UserDetails(5, "janedoe", None))
+        self.db.upsert_ratings_batch(5, [UserRating(1, 8, False, 20200101)])
+        self.db.upsert_movies([movie])
+        self.db.upsert_movie_ratings([rating])
+        # and
+        cur = self.db.con.cursor()
+        cur.execute("UPDATE rating SET last_updated = '2000-01-01 00:00:00';")
+        for table in ["movie", "movie_rating"]:
+            cur.execute(
+                f"UPDATE {table} SET last_updated = '2000-01-01 00:00:00', content_changed_at = '2000-01-01 00:00:00';"
+            )
+        self.db.con.commit()
+        fingerprints = self.db.get_export_fingerprints([5])
+
+        # when
+        self.db.upsert_movies([movie])
+        self.db.upsert_movie_ratings([rating])
+        self.db.touch_movies([1])
+        # then
+        self.assertEqual(self.db.get_export_fingerprints([5]), fingerprints)
+
+        # when
+        rating.rate = 8.0
+        self.db.upsert_movie_ratings([rating])
+        # then
+        self.assertNotEqual(self.db.get_export_fingerprints([5]), fingerprints)
+
+    def test_upsert_ratings_batch(self):
+        # given
+        self.db.upsert_ratings_batch(
+            1,
+            [UserRating(1, 8, False, 20200101), UserRating(2, 7, True, 20200102)],
+        )
+
+        # when
+        result = self.db.upsert_ratings_batch(
+            1,
+            [UserRating(2, 9, False, 20200102), UserRating(3, 6, False, 20200103)],
+        )
+        # then
+        self.assertEqual(result, RatingChanges(inserted=1, updated=1, removed=0))
+        cur = self.db.con.cursor()
+        self.assertEqual(
+            cur.execute(
+                "SELECT movie_id, rate, favorite, view_date FROM rating WHERE user_id = 1 ORDER BY movie_id;"
+            ).fetchall(),
+            [(1, 8, 0, 20200101), (2, 9, 0, 20200102), (3, 6, 0, 20200103)],
+        )
+
+    def test_remove_ratings_except(self):
+        # given
+        self.db.upsert_ratings_batch(
+            1,
+            [UserRating(1, 8, False, 20200101), UserRating(2, 7, True, 20200102)],
+        )
+        self.db.upsert_ratings_batch(2, [UserRating(1, 5, False, 20200101)])
+
+        # when
+        result = self.db.remove_ratings_except(1, {2})
+        # then
+        self.assertEqual(result, RatingChanges(inserted=0, updated=0, removed=1))
+        cur = self.db.con.cursor()
+        self.assertEqual(
+            cur.execute(
+                "SELECT user_id, movie_id FROM rating ORDER BY user_id, movie_id;"
+            ).fetchall(),
+            [(1, 2), (2, 1)],
+        )
+
+    def test_should_full_sync_ratings(self):
+        # expect
+        self.assertTrue(self.db.should_full_sync_ratings(1))
+
+        # when
+        self.db.mark_full_sync_ratings(1)
+        # then
+        self.assertFalse(self.db.should_full_sync_ratings(1))
+        self.assertTrue(self.db.should_full_sync_ratings(2))
+
+    def test_should_full_sync_ratings_stale(self):
+        # given
+        cur = self.db.con.cursor()
+        cur.execute(
+            "INSERT INTO rating_sync (user_id, last_full_sync) VALUES (1, datetime('now', '-8 days'));"
+        )
+
+        # expect
+        self.assertTrue(self.db.should_full_sync_ratings(1))
+        self.assertFalse(self.db.should_full_sync_ratings(1, 9 * 24 * 60 * 60))
+
+    def test_get_stored_ratings(self):
+        # given
+        self.db.upsert_ratings_batch(
+            1,
+            [UserRating(1, 8, False, 20200101), UserRating(2, 7, True, 20200102)],
+        )
+        self.db.upsert_ratings_batch(2, [UserRating(1, 5, False, 20200101)])
+
+        # expect
+        self.assertEqual(
+            self.db.get_stored_ratings(1),
+            {
+                1: UserRating(1, 8, False, 20200101),
+                2: UserRating(2, 7, True, 20200102),
+            },
+        )
+
+
+class TestFilmwebDBProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.name = os.path.join(self.tmp_dir.name, "filmweb.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def pragmas(self, db: FilmwebDB) -> tuple:
+        cur = db.con.cursor()
+        return tuple(
+            cur.execute(f"PRAGMA {pragma};").fetchone()[0]
+            for pragma in [
+                "journal_mode",
+                "synchronous",
+                "cache_size",
+                "mmap_size",
+                "temp_store",
+                "foreign_keys",
+            ]
+        )
+
+    def test_default_profile(self):
+        # when
+        db = FilmwebDB(self.name)
+        # then
+        self.assertEqual(db.profile, PROFILES["safe"])
+        self.assertEqual(self.pragmas(db), ("wal", 2, -16000, 0, 0, 0))
+
+    def test_bulk_load_profile(self):
+        # when
+        db = FilmwebDB(self.name, "bulk-load")
+        # then
+        self.assertEqual(self.pragmas(db), ("wal", 0, -256000, 1073741824, 2, 0))
+
+    def test_custom_profile(self):
+        # when
+        db = FilmwebDB(self.name, DBProfile("DELETE", "NORMAL", -1000, 0, "FILE", True))
+        # then
+        self.assertEqual(self.pragmas(db), ("delete", 1, -1000, 0, 1, 1))
+
+    def test_reader_while_writing(self):
+        # given
+        writer = FilmwebDB(self.name, "fast")
+        writer.upsert_ratings_batch(1, [UserRating(1, 8, False, 20200101)])
+        reader = FilmwebDB(self.name, "fast")
+
+        # when
+        cur = writer.con.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        cur.execute("DELETE FROM rating;")
+        # then
+        self.assertEqual(
+            reader.get_stored_ratings(1), {1: UserRating(1, 8, False, 20200101)}
+        )
+
+        # when
+        writer.con.commit()
+        # then
+        self.assertEqual(reader.get_stored_ratings(1), {})
+
+    def test_read_only(self):
+        # given
+        writer = FilmwebDB(self.name)
+        writer.upsert_ratings_batch(1, [UserRating(1, 8, False, 20200101)])
+
+        # when
+        reader = FilmwebDB(self.name, read_only=True)
+        # then
+        self.assertEqual(
+            reader.get_stored_ratings(1), {1: UserRating(1, 8, False, 20200101)}
+        )
+        self.assertEqual(list(reader.iter_all_user_ratings()), [])
+        # and
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.upsert_ratings_batch(1, [UserRating(2, 8, False, 20200101)])
+
+
+class TestFilmwebDBSchema(unittest.TestCase):
+    def setUp(self):
+        self.db = FilmwebDB("file::memory:")
+
+    def query_plan(self, query: str, params: dict) -> list[str]:
+        cur = self.db.con.cursor()
+        return list(
+            row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        )
+
+    def assertNoTableScan(self, query: str, params: dict):
+        plan = self.query_plan(query, params)
+        scans = list(
+            detail
+            for detail in plan
+            if detail.startswith("SCAN") and "VIRTUAL TABLE" not in detail
+        )
+        self.assertEqual(scans, [], plan)
+
+    def test_migrations_applied(self):
+        # given
+        cur = self.db.con.cursor()
+
+        # expect
+        self.assertEqual(
+            cur.execute("PRAGMA user_version;").fetchone()[0], len(MIGRATIONS)
+        )
+
+    def test_migrations_applied_to_old_database(self):
+        # given
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            name = os.path.join(tmp_dir, "filmweb.db")
+            db = FilmwebDB(name)
+            db.con.executescript(
+                """
+                  DROP INDEX rating_user_idx;
+                  ALTER TABLE rating DROP COLUMN last_updated;
+                  ALTER TABLE movie DROP COLUMN fingerprint;
+                  ALTER TABLE movie_rating DROP COLUMN fingerprint;
+                  ALTER TABLE movie DROP COLUMN content_changed_at;
+                  ALTER TABLE movie_rating DROP COLUMN content_changed_at;
+                  CREATE TRIGGER movie_inserted AFTER INSERT ON movie
+                  FOR EACH ROW
+                  BEGIN
+                    UPDATE movie SET last_updated = datetime() WHERE id = NEW.id;
+                  END;
+                  PRAGMA user_version = 0;
+                """
+            )
+            db.con.close()
+
+            # when
+            db = FilmwebDB(name)
+            # then
+            cur = db.con.cursor()
+            self.assertEqual(
+                cur.execute("PRAGMA user_version;").fetchone()[0], len(MIGRATIONS)
+            )
+            self.assertEqual(
+                cur.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'rating_user_idx';"
+                ).fetchall(),
+                [("rating_user_idx",)],
+            )
+            self.assertEqual(
+                cur.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'trigger';"
+                ).fetchall(),
+                [],
+            )
+            self.assertIn(
+                "last_updated",
+                list(row[1] for row in cur.execute("PRAGMA table_info(rating);")),
+            )
+            for table in ["movie", "movie_rating"]:
+                self.assertIn(
+                    "fingerprint",
+                    list(row[1] for row in cur.execute(f"PRAGMA table_info({table});")),
+                )
+            db.con.close()
+
+    def test_up_to_date_database_skips_schema(self):
+        # given
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            name = os.path.join(tmp_dir, "filmweb.db")
+            FilmwebDB(name).con.close()
+
+            with patch.object(FilmwebDB, "create_schema") as mock_create_schema:
+                with patch.object(FilmwebDB, "migrate") as mock_migrate:
+                    # when
+                    db = FilmwebDB(name)
+                    # then
+                    mock_create_schema.assert_not_called()
+                    mock_migrate.assert_not_called()
+                    self.assertEqual(db.schema_version(), len(MIGRATIONS))
+                    db.con.close()
+
+    def test_new_database_creates_schema(self):
+        # given
+        with (
+            patch.object(FilmwebDB, "create_schema") as mock_create_schema,
+            patch.object(FilmwebDB, "migrate") as mock_migrate,
+        ):
+            # when
+            FilmwebDB("file::memory:")
+            # then
+            mock_create_schema.assert_called_once()
+            mock_migrate.assert_called_once()
+
+    def test_timestamp_triggers_dropped(self):
+        # given
+        cur = self.db.con.cursor()
+
+        # expect
+        self.assertEqual(
+            cur.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger';"
+            ).fetchall(),
+            [],
+        )
+
+    def test_hot_queries_use_indexes(self):
+        # expect
+        self.assertNoTableScan(SELECT_STORED_RATINGS, {"id": 1})
+        self.assertNoTableScan(
+            DELETE_RATINGS_EXCEPT, {"user_id": 1, "movie_ids": "[1, 2]"}
+        )
+        self.assertNoTableScan(DELETE_SIMILAR_USERS, {"user_id": 1})
+        self.assertNoTableScan(
+            "SELECT movie_id FROM movie_genres WHERE genre_id = :id;", {"id": 1}
+        )
+        self.assertNoTableScan(
+            "SELECT movie_id FROM movie_directors WHERE director_id = :id;", {"id": 1}
+        )
+        self.assertNoTableScan(
+            "SELECT movie_id FROM movie_cast WHERE cast_id = :id;", {"id": 1}
+        )
+        self.assertNoTableScan(
+            "SELECT movie_id FROM movie_countries WHERE country_id = :id;", {"id": 1}
+        )
+
+    def test_export_uses_indexes(self):
+        # given
+        cur = self.db.con.cursor()
+        cur.execute("ANALYZE;")
+
+        # when
+        plan = self.query_plan(SELECT_USER_RATING, {"id": 1})
+        # then
+        self.assertIn("SEARCH r USING COVERING INDEX rating_user_idx (user_id=?)", plan)
+        self.assertIn("SEARCH m USING INTEGER PRIMARY KEY (rowid=?)", plan)
@@ -0,0 +1,318 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from backup.db import MovieRatingDetails
+from backup.export import (
+    EXPORT_FORMATS,
+    ColumnarExporter,
+    CsvExporter,
+    Exporter,
+    ExportManifest,
+    GzipCsvExporter,
+    HashingWriter,
+    JsonLinesExporter,
+    ParquetExporter,
+    ZstdCsvExporter,
+    atomic_write,
+    export_formats,
+    read_columnar,
+)
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+RATINGS = [
+    MovieRatingDetails(
+        "title 1",
+        "int title",
+        "tytuł",
+        2000,
+        7.5,
+        8,
+        True,
+        20200101,
+        120,
+        "Dramat",
+        "Jan",
+        "Anna,Piotr",
+        "pl",
+    ),
+    MovieRatingDetails(
+        "title 2",
+        None,
+        None,
+        1999,
+        None,
+        3,
+        False,
+        20210202,
+        None,
+        None,
+        None,
+        None,
+        None,
+    ),
+]
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "export.csv")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_atomic_write(self):
+        # given
+        with open(self.path, "w") as file:
+            file.write("old")
+
+        # when
+        with atomic_write(self.path) as file:
+            file.write("new")
+            # then
+            with open(self.path) as old_file:
+                self.assertEqual(old_file.read(), "old")
+
+        # and
+        with open(self.path) as new_file:
+            self.assertEqual(new_file.read(), "new")
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["export.csv"])
+
+    def test_atomic_write_failure(self):
+        # given
+        with open(self.path, "w") as file:
+            file.write("old")
+
+        # when
+        with self.assertRaises(ValueError):
+            with atomic_write(self.path) as file:
+                file.write("new")
+                raise ValueError()
+        # then
+        with open(self.path) as old_file:
+            self.assertEqual(old_file.read(), "old")
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["export.csv"])
+
+    def test_hashing_writer(self):
+        # given
+        file = io.BytesIO()
+
+        # when
+        writer = HashingWriter(file)
+        writer.write(b"abc")
+        # then
+        self.assertEqual(file.getvalue(), b"abc")
+        self.assertEqual(writer.tell(), 3)
+        self.assertEqual(
+            writer.hexdigest(),
+            "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad",
+        )
+
+    def test_csv_exporter(self):
+        # given
+        file = io.BytesIO()
+
+        # when
+        exporter = CsvExporter(file)
+        exported = exporter.write_rows(iter(RATINGS))
+        exporter.close()
+        # then
+        self.assertEqual(exported, 2)
+        self.assertEqual(
+            file.getvalue().decode("utf-8").splitlines(),
+            [
+                "original_title,international_title,title,year,rate,my_rate,favorite,view_date,duration,genres,directors,cast,countries",
+                'title 1,int title,tytuł,2000,7.5,8,True,20200101,120,Dramat,Jan,"Anna,Piotr",pl',
+                "title 2,,,1999,,3,False,20210202,,,,,",
+            ],
+        )
+
+    def test_gzip_csv_exporter(self):
+        # given
+        plain_file = io.BytesIO()
+        gzip_file = io.BytesIO()
+
+        # when
+        for exporter in [CsvExporter(plain_file), GzipCsvExporter(gzip_file)]:
+            exporter.write_rows(iter(RATINGS))
+            exporter.close()
+        # then
+        self.assertEqual(gzip.decompress(gzip_file.getvalue()), plain_file.getvalue())
+
+    @unittest.skipUnless(zstandard, "zstandard is not installed")
+    def test_zstd_csv_exporter(self):
+        # given
+        plain_file = io.BytesIO()
+        zstd_file = io.BytesIO()
+
+        # when
+        for exporter in [CsvExporter(plain_file), ZstdCsvExporter(zstd_file)]:
+            exporter.write_rows(iter(RATINGS))
+            exporter.close()
+        # then
+        self.assertFalse(zstd_file.closed)
+        with zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(zstd_file.getvalue())
+        ) as reader:
+            self.assertEqual(reader.read(), plain_file.getvalue())
+
+    def test_json_lines_exporter(self):
+        # given
+        file = io.BytesIO()
+
+        # when
+        exporter = JsonLinesExporter(file)
+        exported = exporter.write_rows(iter(RATINGS))
+        exporter.close()
+        # then
+        self.assertEqual(exported, 2)
+        rows = [json.loads(line) for line in file.getvalue().splitlines()]
+        self.assertEqual(rows[0]["title"], "tytuł")
+        self.assertEqual(rows[0]["rate"], 7.5)
+        self.assertIs(rows[0]["favorite"], True)
+        self.assertIsNone(rows[1]["rate"])
+
+    def test_columnar_exporter(self):
+        # given
+        file = io.BytesIO()
+
+        # when
+        exporter = ColumnarExporter(file, row_group_size=1)
+        exported = exporter.write_rows(iter(RATINGS))
+        exporter.close()
+        # then
+        self.assertEqual(exported, 2)
+        file.seek(0)
+        self.assertEqual(
+            list(read_columnar(file)),
+            [
+                {
+                    "original_title": "title 1",
+                    "international_title": "int title",
+                    "title": "tytuł",
+                    "year": 2000,
+                    "rate": 7.5,
+                    "my_rate": 8,
+                    "favorite": True,
+                    "view_date": 20200101,
+                    "duration": 120,
+                    "genres": "Dramat",
+                    "directors": "Jan",
+                    "cast": "Anna,Piotr",
+                    "countries": "pl",
+                },
+                {
+                    "original_title": "title 2",
+                    "international_title": None,
+                    "title": None,
+                    "year": 1999,
+                    "rate": None,
+                    "my_rate": 3,
+                    "favorite": False,
+                    "view_date": 20210202,
+                    "duration": None,
+                    "genres": None,
+                    "directors": None,
+                    "cast": None,
+                    "countries": None,
+                },
+            ],
+        )
+
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_parquet_exporter(self):
+        # given
+        file = io.BytesIO()
+
+        # when
+        exporter = ParquetExporter(file, row_group_size=1)
+        exported = exporter.write_rows(iter(RATINGS))
+        exporter.close()
+        # then
+        self.assertEqual(exported, 2)
+        parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(file.getvalue()))
+        self.assertEqual(parquet_file.num_row_groups, 2)
+        rows = parquet_file.read().to_pylist()
+        self.assertEqual(rows[0]["title"], "tytuł")
+        self.assertEqual(rows[0]["rate"], 7.5)
+        self.assertIs(rows[0]["favorite"], True)
+        self.assertEqual(rows[0]["view_date"], 20200101)
+        self.assertIsNone(rows[1]["rate"])
+        self.assertIsNone(rows[1]["duration"])
+
+    def test_exporter_is_abstract(self):
+        # expect
+        with self.assertRaises(TypeError):
+            Exporter(io.BytesIO())  # pylint: disable=abstract-class-instantiated
+
+    def test_export_formats(self):
+        # expect
+        self.assertEqual(
+            [name for name in EXPORT_FORMATS if name not in ("csv.zst", "parquet")],
+            ["csv", "csv.gz", "jsonl", "fwcol", "columnar"],
+        )
+        self.assertIs(EXPORT_FORMATS["fwcol"], ColumnarExporter)
+
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_export_formats_with_pyarrow(self):
+        # when
+        formats = export_formats()
+        # then
+        self.assertIs(formats["parquet"], ParquetExporter)
+        self.assertIs(formats["columnar"], ParquetExporter)
+
+    def test_export_formats_without_pyarrow(self):
+        # when
+        with patch("backup.export.pyarrow", None):
+            formats = export_formats()
+        # then
+        self.assertNotIn("parquet", formats)
+        self.assertIs(formats["columnar"], ColumnarExporter)
+
+    def test_export_formats_without_zstandard(self):
+        # when
+        with patch("backup.export.zstandard", None):
+            formats = export_formats()
+        # then
+        self.assertNotIn("csv.zst", formats)
+
+    def test_manifest(self):
+        # given
+        manifest_path = os.path.join(self.tmp_dir.name, "manifest.json")
+        manifest = ExportManifest(manifest_path)
+        with open(self.path, "w") as file:
+            file.write("abc")
+
+        # expect
+        self.assertFalse(manifest.is_current(1, self.path, "1|2020"))
+
+        # when
+        manifest.update(1, self.path, "1|2020", "digest")
+        manifest.save()
+        manifest = ExportManifest(manifest_path)
+        # then
+        self.assertTrue(manifest.is_current(1, self.path, "1|2020"))
+        self.assertFalse(manifest.is_current(1, self.path, "2|2020"))
+        self.assertFalse(manifest.is_current(1, self.path, None))
+        self.assertFalse(manifest.is_current(2, self.path, "1|2020"))
+        self.assertEqual(manifest.entries["1"]["sha256"], "digest")
+
+        # when
+        os.remove(self.path)
+        # then
+        self.assertFalse(manifest.is_current(1, self.path, "1|2020"))
@@ -0,0 +1,222 @@
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+from backup.ratelimit import (
+    RateLimiter,
+    TokenBucket,
+    backoff_delay,
+    endpoint_class,
+    parse_retry_after,
+)
+
+
+class TestEndpointClass(unittest.TestCase):
+    def test_endpoint_class(self):
+        # expect
+        self.assertEqual(endpoint_class("/film/743825/preview"), "/film/*/preview")
+        self.assertEqual(endpoint_class("/film/743825/rating"), "/film/*/rating")
+        self.assertEqual(
+            endpoint_class("/api/v1/logged/vote/title/film?page=2"), "/logged/*"
+        )
+        self.assertEqual(endpoint_class("/logged/friends"), "/logged/*")
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_parse_retry_after_seconds(self):
+        # expect
+        self.assertEqual(parse_retry_after("120"), 120.0)
+        self.assertEqual(parse_retry_after(" 3 "), 3.0)
+
+    def test_parse_retry_after_http_date(self):
+        # expect
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+        self.assertGreater(parse_retry_after("Fri, 31 Dec 9999 23:59:59 GMT"), 0.0)
+
+    def test_parse_retry_after_invalid(self):
+        # expect
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after(""))
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+class TestBackoffDelay(unittest.TestCase):
+    def test_backoff_delay_grows_exponentially(self):
+        # expect
+        for attempt, limit in [(1, 1.0), (2, 2.0), (3, 4.0), (4, 8.0)]:
+            delay = backoff_delay(attempt)
+            self.assertGreaterEqual(delay, limit / 2)
+            self.assertLessEqual(delay, limit)
+
+    def test_backoff_delay_is_capped(self):
+        # expect
+        self.assertLessEqual(backoff_delay(100, cap=10), 10)
+
+
+@patch("backup.ratelimit.time.sleep")
+@patch("backup.ratelimit.time.monotonic")
+class TestTokenBucket(unittest.TestCase):
+    def test_invalid_limits(self, *_: Mock):
+        # expect
+        for rate, burst in [(0, 5), (-1, 5), (5, 0), (5, -1)]:
+            with self.assertRaises(ValueError):
+                TokenBucket(rate, burst)
+
+    def test_burst_is_not_delayed(self, mock_monotonic: Mock, mock_sleep: Mock):
+        # given
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=3)
+
+        # when
+        for _ in range(3):
+            bucket.acquire()
+        # then
+        mock_sleep.assert_not_called()
+
+    def test_callers_above_burst_are_queued(
+        self, mock_monotonic: Mock, mock_sleep: Mock
+    ):
+        # given
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=1)
+
+        # when
+        delays = list(bucket.reserve() for _ in range(4))
+        # then
+        self.assertEqual(delays, [0.0, 0.5, 1.0, 1.5])
+
+    def test_bucket_refills(self, mock_monotonic: Mock, mock_sleep: Mock):
+        # given
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=2)
+        bucket.reserve()
+        bucket.reserve()
+
+        # when
+        mock_monotonic.return_value = 100.5
+        # then
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.5)
+
+    def test_bucket_does_not_exceed_burst(self, mock_monotonic: Mock, _: Mock):
+        # given
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=2)
+
+        # when
+        mock_monotonic.return_value = 200.0
+        # then
+        self.assertEqual(list(bucket.reserve() for _ in range(3)), [0.0, 0.0, 0.5])
+
+    def test_throttle_decreases_rate(self, mock_monotonic: Mock, _: Mock):
+        # given
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=8, burst=1, min_rate=1)
+
+        # when
+        bucket.on_throttle()
+        # then
+        self.assertEqual(bucket.rate, 4)
+
+        # when
+        bucket.on_throttle()
+        # then
+        self.assertEqual(bucket.rate, 4)
+
+        # when
+        mock_monotonic.return_value = 102.0
+        bucket.on_throttle()
+        mock_monotonic.return_value = 104.0
+        bucket.on_throttle()
+        mock_monotonic.return_value = 106.0
+        bucket.on_throttle()
+        # then
+        self.assertEqual(bucket.rate, 1)
+
+    def test_throttle_respects_retry_after(self, mock_monotonic: Mock, _: Mock):
+        # given
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=4, burst=4)
+
+        # when
+        bucket.on_throttle(retry_after=10)
+        # then
+        self.assertEqual(bucket.reserve(), 10.5)
+
+        # when
+        mock_monotonic.return_value = 110.0
+        # then
+        self.assertEqual(bucket.reserve(), 1.0)
+
+    def test_success_increases_rate(self, mock_monotonic: Mock, _: Mock):
+        # given
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=4, burst=1, increase=0.5)
+        bucket.on_throttle()
+
+        # when
+        for _ in range(2):
+            bucket.on_success()
+        # then
+        self.assertEqual(bucket.rate, 2.5)
+
+        # when
+        for _ in range(100):
+            bucket.on_success()
+        # then
+        self.assertEqual(bucket.rate, 4)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_invalid_limits(self):
+        # expect
+        for rate, burst in [(0, 5), (-1, 5), (5, 0), (5, -1)]:
+            with self.assertRaises(ValueError):
+                RateLimiter(rate, burst)
+            with self.assertRaises(ValueError):
+                RateLimiter(limits={"/logged/*": (rate, burst)})
+
+    def test_bucket_per_host_and_endpoint_class(self):
+        # given
+        limiter = RateLimiter(rate=5, burst=5, limits={"/logged/*": (1, 2)})
+
+        # when
+        preview = limiter.bucket("https://www.filmweb.pl/api/v1/film/1/preview")
+        other_preview = limiter.bucket("https://www.filmweb.pl/api/v1/film/2/preview")
+        rating = limiter.bucket("https://www.filmweb.pl/api/v1/film/1/rating")
+        logged = limiter.bucket("https://www.filmweb.pl/api/v1/logged/friends")
+        other_host = limiter.bucket("https://example.com/api/v1/film/1/preview")
+        # then
+        self.assertIs(preview, other_preview)
+        self.assertIsNot(preview, rating)
+        self.assertIsNot(preview, other_host)
+        # and
+        self.assertEqual((preview.rate, preview.burst), (5, 5))
+        self.assertEqual((logged.rate, logged.burst), (1, 2))
+
+    def test_effective_rates(self):
+        # given
+        limiter = RateLimiter(rate=4, burst=4)
+        url = "https://www.filmweb.pl/api/v1/film/1/preview"
+
+        # when
+        limiter.acquire(url)
+        limiter.on_throttle(url)
+        # then
+        self.assertEqual(limiter.effective_rate(url), 2)
+        self.assertEqual(
+            limiter.effective_rates(), {"www.filmweb.pl/film/*/preview": 2}
+        )
+
+
+class TestRateLimiterAsync(unittest.IsolatedAsyncioTestCase):
+    @patch("backup.ratelimit.asyncio.sleep", new_callable=AsyncMock)
+    async def test_acquire_async_waits(self, mock_sleep: AsyncMock):
+        # given
+        limiter = RateLimiter(rate=1, burst=1)
+
+        # when
+        await limiter.acquire_async("https://www.filmweb.pl/api/v1/film/1/preview")
+        await limiter.acquire_async("https://www.filmweb.pl/api/v1/film/1/preview")
+        # then
+        mock_sleep.assert_awaited_once()
+        self.assertAlmostEqual(mock_sleep.await_args.args[0], 1.0, places=2)
@@ -0,0 +1,84 @@
+import base64
+import json
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+from backup.token import TokenCache, decode_expiry
+
+
+def make_jwt(expires_at: float) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    return f"{encode({"alg": "HS256"})}.{encode({"exp": int(expires_at)})}.signature"
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "jwt.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_decode_expiry(self):
+        # expect
+        self.assertEqual(decode_expiry(make_jwt(1700000000)), 1700000000.0)
+        self.assertIsNone(decode_expiry("jwt"))
+        self.assertIsNone(decode_expiry(None))
+        self.assertIsNone(decode_expiry("a.b.c"))
+        self.assertIsNone(decode_expiry("a.e30.c"))
+
+    def test_save_and_load(self):
+        # given
+        token = make_jwt(time.time() + 3600)
+        cache = TokenCache("artuser-secret", self.path)
+
+        # when
+        cache.save(token)
+        # then
+        cached = TokenCache("artuser-secret", self.path).load()
+        self.assertEqual(cached.token, token)
+        self.assertAlmostEqual(cached.expires_in(), 3600, delta=5)
+        # and
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        with open(self.path) as cache_file:
+            self.assertNotIn("artuser-secret", cache_file.read())
+
+    def test_load_other_secret(self):
+        # given
+        TokenCache("secret", self.path).save(make_jwt(time.time() + 3600))
+
+        # expect
+        self.assertIsNone(TokenCache("other", self.path).load())
+
+    def test_save_without_expiry(self):
+        # when
+        TokenCache("secret", self.path).save("jwt")
+        # then
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_load_fresh(self):
+        # given
+        token = make_jwt(time.time() + 30)
+        cache = TokenCache("secret", self.path)
+        cache.save(token)
+
+        # expect
+        self.assertEqual(cache.load_fresh(None, 10).token, token)
+        self.assertIsNone(cache.load_fresh(None, 60))
+        self.assertIsNone(cache.load_fresh(token, 10))
+
+    def test_lock(self):
+        # given
+        cache = TokenCache("secret", self.path)
+
+        # when
+        with cache.lock():
+            with open(f"{self.path}.lock") as _:
+                pass
+        # then
+        self.assertEqual(stat.S_IMODE(os.stat(f"{self.path}.lock").st_mode), 0o600)